@@ -0,0 +1,82 @@
+"""
+Cost of rendering bot messages with inline f-strings, `escape_markdown` and uncached quantization vs precompiled templates
+with cached escaping and quantization exponents and memoized formatted fields of users.
+
+Renders the order offer sent to every maker and the TOP entries rendered for every changed maker.
+
+Usage:
+    python benchmarks/formatting.py [--users 100] [--repeat 5] [--number 200]
+"""
+from argparse import ArgumentParser
+from decimal import Decimal, ROUND_HALF_EVEN
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+for name, value in {'TOKEN': '0:benchmark', 'ACCEPT_ORDER_TIMEOUT': '10', 'TOP_LENGTH': '10', 'FROZEN_BALANCE_COOLDOWN': '600', 'ORDER_FEE': '0', 'SUPPORT_ID': '0'}.items():
+    os.environ.setdefault(name, value)
+
+from telegram.helpers import escape_markdown as md
+from database import User
+from formatting_helper import FormattingHelper
+import templates
+
+
+def quantize(value: Decimal, exp: int) -> str:
+    # FormattingHelper.quantize before exponents were cached.
+    return str(value.quantize(Decimal(10) ** -exp, rounding=ROUND_HALF_EVEN)).rstrip('0').rstrip('.')
+
+def formatted_name(user: User) -> str:
+    if len(user.name) <= 8:
+        return user.name
+    stripped_name = user.name[1:] if user.name.startswith('@') else user.name
+    return stripped_name[:8] + "..."
+
+def formatted_balance(user: User) -> str:
+    return str(0) if user.balance.is_zero() else quantize(user.balance, 8)
+
+def formatted_exchange_rate(user: User) -> str:
+    return str(0) if user.exchange_rate.is_zero() else quantize(user.exchange_rate, 2)
+
+def inline_offer(user: User, quantity: Decimal) -> str:
+    return f"Запрос на покупку *{md(quantize(quantity, 8), version=2)}* USDT\nБаланс: *{md(formatted_balance(user), version=2)}* USDT\nПрибыль: *{md(quantize(quantity * user.exchange_rate, 2), version=2)}* {user.currency}"
+
+def template_offer(user: User, quantity: Decimal) -> str:
+    return templates.OFFER.render(quantity=FormattingHelper.quantize(quantity, 8), balance=user.formatted_balance, profit=FormattingHelper.quantize(quantity * user.exchange_rate, 2), currency=user.currency)
+
+def inline_entry(user: User) -> str:
+    return f"{md(formatted_name(user), version=2)} \\| *{md(formatted_balance(user), version=2)}* USDT \\| 1 USDT \\= *{md(formatted_exchange_rate(user), version=2)}* {user.currency}"
+
+def template_entry(user: User) -> str:
+    return templates.LEADERBOARD_ENTRY.render(name=user.formatted_name, balance=user.formatted_balance, exchange_rate=user.formatted_exchange_rate, currency=user.currency)
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--number', type=int, default=200)
+    args = parser.parse_args()
+
+    users = [
+        User(id=id, name=f"@maker_{id}", card='4111111111111111', balance=Decimal(1000 + id) / 7, exchange_rate=Decimal(90) + Decimal(id % 100) / 10, currency='RUB')
+        for id in range(args.users)
+    ]
+    quantity = Decimal('125.5')
+    for user in users:
+        assert inline_offer(user, quantity) == template_offer(user, quantity)
+        assert inline_entry(user) == template_entry(user)
+
+    cases = {
+        "offer": (lambda: [inline_offer(user, quantity) for user in users], lambda: [template_offer(user, quantity) for user in users]),
+        "TOP entry": (lambda: [inline_entry(user) for user in users], lambda: [template_entry(user) for user in users]),
+    }
+    print(f"{'message':>10} {'inline, us':>11} {'template, us':>13} {'speedup':>8}")
+    for name, (inline, template) in cases.items():
+        inline_time = min(timeit.repeat(inline, repeat=args.repeat, number=args.number)) / args.number / args.users * 1e6
+        template_time = min(timeit.repeat(template, repeat=args.repeat, number=args.number)) / args.number / args.users * 1e6
+        print(f"{name:>10} {inline_time:>11.2f} {template_time:>13.2f} {inline_time / template_time:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Throughput of per-user order actions with the former class-wide lock in `OrderContextManager.get` vs per-user locks only.
+
+Every simulated user repeatedly runs an action shaped like the bot handlers: get the manager, lock it, then lock the context.
+Loading the state costs `--load-latency` seconds, as a round trip to the Postgres context store does.
+
+Usage:
+    python benchmarks/lock_contention.py [--users 1 10 100 1000] [--actions 20] [--load-latency 0.001] [--io-latency 0.005]
+"""
+from argparse import ArgumentParser
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+for name, value in {'TOKEN': '0:benchmark', 'ACCEPT_ORDER_TIMEOUT': '10', 'TOP_LENGTH': '10', 'FROZEN_BALANCE_COOLDOWN': '600', 'ORDER_FEE': '0', 'SUPPORT_ID': '0'}.items():
+    os.environ.setdefault(name, value)
+
+from context_store import ContextState, MemoryContextStore
+import order_manager
+from order_manager import OrderContextManager
+
+
+class SimulatedStore(MemoryContextStore):
+    def __init__(self, load_latency: float):
+        super().__init__()
+        self._load_latency = load_latency
+
+    async def load(self, user_id: int):
+        await asyncio.sleep(self._load_latency)
+        return await super().load(user_id)
+
+
+async def action(user_id: int, global_lock: asyncio.Lock | None, io_latency: float):
+    if global_lock:
+        async with global_lock:
+            ocm = await OrderContextManager.get(user_id)
+    else:
+        ocm = await OrderContextManager.get(user_id)
+    async with ocm:
+        # Stands for the database and Bot API calls of a handler.
+        await asyncio.sleep(io_latency)
+
+async def measure(users: int, actions: int, global_lock: asyncio.Lock | None, io_latency: float) -> float:
+    async def user(user_id: int):
+        for _ in range(actions):
+            await action(user_id, global_lock, io_latency)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(user(user_id) for user_id in range(users)))
+    return users * actions / (time.perf_counter() - start)
+
+async def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, nargs='+', default=[1, 10, 100, 1000])
+    parser.add_argument('--actions', type=int, default=20)
+    parser.add_argument('--load-latency', type=float, default=0.001)
+    parser.add_argument('--io-latency', type=float, default=0.005)
+    args = parser.parse_args()
+
+    store = order_manager.store = SimulatedStore(args.load_latency)
+    for user_id in range(max(args.users)):
+        store._states[user_id] = ContextState()
+
+    print(f"{'users':>6} {'global lock, ops/s':>20} {'per-user locks, ops/s':>22} {'speedup':>8}")
+    for users in args.users:
+        global_ops = await measure(users, args.actions, asyncio.Lock(), args.io_latency)
+        keyed_ops = await measure(users, args.actions, None, args.io_latency)
+        print(f"{users:>6} {global_ops:>20.0f} {keyed_ops:>22.0f} {keyed_ops / global_ops:>7.1f}x")
+    print(f"Locks left in the registry: {len(store._locks)}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,197 @@
+"""
+Admission control of the order API.
+
+Placing an order holds a task, DB sessions and the locks of the makers it's offered to until a maker accepts it,
+so only `ORDER_CONCURRENCY` orders of a currency are placed at the same time. The rest wait for a slot in a bounded queue,
+first come first served. Orders are rejected with 429 and `Retry-After` rather than queued once the queue is full
+or when they're expected to wait longer than `ORDER_QUEUE_TIMEOUT`, judging by how long the recent orders took.
+On top of that every API key is limited to `ORDER_RATE` orders per second.
+"""
+from asyncio import Future, get_running_loop, wait_for
+from collections import deque
+import logging
+from math import ceil
+from time import monotonic
+from typing import Optional
+
+from fastapi import HTTPException
+from config import ORDER_BURST, ORDER_CONCURRENCY, ORDER_QUEUE_SIZE, ORDER_QUEUE_TIMEOUT, ORDER_RATE
+from dispatcher import TokenBucket
+import metrics
+
+# Weight of the latest order in the average duration of orders.
+DURATION_WEIGHT = 0.2
+
+
+class Lane:
+    """
+    Slots and queue of a currency.
+    """
+    def __init__(self):
+        self.running = 0
+        # Futures of the queued orders resolved once they're given a slot.
+        self.waiters: deque[Future] = deque()
+        # Average seconds an order holds its slot for, unknown until an order has been placed.
+        self.duration: Optional[float] = None
+
+
+class Ticket:
+    """
+    Place of an order in its currency's lane: holds a slot while entered, waiting for it first if the order was queued.
+    """
+    def __init__(self, admission: 'Admission', currency: str, waiter: Optional[Future], deadline: float):
+        self._admission = admission
+        self._currency = currency
+        self._waiter = waiter
+        self._deadline = deadline
+        self._started = 0.0
+        self._done = False
+
+    async def __aenter__(self) -> 'Ticket':
+        self._done = True
+        if self._waiter is not None:
+            await self._admission._wait(self._currency, self._waiter, self._deadline)
+        self._started = monotonic()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._admission._release(self._currency, monotonic() - self._started)
+
+    def cancel(self):
+        """
+        Gives up the slot or the place in the queue of a ticket that won't be entered, e.g. as its order failed before being placed.
+        Does nothing once the ticket has been entered or cancelled.
+        """
+        if self._done:
+            return
+        self._done = True
+        if self._waiter is None:
+            self._admission._release(self._currency, None)
+        else:
+            self._admission._leave(self._currency, self._waiter)
+
+
+class Admission:
+    def __init__(self, concurrency: int, queue_size: int, queue_timeout: float, rate: float, burst: float):
+        self._concurrency = concurrency
+        self._queue_size = queue_size
+        self._queue_timeout = queue_timeout
+        self._rate = rate
+        self._burst = burst
+        self._lanes: dict[str, Lane] = {}
+        self._buckets: dict[str, TokenBucket] = {}
+
+    def limit_rate(self, key: str, orders: int = 1):
+        """
+        Takes the orders from the API key's token bucket.
+
+        Args:
+            key (str): API key placing the orders
+            orders (int): Orders placed, e.g. of a batch
+
+        Raises:
+            HTTPException: 429 if the key exceeded its rate
+        """
+        if self._rate <= 0:
+            return
+        if (bucket := self._buckets.get(key)) is None:
+            bucket = self._buckets[key] = TokenBucket(self._rate, self._burst)
+        # A batch larger than the burst would never fit.
+        tokens = min(orders, self._burst)
+        if delay := bucket.delay(tokens):
+            self._reject('rate', delay, f"Rate limit of {self._rate:g} orders per second exceeded.")
+        bucket.take(tokens)
+
+    def reserve(self, currency: str) -> Ticket:
+        """
+        Admits the order to its currency's lane. The returned ticket is entered for as long as the order is placed.
+
+        Args:
+            currency (str): Currency of the order
+
+        Returns:
+            Ticket: Slot of the order or its place in the queue
+
+        Raises:
+            HTTPException: 429 if the queue is full or the order is expected to wait longer than the queue timeout
+        """
+        lane = self._lane(currency)
+        deadline = monotonic() + self._queue_timeout
+        if lane.running < self._concurrency and not lane.waiters:
+            lane.running += 1
+            return Ticket(self, currency, None, deadline)
+
+        if len(lane.waiters) >= self._queue_size:
+            self._reject('queue_full', self._expected_wait(lane, len(lane.waiters)), f"Too many {currency} orders are waiting to be placed.")
+        if (wait := self._expected_wait(lane, len(lane.waiters) + 1)) > self._queue_timeout:
+            self._reject('deadline', wait, f"{currency} orders are expected to wait longer than {self._queue_timeout:g}s to be placed.")
+
+        waiter = get_running_loop().create_future()
+        lane.waiters.append(waiter)
+        return Ticket(self, currency, waiter, deadline)
+
+    @property
+    def queued(self) -> dict[tuple[str, ...], float]:
+        return {(currency,): len(lane.waiters) for currency, lane in self._lanes.items()}
+
+    @property
+    def running(self) -> dict[tuple[str, ...], float]:
+        return {(currency,): lane.running for currency, lane in self._lanes.items()}
+
+    async def _wait(self, currency: str, waiter: Future, deadline: float):
+        lane = self._lanes[currency]
+        start = monotonic()
+        try:
+            await wait_for(waiter, max(deadline - start, 0))
+        except BaseException as e:
+            self._leave(currency, waiter)
+            if isinstance(e, TimeoutError):
+                self._reject('timeout', self._expected_wait(lane, len(lane.waiters) + 1), f"{currency} order waited longer than {self._queue_timeout:g}s to be placed.")
+            raise
+        finally:
+            metrics.order_queue_seconds.observe(monotonic() - start, currency=currency)
+
+    def _leave(self, currency: str, waiter: Future):
+        lane = self._lanes[currency]
+        if waiter.done() and not waiter.cancelled():
+            # Given the slot as it left, which is passed on.
+            self._release(currency, None)
+        else:
+            waiter.cancel()
+            if waiter in lane.waiters:
+                lane.waiters.remove(waiter)
+
+    def _release(self, currency: str, duration: Optional[float]):
+        lane = self._lanes[currency]
+        if duration is not None:
+            lane.duration = duration if lane.duration is None else lane.duration + DURATION_WEIGHT * (duration - lane.duration)
+        while lane.waiters:
+            waiter = lane.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        lane.running -= 1
+
+    def _lane(self, currency: str) -> Lane:
+        if (lane := self._lanes.get(currency)) is None:
+            lane = self._lanes[currency] = Lane()
+        return lane
+
+    def _expected_wait(self, lane: Lane, position: int) -> float:
+        """
+        Seconds until the order at `position` of the queue is given a slot, as every slot frees up once per average duration.
+        """
+        if lane.duration is None:
+            return 0
+        return position * lane.duration / self._concurrency
+
+    def _reject(self, reason: str, retry_after: float, detail: str):
+        metrics.order_rejections_total.inc(reason=reason)
+        logging.warning(f"Order rejected: {detail}", extra={"reason": reason})
+        raise HTTPException(status_code=429, detail=detail, headers={"Retry-After": str(max(ceil(retry_after), 1))})
+
+
+admission = Admission(ORDER_CONCURRENCY, ORDER_QUEUE_SIZE, ORDER_QUEUE_TIMEOUT, ORDER_RATE, ORDER_BURST)
+
+metrics.Gauge('orders_queued', "Orders waiting for a slot of their currency.", lambda: admission.queued, ('currency',))
+metrics.Gauge('orders_running', "Orders being placed by currency.", lambda: admission.running, ('currency',))
@@ -0,0 +1,67 @@
+"""
+Archival of finished orders.
+
+COMPLETED orders are kept forever and `orders` would only grow, slowing down every eligibility check and lookup of active orders.
+The archiver moves COMPLETED and DECLINED orders older than `ORDER_ARCHIVE_AGE` to `orders_archive`, so that `orders` only holds
+the orders in flight. Orders are moved in batches, each by a single statement deleting them from `orders` and inserting them
+into the archive in its own transaction. Rows locked by the handlers are skipped until the next run.
+"""
+from asyncio import sleep
+from datetime import datetime, timedelta, timezone
+import logging
+
+from sqlalchemy import Insert, delete, func, insert, select
+from config import ORDER_ARCHIVE_AGE, ORDER_ARCHIVE_BATCH_SIZE
+from database import ArchivedOrder, AsyncSessionFactory, Order, OrderStatus
+import metrics
+
+# Columns of `orders` copied to the archive as they are.
+COLUMNS = [column.name for column in Order.__table__.columns]
+
+
+class Archiver:
+    def __init__(self, age: float, batch_size: int):
+        self._age = age
+        self._batch_size = batch_size
+
+    async def archive(self) -> int:
+        """
+        Moves the finished orders batch by batch until none are left.
+
+        Returns:
+            int: Orders moved
+        """
+        archived = 0
+        statement = self._statement(datetime.now(timezone.utc) - timedelta(seconds=self._age))
+        while True:
+            async with AsyncSessionFactory() as session:
+                moved = len((await session.execute(statement)).all())
+                await session.commit()
+            archived += moved
+            metrics.orders_archived_total.inc(moved)
+            if moved < self._batch_size:
+                return archived
+
+    async def run(self, interval: float):
+        while True:
+            await sleep(interval)
+            try:
+                if archived := await self.archive():
+                    logging.info(f"Archived {archived} orders.")
+            except Exception as e:
+                logging.error(f"Error archiving orders: {e}", exc_info=True)
+
+    def _statement(self, before: datetime) -> Insert:
+        orders = Order.__table__
+        batch = (
+            select(orders.c.id)
+            .where(orders.c.status.in_([OrderStatus.COMPLETED, OrderStatus.DECLINED]), orders.c.created_at < before)
+            .limit(self._batch_size)
+            .with_for_update(skip_locked=True)
+        )
+        # Rowcount of INSERT ... SELECT from a DML CTE isn't reported, hence the moved IDs are returned.
+        moved = delete(orders).where(orders.c.id.in_(batch)).returning(*orders.c).cte('moved')
+        return insert(ArchivedOrder.__table__).from_select([*COLUMNS, 'archived_at'], select(*[moved.c[name] for name in COLUMNS], func.now())).returning(ArchivedOrder.__table__.c.id)
+
+
+archiver = Archiver(ORDER_ARCHIVE_AGE, ORDER_ARCHIVE_BATCH_SIZE)
@@ -0,0 +1,341 @@
+from asyncio import Event, create_task, sleep
+from contextlib import asynccontextmanager
+from enum import IntEnum
+import logging
+from typing import AsyncIterator, Awaitable, Callable, Optional
+import uuid
+from weakref import WeakValueDictionary
+
+import psycopg
+from sqlalchemy import make_url, text
+from sqlalchemy.ext.asyncio import AsyncConnection
+from telegram import Bot, Message
+from config import CONTEXT_STORE, DATABASE_URL
+from database import async_engine
+from locks import LockRegistry
+
+
+class LockScope(IntEnum):
+    MANAGER = 0
+    CONTEXT = 1
+
+
+class OrderOffer:
+    """
+    Client order offered to several makers at the same time.
+
+    The first maker to accept wins the offer, the rest are settled as losers.
+    The offer is settled once it's won or every maker it was offered to has withdrawn.
+    """
+    def __init__(self, id: Optional[str] = None, winner: Optional[int] = None):
+        self.id = id or str(uuid.uuid4())
+        self.winner: Optional[int] = winner
+        self.settled = Event()
+        self._pending: set[int] = set()
+
+    async def join(self, *user_ids: int):
+        self._pending.update(user_ids)
+
+    async def claim(self, user_id: int) -> bool:
+        if self.winner is None:
+            self.winner = user_id
+            self.settled.set()
+        return self.winner == user_id
+
+    async def withdraw(self, user_id: int):
+        self._pending.discard(user_id)
+        if not self._pending:
+            self.settled.set()
+
+    async def close(self):
+        pass
+
+
+class ContextState:
+    """
+    Live state of a user's order persisted by `ContextStore`.
+    """
+    def __init__(self, order_id: Optional[str] = None, offer: Optional[OrderOffer] = None, notification: Optional[Message] = None, support_message: Optional[Message] = None):
+        self.order_id = order_id
+        self.offer = offer
+        self.notification = notification
+        self.support_message = support_message
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, ContextState) and self._key() == other._key()
+
+    def _key(self) -> tuple:
+        return (self.order_id, self.offer and self.offer.id, self.notification, self.support_message)
+
+
+class ContextStore:
+    """
+    Store of `ContextState`s along with per-user locks guarding them.
+    """
+    def lock(self, scope: LockScope, user_id: int) -> AsyncIterator[Optional[AsyncConnection]]:
+        """
+        Exclusive lock of `scope` for `user_id`. Yields the connection holding the lock, if any, to run the guarded queries on.
+
+        The state is loaded, created, saved and deleted on `connection`, when given the one holding the lock,
+        instead of checking out another. It must not be in a transaction then.
+        """
+        raise NotImplementedError
+
+    async def load(self, user_id: int, connection: Optional[AsyncConnection] = None) -> Optional[ContextState]:
+        raise NotImplementedError
+
+    async def create(self, user_id: int, connection: Optional[AsyncConnection] = None) -> Optional[ContextState]:
+        """
+        Creates an empty state for `user_id`, claiming the user for a single order across processes. Returns None if it already exists.
+        """
+        raise NotImplementedError
+
+    async def save(self, user_id: int, state: ContextState, connection: Optional[AsyncConnection] = None):
+        """
+        Saves the state of `user_id` if it still exists.
+        """
+        raise NotImplementedError
+
+    async def delete(self, user_id: int, connection: Optional[AsyncConnection] = None) -> bool:
+        raise NotImplementedError
+
+    async def create_offer(self) -> OrderOffer:
+        raise NotImplementedError
+
+    async def pending_offers(self, user_id: int) -> list[OrderOffer]:
+        """
+        Offers `user_id` joined and hasn't withdrawn from yet.
+        """
+        raise NotImplementedError
+
+    async def discard_offers(self):
+        """
+        Discards all offers. Only safe at startup, as offers are awaited by the process that created them.
+        """
+        pass
+
+    async def start(self):
+        pass
+
+
+class MemoryContextStore(ContextStore):
+    """
+    Keeps the state in process. The service must then run as a single process.
+    """
+    def __init__(self):
+        self._states: dict[int, ContextState] = {}
+        self._locks = LockRegistry()
+        self._offers: WeakValueDictionary[str, OrderOffer] = WeakValueDictionary()
+
+    @asynccontextmanager
+    async def lock(self, scope: LockScope, user_id: int) -> AsyncIterator[None]:
+        async with self._locks.hold((scope, user_id)):
+            yield None
+
+    async def load(self, user_id: int, connection: Optional[AsyncConnection] = None) -> Optional[ContextState]:
+        return self._states.get(user_id)
+
+    async def create(self, user_id: int, connection: Optional[AsyncConnection] = None) -> Optional[ContextState]:
+        if user_id in self._states:
+            return None
+        state = self._states[user_id] = ContextState()
+        return state
+
+    async def save(self, user_id: int, state: ContextState, connection: Optional[AsyncConnection] = None):
+        if user_id in self._states:
+            self._states[user_id] = state
+
+    async def delete(self, user_id: int, connection: Optional[AsyncConnection] = None) -> bool:
+        return self._states.pop(user_id, None) is not None
+
+    async def create_offer(self) -> OrderOffer:
+        offer = OrderOffer()
+        self._offers[offer.id] = offer
+        return offer
+
+    async def pending_offers(self, user_id: int) -> list[OrderOffer]:
+        return [offer for offer in list(self._offers.values()) if user_id in offer._pending]
+
+
+class PostgresOrderOffer(OrderOffer):
+    """
+    `OrderOffer` persisted in `order_offers`, so that makers can claim it from any process.
+
+    Settlement is announced on the `order_offers` channel to the process waiting on the offer.
+    """
+    def __init__(self, store: 'PostgresContextStore', id: Optional[str] = None, winner: Optional[int] = None):
+        super().__init__(id, winner)
+        self._store = store
+
+    async def join(self, *user_ids: int):
+        async with async_engine.begin() as connection:
+            await connection.execute(text("UPDATE order_offers SET pending = array_cat(pending, CAST(:user_ids AS BIGINT[])) WHERE id = :id"), {"id": self.id, "user_ids": list(user_ids)})
+
+    async def claim(self, user_id: int) -> bool:
+        async with async_engine.begin() as connection:
+            self.winner = (await connection.execute(text("UPDATE order_offers SET winner = COALESCE(winner, :user_id) WHERE id = :id RETURNING winner"), {"id": self.id, "user_id": user_id})).scalar()
+            if self.winner == user_id:
+                await connection.execute(text("SELECT pg_notify('order_offers', :id)"), {"id": self.id})
+        if self.winner == user_id:
+            self._store.settle(self.id)
+        return self.winner == user_id
+
+    async def withdraw(self, user_id: int):
+        async with async_engine.begin() as connection:
+            row = (await connection.execute(text("UPDATE order_offers SET pending = array_remove(pending, :user_id) WHERE id = :id RETURNING winner, cardinality(pending)"), {"id": self.id, "user_id": user_id})).one_or_none()
+            settled = row is not None and (row[0] is not None or row[1] == 0)
+            if settled:
+                await connection.execute(text("SELECT pg_notify('order_offers', :id)"), {"id": self.id})
+        if settled:
+            self._store.settle(self.id)
+
+    async def close(self):
+        async with async_engine.begin() as connection:
+            await connection.execute(text("DELETE FROM order_offers WHERE id = :id"), {"id": self.id})
+
+
+class PostgresContextStore(ContextStore):
+    """
+    Keeps the state in `order_contexts` and guards it with advisory locks, so that it's shared by all processes of the service.
+
+    Also relays notifications between processes with LISTEN/NOTIFY.
+    """
+    def __init__(self):
+        self.bot: Optional[Bot] = None
+        # Lets waiters of the same process queue up on the process' lock instead of holding a connection each.
+        self._local = MemoryContextStore()
+        # Offers awaited in this process.
+        self._offers: WeakValueDictionary[str, OrderOffer] = WeakValueDictionary()
+        self._subscribers: dict[str, list[Callable[[str], Awaitable[None]]]] = {}
+        self._dsn = make_url(DATABASE_URL).set(drivername='postgresql').render_as_string(hide_password=False)
+        self.subscribe('order_offers', self._on_offer_settled)
+
+    @asynccontextmanager
+    async def lock(self, scope: LockScope, user_id: int) -> AsyncIterator[AsyncConnection]:
+        key = user_id * len(LockScope) + scope
+        async with self._local.lock(scope, user_id):
+            async with async_engine.connect() as connection:
+                await connection.execute(text("SELECT pg_advisory_lock(:key)"), {"key": key})
+                # Session level lock outlives the transaction, leaving the connection free for the guarded ones.
+                await connection.commit()
+                try:
+                    yield connection
+                finally:
+                    await connection.rollback()
+                    await connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": key})
+                    await connection.commit()
+
+    async def load(self, user_id: int, connection: Optional[AsyncConnection] = None) -> Optional[ContextState]:
+        async with _begin(connection) as connection:
+            row = (await connection.execute(text(
+                "SELECT c.order_id, c.offer_id, o.winner, c.notification, c.support_message "
+                "FROM order_contexts c LEFT JOIN order_offers o ON o.id = c.offer_id "
+                "WHERE c.user_id = :user_id"
+            ), {"user_id": user_id})).one_or_none()
+
+        if row is None:
+            return None
+        order_id, offer_id, winner, notification, support_message = row
+        return ContextState(
+            order_id,
+            PostgresOrderOffer(self, offer_id, winner) if offer_id else None,
+            Message.de_json(notification, self.bot) if notification else None,
+            Message.de_json(support_message, self.bot) if support_message else None
+        )
+
+    async def create(self, user_id: int, connection: Optional[AsyncConnection] = None) -> Optional[ContextState]:
+        async with _begin(connection) as transaction:
+            created = (await transaction.execute(text("INSERT INTO order_contexts (user_id) VALUES (:user_id) ON CONFLICT DO NOTHING RETURNING user_id"), {"user_id": user_id})).scalar() is not None
+        return await self.load(user_id, connection) if created else None
+
+    async def save(self, user_id: int, state: ContextState, connection: Optional[AsyncConnection] = None):
+        async with _begin(connection) as connection:
+            await connection.execute(text(
+                "UPDATE order_contexts SET order_id = :order_id, offer_id = :offer_id, "
+                "notification = CAST(:notification AS JSONB), support_message = CAST(:support_message AS JSONB), updated_at = now() "
+                "WHERE user_id = :user_id"
+            ), {
+                "user_id": user_id,
+                "order_id": state.order_id,
+                "offer_id": state.offer and state.offer.id,
+                "notification": state.notification and state.notification.to_json(),
+                "support_message": state.support_message and state.support_message.to_json()
+            })
+
+    async def delete(self, user_id: int, connection: Optional[AsyncConnection] = None) -> bool:
+        async with _begin(connection) as connection:
+            return (await connection.execute(text("DELETE FROM order_contexts WHERE user_id = :user_id RETURNING user_id"), {"user_id": user_id})).scalar() is not None
+
+    async def create_offer(self) -> OrderOffer:
+        offer = PostgresOrderOffer(self)
+        async with async_engine.begin() as connection:
+            await connection.execute(text("INSERT INTO order_offers (id) VALUES (:id)"), {"id": offer.id})
+        self._offers[offer.id] = offer
+        return offer
+
+    async def pending_offers(self, user_id: int) -> list[OrderOffer]:
+        async with async_engine.connect() as connection:
+            rows = (await connection.execute(text("SELECT id, winner FROM order_offers WHERE :user_id = ANY(pending)"), {"user_id": user_id})).all()
+        return [PostgresOrderOffer(self, id, winner) for id, winner in rows]
+
+    async def discard_offers(self):
+        async with async_engine.begin() as connection:
+            await connection.execute(text("DELETE FROM order_offers"))
+
+    def settle(self, offer_id: str):
+        if offer := self._offers.get(offer_id):
+            offer.settled.set()
+
+    def subscribe(self, channel: str, callback: Callable[[str], Awaitable[None]]):
+        self._subscribers.setdefault(channel, []).append(callback)
+
+    async def publish(self, channel: str, payload: str):
+        async with async_engine.begin() as connection:
+            await connection.execute(text("SELECT pg_notify(:channel, :payload)"), {"channel": channel, "payload": payload})
+
+    async def start(self):
+        create_task(self._listen())
+
+    async def _listen(self):
+        while True:
+            try:
+                async with await psycopg.AsyncConnection.connect(self._dsn, autocommit=True) as connection:
+                    for channel in self._subscribers:
+                        await connection.execute(f"LISTEN {channel}")
+                    # Notifications sent while not listening are lost.
+                    await self._recheck_offers()
+                    logging.info(f"{PostgresContextStore.__name__} listening to {list(self._subscribers)}.")
+
+                    async for notify in connection.notifies():
+                        for callback in self._subscribers.get(notify.channel, []):
+                            create_task(callback(notify.payload))
+            except Exception as e:
+                logging.error(f"Error listening to notifications: {e}", exc_info=True)
+                await sleep(1)
+
+    async def _recheck_offers(self):
+        if not (ids := list(self._offers.keys())):
+            return
+        async with async_engine.connect() as connection:
+            settled = (await connection.execute(text("SELECT id FROM order_offers WHERE id = ANY(:ids) AND (winner IS NOT NULL OR cardinality(pending) = 0)"), {"ids": ids})).scalars().all()
+        for offer_id in settled:
+            self.settle(offer_id)
+
+    async def _on_offer_settled(self, offer_id: str):
+        self.settle(offer_id)
+
+
+@asynccontextmanager
+async def _begin(connection: Optional[AsyncConnection]) -> AsyncIterator[AsyncConnection]:
+    """
+    Transaction on `connection`, the one holding the caller's lock, or on a pooled connection if None.
+    """
+    if connection is None:
+        async with async_engine.begin() as connection:
+            yield connection
+    else:
+        async with connection.begin():
+            yield connection
+
+
+store: ContextStore = PostgresContextStore() if CONTEXT_STORE == 'postgres' else MemoryContextStore()
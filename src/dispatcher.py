@@ -0,0 +1,272 @@
+from asyncio import Event, Future, Task, create_task, get_running_loop, sleep, wait_for
+from heapq import heappop, heappush
+from enum import IntEnum
+from itertools import count
+import logging
+from time import monotonic, perf_counter
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+from telegram import Bot, Message
+from telegram.error import BadRequest, NetworkError, RetryAfter
+from config import API_WORKERS, TELEGRAM_CHAT_BURST, TELEGRAM_CHAT_RATE, TELEGRAM_RATE, TELEGRAM_RETRIES
+import metrics
+from tracing import tracer
+
+
+class Priority(IntEnum):
+    """
+    Order in which queued requests are dispatched. Lower goes first.
+    """
+    OFFER = 0
+    ORDER = 1
+    MENU = 2
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._updated = monotonic()
+
+    def delay(self, tokens: float = 1) -> float:
+        """
+        Seconds until `tokens` are available.
+        """
+        now = monotonic()
+        self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+        return 0 if self._tokens >= tokens else (tokens - self._tokens) / self._rate
+
+    def take(self, tokens: float = 1):
+        self._tokens -= tokens
+
+    def block(self, seconds: float):
+        self._tokens = min(self._tokens, 0) - seconds * self._rate
+
+    @property
+    def full(self) -> bool:
+        return self.delay() == 0 and self._tokens >= self._burst
+
+
+class Request:
+    def __init__(self, priority: Priority, chat_id: int, method: str, call: Callable[[], Awaitable[Any]], key: Optional[Hashable], futures: list[Future]):
+        self.priority = priority
+        self.chat_id = chat_id
+        self.method = method
+        self.call = call
+        self.key = key
+        # Futures of the request and of the ones coalesced into it.
+        self.futures = futures
+        self.attempts = 0
+        self.dropped = False
+        # Whether the request is being retried, which keeps its chat blocked until it's done.
+        self.retrying = False
+        # Span of the handler that queued the request.
+        self.span = tracer.current
+
+
+class Dispatcher:
+    """
+    Outbound queue of Bot API requests.
+
+    Requests are dispatched by priority within a global and per-chat token bucket, one at a time per chat, so that
+    bursts of orders don't hit Telegram flood limits. Edits of a message still queued are coalesced into the latest one,
+    and queued edits are dropped once the message is deleted. Flood waits and network errors are retried in the background
+    up to `retries` times, holding back the later requests of the chat meanwhile.
+
+    Every method only queues the request and returns a future of its result, so callers holding locks don't wait
+    for Telegram. Failures are logged, thus the future doesn't have to be awaited.
+    """
+    def __init__(self, rate: float, chat_rate: float, chat_burst: float, retries: int):
+        self._bot: Optional[Bot] = None
+        self._global = TokenBucket(rate, rate)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._retries = retries
+        self._chats: dict[int, TokenBucket] = {}
+        self._heap: list[tuple[int, int, Request]] = []
+        # Requests waiting for their chat's bucket, by the time it's available.
+        self._delayed: list[tuple[float, int, Request]] = []
+        # Requests waiting for the request in flight in their chat.
+        self._blocked: dict[int, list[Request]] = {}
+        self._queued: dict[Hashable, Request] = {}
+        self._sequence = count()
+        self._wakeup = Event()
+        # Requests being executed, referenced so that they aren't garbage collected meanwhile.
+        self._executing: set[Task] = set()
+
+    def send_message(self, chat_id: int, text: str, priority: Priority, **kwargs) -> 'Future[Message]':
+        return self.submit(priority, chat_id, 'sendMessage', lambda: self._bot.send_message(chat_id, text, **kwargs))
+
+    def edit_text(self, message: Message, text: str, priority: Priority, **kwargs) -> Future:
+        return self.submit(priority, message.chat_id, 'editMessageText', lambda: message.edit_text(text, **kwargs), key=(Message.edit_text.__name__, message.chat_id, message.message_id))
+
+    def edit_reply_markup(self, message: Message, reply_markup: Any, priority: Priority) -> Future:
+        return self.submit(priority, message.chat_id, 'editMessageReplyMarkup', lambda: message.edit_reply_markup(reply_markup), key=(Message.edit_reply_markup.__name__, message.chat_id, message.message_id))
+
+    def delete(self, message: Message, priority: Priority) -> Future:
+        # Edits of a deleted message would fail anyway.
+        for name in (Message.edit_text.__name__, Message.edit_reply_markup.__name__):
+            if request := self._queued.pop((name, message.chat_id, message.message_id), None):
+                request.dropped = True
+                for future in request.futures:
+                    future.set_result(None)
+        return self.submit(priority, message.chat_id, 'deleteMessage', lambda: message.delete())
+
+    def submit(self, priority: Priority, chat_id: int, method: str, call: Callable[[], Awaitable[Any]], key: Optional[Hashable] = None) -> Future:
+        """
+        Queues a request.
+
+        Args:
+            priority (Priority): Priority of the request
+            chat_id (int): Chat the request is rate limited by
+            method (str): Bot API method the request calls
+            call (Callable[[], Awaitable[Any]]): Makes the request
+            key (Optional[Hashable]): Requests with the same key still queued are coalesced into this one
+
+        Returns:
+            Future: Result of the request
+        """
+        future = get_running_loop().create_future()
+        future.add_done_callback(_retrieve)
+        if key is not None and (queued := self._queued.get(key)):
+            queued.call = call
+            queued.futures.append(future)
+            # Keeps its place in the queue, unless this one is more urgent.
+            if priority >= queued.priority:
+                return future
+            queued.dropped = True
+            futures = queued.futures
+        else:
+            futures = [future]
+
+        request = Request(priority, chat_id, method, call, key, futures)
+        if key is not None:
+            self._queued[key] = request
+        self._push(request)
+        return future
+
+    @property
+    def size(self) -> int:
+        return len(self._heap) + len(self._delayed) + sum(len(blocked) for blocked in self._blocked.values())
+
+    async def run(self, bot: Bot):
+        self._bot = bot
+        while True:
+            request = await self._next()
+            self._global.take()
+            self._chat(request.chat_id).take()
+            self._blocked.setdefault(request.chat_id, [])
+            if request.key is not None:
+                self._queued.pop(request.key, None)
+            task = create_task(self._execute(request))
+            self._executing.add(task)
+            task.add_done_callback(self._executing.discard)
+
+    def _push(self, request: Request):
+        heappush(self._heap, (request.priority, next(self._sequence), request))
+        self._wakeup.set()
+
+    def _chat(self, chat_id: int) -> TokenBucket:
+        if (bucket := self._chats.get(chat_id)) is None:
+            # Full buckets are the same as new ones.
+            if len(self._chats) > 10000:
+                self._chats = {id: bucket for id, bucket in self._chats.items() if id in self._blocked or not bucket.full}
+            bucket = self._chats[chat_id] = TokenBucket(self._chat_rate, self._chat_burst)
+        return bucket
+
+    async def _next(self) -> Request:
+        while True:
+            now = monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, sequence, request = heappop(self._delayed)
+                heappush(self._heap, (request.priority, sequence, request))
+
+            while self._heap:
+                _, sequence, request = self._heap[0]
+                if request.dropped:
+                    heappop(self._heap)
+                    if request.retrying:
+                        self._unblock(request.chat_id)
+                    continue
+                if request.chat_id in self._blocked and not request.retrying:
+                    heappop(self._heap)
+                    self._blocked[request.chat_id].append(request)
+                    continue
+                if delay := self._chat(request.chat_id).delay():
+                    heappop(self._heap)
+                    heappush(self._delayed, (now + delay, sequence, request))
+                    continue
+                if delay := self._global.delay():
+                    await sleep(delay)
+                    break
+                heappop(self._heap)
+                return request
+            else:
+                self._wakeup.clear()
+                try:
+                    await wait_for(self._wakeup.wait(), max(self._delayed[0][0] - monotonic(), 0) if self._delayed else None)
+                except TimeoutError:
+                    pass
+
+    async def _execute(self, request: Request):
+        request.attempts += 1
+        retry = None
+        start = perf_counter()
+        try:
+            result = await request.call()
+            metrics.telegram_requests_total.inc(method=request.method, result='ok')
+            for future in request.futures:
+                if not future.done():
+                    future.set_result(result)
+        except RetryAfter as e:
+            # Flood limit of the chat was hit.
+            self._chat(request.chat_id).block(e.retry_after)
+            if request.attempts > self._retries:
+                self._fail(request, e)
+            else:
+                retry = e.retry_after
+        except NetworkError as e:
+            if isinstance(e, BadRequest) or request.attempts > self._retries:
+                self._fail(request, e)
+            else:
+                retry = 2 ** request.attempts
+        except Exception as e:
+            self._fail(request, e)
+        finally:
+            metrics.telegram_request_seconds.observe(perf_counter() - start, method=request.method)
+            tracer.record_telegram(request.span, perf_counter() - start)
+            if retry is None:
+                self._unblock(request.chat_id)
+
+        if retry is None:
+            return
+        # The chat stays blocked meanwhile, so that the requests queued after this one aren't sent before it.
+        metrics.telegram_requests_total.inc(method=request.method, result='retry')
+        logging.warning(f"Retrying Bot API request to chat {request.chat_id} in {retry} seconds (attempt {request.attempts}).")
+        request.retrying = True
+        await sleep(retry)
+        self._push(request)
+
+    def _unblock(self, chat_id: int):
+        for blocked in self._blocked.pop(chat_id, []):
+            self._push(blocked)
+
+    def _fail(self, request: Request, e: Exception):
+        metrics.telegram_requests_total.inc(method=request.method, result='error')
+        logging.error(f"Error dispatching Bot API request to chat {request.chat_id}: {e}", exc_info=True)
+        for future in request.futures:
+            if not future.done():
+                future.set_exception(e)
+
+
+def _retrieve(future: Future):
+    # Marks the exception retrieved, as the future might be left unawaited.
+    if not future.cancelled():
+        future.exception()
+
+
+# The global limit is shared by the processes serving the API, see API_WORKERS.
+dispatcher = Dispatcher(TELEGRAM_RATE / API_WORKERS, TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST, TELEGRAM_RETRIES)
+metrics.Gauge('telegram_queue_size', "Bot API requests queued by the dispatcher.", lambda: dispatcher.size)
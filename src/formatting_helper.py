@@ -1,5 +1,9 @@
 from decimal import Decimal, ROUND_HALF_EVEN
 
+# Quantization exponents by number of decimal places.
+_exponents: dict[int, Decimal] = {}
+
+
 class FormattingHelper:
     @staticmethod
     def quantize(value: Decimal, exp: int) -> Decimal:
@@ -19,5 +23,6 @@ class FormattingHelper:
             >>> helper.quantize(Decimal('3.14159'), -1)
             Decimal('3.0')
         """
-        exponent = Decimal(10) ** -exp
+        if (exponent := _exponents.get(exp)) is None:
+            exponent = _exponents[exp] = Decimal(10) ** -exp
         return str(value.quantize(exponent, rounding=ROUND_HALF_EVEN)).rstrip('0').rstrip('.')
@@ -0,0 +1,209 @@
+from asyncio import Future, get_running_loop, shield, sleep
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+import hashlib
+import logging
+from time import monotonic
+from typing import Any, Awaitable, Callable, Optional
+
+from fastapi import HTTPException, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from sqlalchemy import and_, delete, or_
+from sqlalchemy.dialects.postgresql import insert
+from config import IDEMPOTENCY_CACHE_SIZE, IDEMPOTENCY_LEASE, IDEMPOTENCY_TTL
+from database import AsyncSessionFactory, IdempotencyKey
+
+# Seconds between checks of a key in flight in another process.
+POLL_INTERVAL = 0.5
+# Response headers replayed along with the body.
+REPLAYED_HEADERS = ('content-type', 'location', 'retry-after')
+
+
+class StoredResponse:
+    def __init__(self, status_code: int, headers: dict[str, str], body: str):
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+
+    @classmethod
+    def of(cls, result: Any) -> 'StoredResponse':
+        response = result if isinstance(result, Response) else JSONResponse(jsonable_encoder(result))
+        return cls(response.status_code, {name: value for name, value in response.headers.items() if name in REPLAYED_HEADERS}, response.body.decode())
+
+    def replay(self, replayed: bool = True) -> Response:
+        return Response(self.body, self.status_code, {**self.headers, "Idempotent-Replayed": str(replayed).lower()})
+
+
+class Idempotency:
+    """
+    Deduplicates retries of requests made with an `Idempotency-Key` header by replaying the response of the first one.
+
+    Responses are kept in `idempotency_keys` until they expire, so that retries are deduplicated across processes and restarts,
+    and the most recent ones are cached in process. Duplicates arriving while the request is in flight wait for its response,
+    in process on the request itself and otherwise by polling the key. Keys of requests that failed with a server error
+    or were rejected with 429 are released, so that their retries run again. Keys in flight for longer than the lease are taken over, as their process must have died.
+    """
+    def __init__(self, ttl: float, lease: float, cache_size: int):
+        self._ttl = ttl
+        self._lease = lease
+        self._cache_size = cache_size
+        # Completed responses by (scope, key) along with their request's fingerprint and monotonic expiry, least recently used first.
+        self._cache: OrderedDict[tuple[str, str], tuple[str, StoredResponse, float]] = OrderedDict()
+        self._in_flight: dict[tuple[str, str], tuple[str, Future]] = {}
+
+    async def run(self, scope: str, key: Optional[str], fingerprint: str, call: Callable[[], Awaitable[Any]]) -> Response:
+        """
+        Runs the request unless a request with the same key has already been made.
+
+        Args:
+            scope (str): Endpoint, e.g. `POST /orders`
+            key (Optional[str]): Idempotency key sent by the client. The request is run as is if None
+            fingerprint (str): Hash of the request, see `fingerprint`
+            call (Callable[[], Awaitable[Any]]): Runs the request. Its result or `HTTPException` becomes the response
+
+        Returns:
+            Response: Response of the request or the replayed one
+
+        Raises:
+            HTTPException: 422 if the key was used for another request
+        """
+        if key is None:
+            return await call()
+        if len(key) > 255:
+            raise HTTPException(status_code=400, detail="Idempotency-Key can't be longer than 255 characters.")
+
+        id = (scope, key)
+        while True:
+            if cached := self._cached(id):
+                self._check(id, fingerprint, cached[0])
+                return cached[1].replay()
+            if in_flight := self._in_flight.get(id):
+                self._check(id, fingerprint, in_flight[0])
+                return (await shield(in_flight[1])).replay()
+
+            row = await self._claim(id, fingerprint)
+            if row is None:
+                break
+            self._check(id, fingerprint, row.fingerprint)
+            if row.status_code is not None:
+                response = StoredResponse(row.status_code, row.headers, row.body)
+                self._remember(id, fingerprint, response, row.expires_at)
+                return response.replay()
+            # In flight in another process.
+            await sleep(POLL_INTERVAL)
+
+        future = get_running_loop().create_future()
+        future.add_done_callback(_retrieve)
+        self._in_flight[id] = (fingerprint, future)
+        try:
+            try:
+                response = StoredResponse.of(await call())
+            except HTTPException as e:
+                response = StoredResponse.of(JSONResponse({"detail": e.detail}, e.status_code, e.headers))
+        except BaseException as e:
+            future.set_exception(e)
+            await self._release(id)
+            raise
+        finally:
+            self._in_flight.pop(id, None)
+
+        if response.status_code >= 500 or response.status_code == 429:
+            await self._release(id)
+        else:
+            await self._store(id, fingerprint, response)
+        future.set_result(response)
+        return response.replay(replayed=False)
+
+    async def run_purge(self, interval: float):
+        while True:
+            await sleep(interval)
+            try:
+                async with AsyncSessionFactory() as session:
+                    purged = (await session.execute(delete(IdempotencyKey).where(IdempotencyKey.expires_at < datetime.now(timezone.utc)))).rowcount
+                    await session.commit()
+                logging.info(f"Purged {purged} expired idempotency keys.")
+            except Exception as e:
+                logging.error(f"Error purging expired idempotency keys: {e}", exc_info=True)
+
+    def _cached(self, id: tuple[str, str]) -> Optional[tuple[str, StoredResponse, float]]:
+        if (cached := self._cache.get(id)) is None:
+            return None
+        if cached[2] <= monotonic():
+            del self._cache[id]
+            return None
+        self._cache.move_to_end(id)
+        return cached
+
+    def _remember(self, id: tuple[str, str], fingerprint: str, response: StoredResponse, expires_at: datetime):
+        self._cache[id] = (fingerprint, response, monotonic() + (expires_at - datetime.now(timezone.utc)).total_seconds())
+        self._cache.move_to_end(id)
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+    @staticmethod
+    def _check(id: tuple[str, str], fingerprint: str, used_with: str):
+        if fingerprint != used_with:
+            raise HTTPException(status_code=422, detail=f"Idempotency-Key {id[1]} was already used for another {id[0]} request.")
+
+    async def _claim(self, id: tuple[str, str], fingerprint: str) -> Optional[IdempotencyKey]:
+        """
+        Claims the key for this request.
+
+        Returns:
+            Optional[IdempotencyKey]: None if claimed, otherwise the key of the request made with it first
+        """
+        scope, key = id
+        now = datetime.now(timezone.utc)
+        while True:
+            async with AsyncSessionFactory() as session:
+                await session.execute(delete(IdempotencyKey).where(
+                    IdempotencyKey.scope == scope,
+                    IdempotencyKey.key == key,
+                    or_(IdempotencyKey.expires_at < now, and_(IdempotencyKey.status_code.is_(None), IdempotencyKey.created_at < now - timedelta(seconds=self._lease)))
+                ))
+                claimed = (await session.execute(
+                    insert(IdempotencyKey)
+                    .values(scope=scope, key=key, fingerprint=fingerprint, created_at=now, expires_at=now + timedelta(seconds=self._ttl))
+                    .on_conflict_do_nothing()
+                    .returning(IdempotencyKey.key)
+                )).scalar() is not None
+                row = None if claimed else await session.get(IdempotencyKey, id)
+                await session.commit()
+            # Unless the key was released meanwhile.
+            if claimed or row is not None:
+                return row
+
+    async def _store(self, id: tuple[str, str], fingerprint: str, response: StoredResponse):
+        expires_at = datetime.now(timezone.utc) + timedelta(seconds=self._ttl)
+        self._remember(id, fingerprint, response, expires_at)
+        try:
+            async with AsyncSessionFactory() as session:
+                if row := await session.get(IdempotencyKey, id):
+                    row.status_code = response.status_code
+                    row.headers = response.headers
+                    row.body = response.body
+                    row.expires_at = expires_at
+                    await session.commit()
+        except Exception as e:
+            logging.error(f"Error storing response of {id[0]} with Idempotency-Key {id[1]}: {e}", exc_info=True)
+
+    async def _release(self, id: tuple[str, str]):
+        try:
+            async with AsyncSessionFactory() as session:
+                await session.execute(delete(IdempotencyKey).where(IdempotencyKey.scope == id[0], IdempotencyKey.key == id[1], IdempotencyKey.status_code.is_(None)))
+                await session.commit()
+        except Exception as e:
+            logging.error(f"Error releasing {id[0]} Idempotency-Key {id[1]}: {e}", exc_info=True)
+
+
+def fingerprint(*parts: str) -> str:
+    return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+def _retrieve(future: Future):
+    # Marks the exception retrieved, as there might be no duplicates awaiting the future.
+    if not future.cancelled():
+        future.exception()
+
+
+idempotency = Idempotency(IDEMPOTENCY_TTL, IDEMPOTENCY_LEASE, IDEMPOTENCY_CACHE_SIZE)
@@ -0,0 +1,69 @@
+from bisect import bisect_left, insort
+from decimal import Decimal
+import logging
+from typing import Optional
+
+from sqlalchemy import select
+from config import TOP_LENGTH
+from database import AsyncSessionFactory, User
+import templates
+
+
+class Leaderboard:
+    """
+    TOP of makers with the lowest exchange rates displayed in the account menu.
+
+    Keeps the ranking of all users along with their pre-rendered MarkdownV2 lines,
+    so rendering the TOP doesn't query the database and costs the same regardless of the number of users.
+    """
+    def __init__(self, length: int):
+        self._length = length
+        # (exchange_rate, user_id) of all users sorted in ascending order.
+        self._ranking: list[tuple[Decimal, int]] = []
+        # Ranking key and rendered line without its position per user.
+        self._entries: dict[int, tuple[tuple[Decimal, int], str]] = {}
+        self._text: Optional[str] = None
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = '\n'.join([f"{position}\\. {self._entries[user_id][1]}" for position, (_, user_id) in enumerate(self._ranking[:self._length], 1)])
+        return self._text
+
+    def update(self, user: User):
+        """
+        Patches the ranking with `user`'s current state. The rendered TOP is only invalidated if `user` is, or was, in it.
+        """
+        key = (user.exchange_rate, user.id)
+        line = self._render(user)
+        entry = self._entries.get(user.id)
+        if entry == (key, line):
+            return
+
+        if entry:
+            index = bisect_left(self._ranking, entry[0])
+            if index < len(self._ranking) and self._ranking[index] == entry[0]:
+                del self._ranking[index]
+                if index < self._length:
+                    self._text = None
+
+        self._entries[user.id] = (key, line)
+        insort(self._ranking, key)
+        if bisect_left(self._ranking, key) < self._length:
+            self._text = None
+
+    async def load(self):
+        async with AsyncSessionFactory() as session:
+            users = (await session.scalars(select(User))).all()
+
+        self._entries = {user.id: ((user.exchange_rate, user.id), self._render(user)) for user in users}
+        self._ranking = sorted(key for key, _ in self._entries.values())
+        self._text = None
+        logging.info(f"{Leaderboard.__name__} loaded {len(users)} users.")
+
+    @staticmethod
+    def _render(user: User) -> str:
+        return templates.LEADERBOARD_ENTRY.render(name=user.formatted_name, balance=user.formatted_balance, exchange_rate=user.formatted_exchange_rate, currency=user.currency)
+
+
+leaderboard = Leaderboard(TOP_LENGTH)
@@ -0,0 +1,97 @@
+"""
+Balance changes recorded in the append-only `ledger_entries`.
+
+Every change is posted as entries along with an atomic increment of the materialized balances,
+so balances aren't read and written back and the user's row is locked only until the transaction commits.
+"""
+from collections import defaultdict
+from decimal import Decimal
+from typing import Optional
+
+from sqlalchemy import Connection, func, insert, select, text, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.orm.attributes import set_committed_value
+from database import LedgerEntry, LedgerEntryKind, User
+
+# (balance, frozen balance) change per unit of amount.
+DELTAS = {
+    LedgerEntryKind.DEPOSIT: (1, 0),
+    LedgerEntryKind.FREEZE: (-1, 1),
+    LedgerEntryKind.UNFREEZE: (1, -1),
+    LedgerEntryKind.FEE: (-1, 0),
+    LedgerEntryKind.SETTLE: (0, -1),
+    LedgerEntryKind.RECONCILE: (-1, 1),
+}
+
+
+def entry(kind: LedgerEntryKind, user_id: int, amount: Decimal, order_id: Optional[str] = None) -> dict:
+    balance, frozen = DELTAS[kind]
+    return {"user_id": user_id, "kind": kind, "order_id": order_id, "balance_delta": balance * amount, "frozen_delta": frozen * amount}
+
+async def post(session: AsyncSession, *entries: dict) -> dict[int, tuple[Decimal, Decimal]]:
+    """
+    Records `entries` in bulk and applies them to the balances within the session's transaction. Users loaded in the session are updated.
+
+    Returns:
+        dict[int, tuple[Decimal, Decimal]]: (balance, frozen balance) after the change per user
+    """
+    if not entries:
+        return {}
+
+    await session.execute(insert(LedgerEntry), list(entries))
+
+    deltas: dict[int, list[Decimal]] = defaultdict(lambda: [Decimal(0), Decimal(0)])
+    for e in entries:
+        deltas[e["user_id"]][0] += e["balance_delta"]
+        deltas[e["user_id"]][1] += e["frozen_delta"]
+
+    balances = {}
+    for user_id, (balance, frozen) in deltas.items():
+        balances[user_id] = (await session.execute(
+            update(User)
+            .where(User.id == user_id)
+            .values(balance=User.balance + balance, frozen_balance=User.frozen_balance + frozen)
+            .returning(User.balance, User.frozen_balance)
+            .execution_options(synchronize_session=False)
+        )).one()
+
+        if user := session.identity_map.get(identity_key(User, user_id)):
+            set_committed_value(user, 'balance', balances[user_id][0])
+            set_committed_value(user, 'frozen_balance', balances[user_id][1])
+    return balances
+
+def discrepancies(connection: Connection) -> list[tuple[int, Decimal, Decimal, Decimal, Decimal]]:
+    """
+    Users whose materialized balances don't match their ledger.
+
+    Returns:
+        list[tuple[int, Decimal, Decimal, Decimal, Decimal]]: (user_id, balance, frozen balance, ledger balance, ledger frozen balance)
+    """
+    ledger = (
+        select(LedgerEntry.user_id, func.sum(LedgerEntry.balance_delta).label('balance'), func.sum(LedgerEntry.frozen_delta).label('frozen_balance'))
+        .group_by(LedgerEntry.user_id)
+        .subquery()
+    )
+    ledger_balance = func.coalesce(ledger.c.balance, 0)
+    ledger_frozen_balance = func.coalesce(ledger.c.frozen_balance, 0)
+    return connection.execute(
+        select(User.id, User.balance, User.frozen_balance, ledger_balance, ledger_frozen_balance)
+        .outerjoin(ledger, ledger.c.user_id == User.id)
+        .filter((User.balance != ledger_balance) | (User.frozen_balance != ledger_frozen_balance))
+        .order_by(User.id)
+    ).all()
+
+def rebuild(connection: Connection) -> int:
+    """
+    Resets materialized balances of the users that don't match their ledger to the ledger's sums.
+
+    Returns:
+        int: Number of users rebuilt
+    """
+    # Holds off postings until the transaction ends, so that none is applied between summing and resetting.
+    connection.execute(text("LOCK TABLE ledger_entries IN SHARE MODE"))
+    rows = discrepancies(connection)
+    for user_id, _, _, balance, frozen_balance in rows:
+        connection.execute(update(User).where(User.id == user_id).values(balance=balance, frozen_balance=frozen_balance))
+    return len(rows)
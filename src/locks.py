@@ -0,0 +1,32 @@
+from asyncio import Lock
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Hashable
+from weakref import WeakValueDictionary
+
+
+class LockRegistry:
+    """
+    Registry of asyncio locks per key, so that only holders of the same key wait on each other.
+
+    Locks are referenced weakly and live only as long as someone holds or awaits them,
+    so the registry is evicted by itself and doesn't grow with the number of keys ever locked.
+    """
+    def __init__(self):
+        self._locks: WeakValueDictionary[Hashable, Lock] = WeakValueDictionary()
+
+    def get(self, key: Hashable) -> Lock:
+        """
+        Returns the lock of `key`. The caller must keep a reference to it for as long as it's used.
+        """
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = Lock()
+        return lock
+
+    @asynccontextmanager
+    async def hold(self, key: Hashable) -> AsyncIterator[None]:
+        async with self.get(key):
+            yield
+
+    def __len__(self) -> int:
+        return len(self._locks)
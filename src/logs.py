@@ -0,0 +1,167 @@
+"""
+JSON logging off the event loop.
+
+Log calls only put the record on a bounded queue. A background thread formats the queued records as JSON lines
+and writes them in batches, one write and flush per batch. Once the queue is full, records are dropped and counted,
+or log calls block until the writer catches up, see `LOG_QUEUE_POLICY`.
+
+Fields such as `order_id` and `user_id` are passed as `extra` and become fields of the JSON line.
+"""
+import atexit
+import json
+import logging
+from logging.handlers import QueueHandler
+from queue import Empty, Full, Queue
+import sys
+from threading import Thread
+import time
+from typing import Optional, TextIO
+
+import metrics
+from config import LOG_QUEUE_POLICY, LOG_QUEUE_SIZE
+
+# Records written at once.
+BATCH_SIZE = 512
+# Attributes every record has. The other ones were passed as `extra`.
+RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+# Reused rather than built by every `json.dumps` call with options.
+_encode = json.JSONEncoder(default=str).encode
+
+
+class JsonFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__()
+        # Formatted local time of the last second seen, as records mostly share it.
+        self._second: Optional[int] = None
+        self._time = ''
+
+    def formatTime(self, record: logging.LogRecord, datefmt: Optional[str] = None) -> str:
+        second = int(record.created)
+        if second != self._second:
+            self._second = second
+            self._time = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(second))
+        return f"{self._time},{int(record.msecs):03d}"
+
+    def format(self, record: logging.LogRecord) -> str:
+        log_data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "message": record.getMessage(),
+            "name": record.name,
+            "filename": record.filename,
+            "lineno": record.lineno,
+            "funcName": record.funcName,
+            "process": record.process,
+            "thread": record.thread,
+        }
+        for key, value in record.__dict__.items():
+            if key not in RECORD_ATTRIBUTES:
+                log_data[key] = value
+        if record.exc_info:
+            log_data["exc_info"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            log_data["stack_info"] = self.formatStack(record.stack_info)
+        return _encode(log_data)
+
+
+class BoundedQueueHandler(QueueHandler):
+    """
+    Puts records on the writer's queue, dropping them or blocking once it's full.
+    """
+    def __init__(self, queue: Queue, block: bool):
+        super().__init__(queue)
+        self._block = block
+        # Records dropped since the writer last reported them.
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Formatted by the writer. Only the message is resolved now, as its arguments might change meanwhile.
+        # The queue is in process, so the exception is kept as is rather than formatted here.
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        if self._block:
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+            metrics.log_records_dropped_total.inc()
+
+
+class LogWriter(Thread):
+    def __init__(self, queue: Queue, handler: BoundedQueueHandler, stream: TextIO):
+        super().__init__(name='log-writer', daemon=True)
+        self._queue = queue
+        self._handler = handler
+        self._stream = stream
+        self._formatter = JsonFormatter()
+
+    def run(self):
+        while True:
+            batch = [self._queue.get()]
+            try:
+                while len(batch) < BATCH_SIZE:
+                    batch.append(self._queue.get_nowait())
+            except Empty:
+                pass
+
+            lines = []
+            stopped = False
+            for record in batch:
+                if record is None:
+                    stopped = True
+                else:
+                    self._format(record, lines)
+            if dropped := self._handler.dropped:
+                self._handler.dropped -= dropped
+                self._format(logging.makeLogRecord({
+                    "name": __name__, "levelno": logging.WARNING, "levelname": 'WARNING',
+                    "msg": f"Dropped {dropped} log records as the queue is full.",
+                }), lines)
+            if lines:
+                try:
+                    self._stream.write('\n'.join(lines) + '\n')
+                    self._stream.flush()
+                except Exception:
+                    # Nowhere to log it to.
+                    pass
+            if stopped:
+                return
+
+    def _format(self, record: logging.LogRecord, lines: list[str]):
+        try:
+            lines.append(self._formatter.format(record))
+        except Exception:
+            self._handler.handleError(record)
+
+    def stop(self):
+        """
+        Writes the records queued so far and stops.
+        """
+        self._queue.put(None)
+        self.join()
+
+
+def setup(level: int = logging.INFO, stream: TextIO = sys.stderr) -> LogWriter:
+    """
+    Replaces the handlers of the root logger with the queue and starts the writer, which is stopped at exit.
+    """
+    queue = Queue(LOG_QUEUE_SIZE)
+    handler = BoundedQueueHandler(queue, block=LOG_QUEUE_POLICY == 'block')
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+        existing.close()
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    writer = LogWriter(queue, handler, stream)
+    writer.start()
+    atexit.register(writer.stop)
+    metrics.Gauge('log_queue_size', "Log records waiting to be written.", queue.qsize)
+    return writer
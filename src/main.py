@@ -1,50 +1,56 @@
-from asyncio import run, wait_for
+from asyncio import as_completed, create_task, gather, run, to_thread, wait_for
+from hmac import compare_digest
 import logging
 import json
+from multiprocessing import get_context
+import os
+import socket
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ConversationHandler
-from telegram.helpers import escape_markdown as md
-from fastapi import FastAPI, HTTPException, Header, Depends, Response
+from fastapi import FastAPI, HTTPException, Header, Depends, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse
 from uvicorn import Config, Server
-from config import SUPPORT_ID, TOKEN, API_KEY, ACCEPT_ORDER_TIMEOUT, TOP_LENGTH, ORDER_FEE
+from config import SUPPORT_ID, TOKEN, API_KEY, ACCEPT_ORDER_TIMEOUT, ORDER_EXPIRY_GRACE, ORDER_BROADCAST_SIZE, ORDER_BATCH_LIMIT, ORDER_MIN_FILL, ORDER_MAX_FILLS, ORDER_POLL_TIMEOUT, ORDER_EVENTS_KEEPALIVE, IDEMPOTENCY_TTL, ORDER_ARCHIVE_INTERVAL, RECONCILE_INTERVAL, RECOVERY_BATCH_SIZE, ORDER_BOOK_SYNC_INTERVAL, ORDER_FEE, API_HOST, API_PORT, API_WORKERS, BOT_MODE, BOT_CONCURRENT_UPDATES, TELEGRAM_API_URL, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET
 from datetime import datetime, timezone
 from enum import Enum
-from typing import List
+from typing import Iterator, List, Optional
 from zoneinfo import ZoneInfo
-from sqlalchemy import or_
-from decimal import Decimal, ROUND_HALF_EVEN
+from sqlalchemy import delete, select
+from decimal import Decimal, ROUND_DOWN, ROUND_HALF_EVEN
 from typing import List
 from creditcard import CreditCard
-from database import Currency, OrderStatus, SessionFactory, User, Order
-from pydantic import BaseModel, field_validator
+from more_itertools import chunked
+from database import AsyncSessionFactory, Currency, Deadline, DeadlineKind, LedgerEntryKind, OrderStatus, ParentOrder, PlacementStatus, User, Order, async_engine, engine
+import ledger
+import templates
+import logs
+import metrics
+from profiler import MIN_INTERVAL, profiler
+from admission import Ticket, admission
+from archive import archiver
+from reconciliation import reconciler
+import reports
+import migrations
+from pydantic import BaseModel, Field, HttpUrl, field_validator
 from formatting_helper import FormattingHelper
-from order_manager import OrderContextManager
-
-
-class JsonFormatter(logging.Formatter):
-    def format(self, record):
-        log_data = {
-            "time": self.formatTime(record, self.datefmt),
-            "level": record.levelname,
-            "message": record.getMessage(),
-            "name": record.name,
-            "filename": record.filename,
-            "lineno": record.lineno,
-            "funcName": record.funcName,
-            "process": record.process,
-            "thread": record.thread,
-        }
-        if record.exc_info:
-            log_data["exc_info"] = self.formatException(record.exc_info)
-        return json.dumps(log_data)
-
-
-logging.basicConfig(level=logging.INFO, format='%(message)s')
-formatter = JsonFormatter()
-for handler in logging.root.handlers:
-   handler.setFormatter(formatter)
+from leaderboard import leaderboard
+from idempotency import fingerprint, idempotency
+from order_book import order_book
+from placements import placements
+from recovery import recover
+from context_store import OrderOffer, PostgresContextStore, store
+from dispatcher import Priority, dispatcher
+from order_manager import OrderContext, OrderContextManager
+from scheduler import scheduler
+from tracing import tracer
+
+
+logs.setup()
 
 CHANGE_EXCHANGE_RATE, CHANGE_CARD_DETAILS, CHANGE_CURRENCY, ORDER = range(4)
+# USDT quantities of orders are quantized to it.
+MIN_QUANTITY = Decimal('0.01')
 
 class HandlerNames(str, Enum):
     CHANGE_EXCHANGE_RATE = "change_exchange_rate"
@@ -61,22 +67,83 @@ class HandlerNames(str, Enum):
     START_WORK = "start_work"
     STOP_WORK = "stop_work"
 
-application = ApplicationBuilder().token(TOKEN).build()
+application = ApplicationBuilder().token(TOKEN).base_url(f"{TELEGRAM_API_URL}/bot").concurrent_updates(BOT_CONCURRENT_UPDATES).build()
 app = FastAPI()
 
 async def validate_api_key(x_api_key: str = Header(...)):
     if x_api_key != API_KEY:
         raise HTTPException(status_code=403, detail="Invalid API Key")
 
+async def validate_webhook_secret(x_telegram_bot_api_secret_token: str = Header('')):
+    if not compare_digest(x_telegram_bot_api_secret_token, WEBHOOK_SECRET or ''):
+        raise HTTPException(status_code=403, detail="Invalid secret token")
+
+async def telegram_webhook(request: Request):
+    try:
+        update = Update.de_json(await request.json(), application.bot)
+    except Exception as e:
+        logging.error(f"Error parsing update received by webhook: {e}", exc_info=True)
+        raise HTTPException(status_code=400, detail="Invalid update.")
+
+    # Processed by the application. Telegram only waits for the update to be received.
+    await application.update_queue.put(update)
+    return Response(status_code=200)
+
+if tracer.enabled:
+    @app.middleware("http")
+    async def trace_request(request: Request, call_next):
+        with tracer.span(f"{request.method} {request.url.path}") as span:
+            response = await call_next(request)
+            if span:
+                # Named after the route rather than the path, so that spans of the same route are grouped.
+                if route := request.scope.get('route'):
+                    span.name = f"{request.method} {route.path}"
+                span.attributes["http.status_code"] = response.status_code
+            return response
+
+class ProfilerRequest(BaseModel):
+    enabled: bool
+    # Seconds between samples.
+    interval: float = Field(0.005, ge=MIN_INTERVAL)
+
+@app.post("/admin/profiler", dependencies=[Depends(validate_api_key)])
+async def switch_profiler(request: ProfilerRequest):
+    """
+    Starts sampling the event loop's thread, discarding the previous samples, or stops sampling. Samples are kept until the next start.
+    """
+    # Stopped off the loop, as the sampling thread is joined. Started on it, so that it samples the loop's thread.
+    await to_thread(profiler.stop)
+    if request.enabled:
+        profiler.start(request.interval)
+    return {"running": profiler.running, "interval": profiler.interval}
+
+@app.get("/admin/profiler", dependencies=[Depends(validate_api_key)])
+async def get_profile():
+    """
+    Samples taken so far as folded stacks, e.g. for `flamegraph.pl`.
+    """
+    return Response(profiler.folded(), media_type="text/plain")
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
+if BOT_MODE == 'webhook':
+    app.add_api_route(WEBHOOK_PATH, telegram_webhook, methods=["POST"], dependencies=[Depends(validate_webhook_secret)], include_in_schema=False)
+
 class CreateOrderRequest(BaseModel):
     quantity: Decimal
     currency: str
+    # Placement of an order placed asynchronously is POSTed to it on every status change.
+    callback_url: Optional[HttpUrl] = None
+    # Lets the order be split across makers when placed synchronously.
+    partial_fills: bool = False
 
     @field_validator('quantity')
     def validate_amount(cls, quantity):
         if quantity <= Decimal(0):
             raise ValueError("Amount must be positive.")
-        return quantity.quantize(Decimal('0.01'), rounding=ROUND_HALF_EVEN)
+        return quantity.quantize(MIN_QUANTITY, rounding=ROUND_HALF_EVEN)
 
     @field_validator('currency')
     def validate_currency(cls, currency):
@@ -84,151 +151,550 @@ class CreateOrderRequest(BaseModel):
             raise ValueError(f"Invalid currency: {currency}. Must be one of {list(Currency.__members__.keys())}.")
         return currency
 
-@app.post("/orders", dependencies=[Depends(validate_api_key)])
-async def order(order_request: CreateOrderRequest):
-    logging.info(f"Received order request for {order_request.quantity} USDT for {order_request.currency}.")
-
-    with SessionFactory() as session:
-        users = session.query(User).filter(
-            User.is_working, 
-            or_(~User.orders.any(), ~User.orders.any(Order.status != OrderStatus.COMPLETED)),
-            User.currency == order_request.currency,
-            User.balance >= order_request.quantity
-        ).order_by(User.exchange_rate).all()
-        
-    logging.debug(f"Found {len(users)} users eligible for accepting the order for buying {order_request.quantity} USDT for {order_request.currency}.")
+async def offer_order(user: User, order_request: CreateOrderRequest, offer: OrderOffer, parent_id: Optional[str] = None) -> Optional[OrderContext]:
+    # Acquiring exclusive lock under which all context store IO must be done.
+    async with await OrderContextManager.get(user.id) as ocm:
+        # The maker might be offered another order by another process, which `offering` and the book don't know of.
+        if ocm.context:
+            if not await ocm.context.dangling():
+                logging.info("User eligible for accepting the order already has an active order.", extra={"order_id": ocm.context._order_id, "user_id": user.id})
+                return None
+            logging.warning("User has a context left behind by a finished order.", extra={"order_id": ocm.context._order_id, "user_id": user.id})
+            await ocm.remove_context()
+            
+        logging.info("Creating order for user.", extra={"user_id": user.id})
 
-    for user in users:
-        user_id = user.id
-        # Acquiring exclusive lock under which all `user_data` IO must be done.
-        async with await OrderContextManager.get(user.id, application.user_data) as ocm:
-            # Exceptional.
-            if ocm.context:
-                if user.frozen_balance == 0:    # Safe to remove dangling OrderContext.
-                    logging.warning(f"User {user.name} ({user.id}) has no frozen balance but has an active order.")
-                    ocm.remove_context()
-                else:
-                    # Ensure support can handle that.
-                    async with ocm.context as oc:
-                        logging.error(f"User {user.name} ({user.id}) eligible for accepting the order already has an active order {oc.order.id} and frozen balance {user.frozen_balance}.")
-                        continue
-                
-            logging.info(f"Creating order for user {user.name} ({user.id})")
-
-            async with ocm.create_context() as oc:
-                try:
-                    order = Order(quantity=order_request.quantity, price=user.exchange_rate)
-                    oc.session.add(user)
-                    user.orders.append(order)
-                    oc.notification = await application.bot.send_message(user.id,
-                                                        f"Запрос на покупку *{md(FormattingHelper.quantize(order_request.quantity, 8), version=2)}* USDT\nБаланс: *{md(user.formatted_balance, version=2)}* USDT\nПрибыль: *{md(FormattingHelper.quantize(order_request.quantity * user.exchange_rate, 2), version=2)}* {user.currency}",
-                                                        reply_markup=InlineKeyboardMarkup([
-                                                            [InlineKeyboardButton("Принять", callback_data=HandlerNames.ACCEPT_ORDER), InlineKeyboardButton("Отклонить", callback_data=HandlerNames.DECLINE_ORDER)]
-                                                            ]),
-                                                            parse_mode="MarkdownV2")
-                    oc.session.commit()
-                    # Enables Order tracking for `OrderContext`
-                    oc._order_id = order.id
-                    
-                except Exception as e:
-                    logging.error(f"Error during order creation for user {user.name} ({user.id}): {e}", exc_info=True)
-                    ocm.remove_context()
-                    continue
+        # The store's claim is what guarantees a single order per maker across processes.
+        if (oc := await ocm.create_context()) is None:
+            logging.info("User eligible for accepting the order was claimed by another order.", extra={"user_id": user.id})
+            return None
+        async with oc:
+            try:
+                order = Order(quantity=order_request.quantity, price=user.exchange_rate, user_id=user.id, parent_id=parent_id)
+                oc.session.add(order)
+                await oc.session.commit()
+                order_book.set_busy(user.id, True)
+                # Enables Order tracking for `OrderContext`
+                oc._order_id = order.id
+                # Set before the offer is sent, so that the buttons find it as soon as they can be pressed.
+                oc.offer = offer
+            
+            except Exception as e:
+                logging.error(f"Error during order creation: {e}", exc_info=True, extra={"user_id": user.id})
+                await ocm.remove_context()
+                return None
 
+    # Sent without holding the locks, so that nothing else of the maker waits on Telegram meanwhile.
+    try:
+        with metrics.order_phase_seconds.time(phase='notify'):
+            notification = await dispatcher.send_message(user.id,
+                                                         templates.OFFER.render(quantity=FormattingHelper.quantize(order_request.quantity, 8), balance=user.formatted_balance, profit=FormattingHelper.quantize(order_request.quantity * user.exchange_rate, 2), currency=user.currency),
+                                                         Priority.OFFER,
+                                                         reply_markup=InlineKeyboardMarkup([
+                                                             [InlineKeyboardButton("Принять", callback_data=HandlerNames.ACCEPT_ORDER), InlineKeyboardButton("Отклонить", callback_data=HandlerNames.DECLINE_ORDER)]
+                                                             ]),
+                                                         parse_mode="MarkdownV2")
+    except Exception as e:
+        logging.error(f"Error offering order: {e}", exc_info=True, extra={"order_id": oc._order_id, "user_id": user.id})
+        try:
+            async with oc:
+                await oc.session.delete(oc.order)
+                await oc.session.commit()
+            order_book.set_busy(user.id, False)
+            async with await OrderContextManager.get(user.id) as ocm:
+                await ocm.remove_context()
+        except Exception as e:
+            logging.error(f"Error discarding order that wasn't offered: {e}", exc_info=True, extra={"order_id": oc._order_id, "user_id": user.id})
+        return None
+
+    async with oc:
+        oc.notification = notification
+        # Accepted or declined before the message was known, so its buttons are taken care of here.
+        if oc.order.status == OrderStatus.ACCEPTED:
+            dispatcher.edit_reply_markup(notification, None, Priority.ORDER)
+        elif oc.order.status == OrderStatus.DECLINED:
+            dispatcher.delete(notification, Priority.ORDER)
+    return oc
+
+async def resolve_offer(oc: OrderContext) -> Optional[dict]:
+    user_id = oc._user_id
+    result = None
+    async with oc:
+        match oc.order.status:
+            case OrderStatus.ACCEPTED:
+                metrics.order_outcomes_total.inc(outcome='accepted')
+                order_book.update(oc.order.user)
+                leaderboard.update(oc.order.user)
+
+                await oc.schedule_client_completion_timeout()
+
+                result = {
+                    "account": {
+                        "id": oc.order.user.id,
+                        "card": oc.order.user.card
+                    },
+                    "order": {
+                        "id": oc.order.id,
+                        "price": oc.order.price,
+                        "quantity": oc.order.quantity
+                    }
+                }
+            
+            case OrderStatus.DECLINED:
+                metrics.order_outcomes_total.inc(outcome='declined')
+                await oc.session.delete(oc.order)
+                await oc.session.commit()
+                order_book.set_busy(user_id, False)
+
+            # Another maker accepted the order first.
+            case OrderStatus.PENDING if oc.offer.winner not in (None, user_id):
+                metrics.order_outcomes_total.inc(outcome='superseded')
+                await oc.session.delete(oc.order)
+                await oc.session.commit()
+                order_book.set_busy(user_id, False)
+
+                dispatcher.delete(oc.notification, Priority.ORDER)
+
+            case OrderStatus.PENDING:
+                metrics.order_outcomes_total.inc(outcome='expired')
+                metrics.order_fees_total.inc()
+                await ledger.post(oc.session, ledger.entry(LedgerEntryKind.FEE, oc.order.user_id, ORDER_FEE, oc.order.id))
+                await oc.session.delete(oc.order)
+                await oc.session.commit()
+                order_book.update(oc.order.user, busy=False)
+                leaderboard.update(oc.order.user)
+
+                dispatcher.edit_text(oc.notification, templates.OFFER_EXPIRED.render(order_id=oc.order.id, fee=FormattingHelper.quantize(ORDER_FEE, 8)), Priority.ORDER, reply_markup=None, parse_mode="MarkdownV2")
+
+            case _:
+                logging.error(f"Order ({oc.order.id}) didn't match any valid {OrderStatus.__name__}.")
+
+    if result is None:
+        # Acquiring exclusive lock under which all context store IO must be done.
+        async with await OrderContextManager.get(user_id) as ocm:
+            await ocm.remove_context()
+    
+    return result
 
-        # Accept/Decline
+@app.post("/orders", dependencies=[Depends(validate_api_key)])
+async def order(order_request: CreateOrderRequest, prefer: str = Header(''), idempotency_key: Optional[str] = Header(None), x_api_key: str = Header(...)):
+    """
+    Places the order and responds once a maker accepts it.
+
+    With `partial_fills` the order may be split across makers: responds with every part accepted once the order is filled
+    or no maker is left to offer the rest to.
+
+    Placed asynchronously with `Prefer: respond-async` or a `callback_url`: responds with 202 and the placement right away,
+    which is followed by GET /orders/{id}, GET /orders/{id}/events or the callback.
+
+    Retries sent with the same `Idempotency-Key` get the response of the first request instead of placing the order again.
+
+    Responds with 429 and `Retry-After` if the API key exceeded its rate or too many orders of the currency are being placed, see `admission`.
+    """
+    admission.limit_rate(x_api_key)
+    async_mode = 'respond-async' in prefer or order_request.callback_url is not None
+    return await idempotency.run("POST /orders", idempotency_key, fingerprint(order_request.model_dump_json(), str(async_mode)), lambda: create_order(order_request, async_mode))
+
+async def create_order(order_request: CreateOrderRequest, async_mode: bool):
+    if not async_mode:
+        with metrics.order_request_seconds.time():
+            async with admission.reserve(order_request.currency):
+                return await place_order(order_request)
+    if order_request.partial_fills:
+        raise HTTPException(status_code=422, detail="Orders with partial fills can't be placed asynchronously.")
+
+    # Rejected before the placement is created. Otherwise the placement waits for its slot in the background.
+    ticket = admission.reserve(order_request.currency)
+    try:
+        placement = await placements.create(order_request.quantity, order_request.currency, order_request.callback_url and str(order_request.callback_url))
+    except BaseException:
+        ticket.cancel()
+        raise
+    task = create_task(run_placement(placement["id"], order_request, ticket))
+    placement_tasks.add(task)
+    task.add_done_callback(placement_tasks.discard)
+    # A task cancelled before it entered the ticket would hold on to it otherwise.
+    task.add_done_callback(lambda _: ticket.cancel())
+    return JSONResponse(jsonable_encoder(placement), status_code=202, headers={"Location": f"/orders/{placement['id']}"})
+
+# Placements being matched in this process.
+placement_tasks = set()
+
+async def run_placement(id: str, order_request: CreateOrderRequest, ticket: Ticket):
+    try:
+        async with ticket:
+            result = await place_order(order_request)
+        await placements.transition(PlacementStatus.ACCEPTED, id, order_id=result["order"]["id"], price=result["order"]["price"], account_id=result["account"]["id"], card=result["account"]["card"])
+    except HTTPException as e:
+        await placements.transition(PlacementStatus.FAILED, id, detail=e.detail)
+    except Exception as e:
+        logging.error(f"Error placing order of placement {id}: {e}", exc_info=True)
+        await placements.transition(PlacementStatus.FAILED, id, detail="Error placing order.")
+
+# Declared before GET /orders/{id}, which would match them otherwise.
+@app.get("/orders/export", dependencies=[Depends(validate_api_key)])
+async def export_orders(format: reports.ExportFormat = reports.ExportFormat.NDJSON, user_id: Optional[int] = None, status: Optional[OrderStatus] = None, currency: Optional[Currency] = None, since: Optional[datetime] = None, until: Optional[datetime] = None):
+    """
+    Orders, archived ones included, created in [`since`, `until`) streamed as CSV or NDJSON in the order they were created.
+    """
+    return StreamingResponse(reports.stream(reports.orders(user_id, status, currency, since, until), format), media_type=format.media_type)
+
+@app.get("/orders/export/makers", dependencies=[Depends(validate_api_key)])
+async def export_makers(format: reports.ExportFormat = reports.ExportFormat.NDJSON, user_id: Optional[int] = None, currency: Optional[Currency] = None, since: Optional[datetime] = None, until: Optional[datetime] = None):
+    """
+    Per-maker volume, fill rate and average accept latency of the orders in [`since`, `until`) streamed as CSV or NDJSON, see `reports`.
+    """
+    return StreamingResponse(reports.stream(reports.makers(user_id, currency, since, until), format), media_type=format.media_type)
+
+@app.get("/orders/{id}", dependencies=[Depends(validate_api_key)])
+async def get_placement(id: str, status: Optional[PlacementStatus] = None, wait: float = 0):
+    """
+    Placement of an order placed asynchronously.
+
+    Long polls with `wait` seconds: responds once the placement's status differs from `status`.
+    """
+    if (placement := await placements.wait(id, status, min(max(wait, 0), ORDER_POLL_TIMEOUT))) is None:
+        raise HTTPException(status_code=404, detail=f"Placement {id} not found.")
+    return placement
+
+@app.get("/orders/{id}/events", dependencies=[Depends(validate_api_key)])
+async def placement_events(id: str):
+    """
+    SSE stream of the placement's status changes. It ends once the status is final.
+    """
+    if await placements.get(id) is None:
+        raise HTTPException(status_code=404, detail=f"Placement {id} not found.")
+
+    async def stream():
+        status = None
+        async for placement in placements.watch(id, ORDER_EVENTS_KEEPALIVE):
+            if placement is None:
+                return
+            if placement["status"] == status:
+                yield ": keepalive\n\n"
+                continue
+            status = placement["status"]
+            yield f"event: {status}\ndata: {json.dumps(jsonable_encoder(placement))}\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.post("/orders/batch", dependencies=[Depends(validate_api_key)])
+async def orders_batch(order_requests: List[CreateOrderRequest], x_api_key: str = Header(...)):
+    """
+    Places all orders at the same time. Like any orders placed at the same time, each is offered to makers not offered another one.
+
+    Results are streamed as NDJSON lines `{"index", "status", "result" | "detail"}` in the order they resolve.
+    Orders of the batch are admitted one by one, those that don't fit in the queue of their currency resolve with 429.
+    """
+    if len(order_requests) > ORDER_BATCH_LIMIT:
+        raise HTTPException(status_code=422, detail=f"Batch can't have more than {ORDER_BATCH_LIMIT} orders.")
+    admission.limit_rate(x_api_key, len(order_requests))
+    logging.info(f"Received batch of {len(order_requests)} order requests.")
+
+    async def place(index: int, order_request: CreateOrderRequest) -> dict:
         try:
-            await wait_for(oc.handle_event.wait(), timeout=ACCEPT_ORDER_TIMEOUT)
-        except TimeoutError:
-            pass
+            async with admission.reserve(order_request.currency):
+                return {"index": index, "status": 200, "result": await place_order(order_request)}
+        except HTTPException as e:
+            return {"index": index, "status": e.status_code, "detail": e.detail}
         except Exception as e:
-            logging.error("Error during order handling: {e}", exc_info=True)
+            logging.error(f"Error placing order {index} of batch: {e}", exc_info=True)
+            return {"index": index, "status": 500, "detail": "Error placing order."}
+
+    async def stream():
+        for result in as_completed([create_task(place(index, order_request)) for index, order_request in enumerate(order_requests)]):
+            yield json.dumps(jsonable_encoder(await result)) + "\n"
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+# Makers being offered an order by this process, which aren't offered another one meanwhile.
+# Other processes are held off by the context `offer_order` claims in the store.
+offering: set[int] = set()
+
+async def place_order(order_request: CreateOrderRequest) -> dict:
+    """
+    Offers the order to eligible makers wave by wave until one accepts it.
+
+    Args:
+        order_request (CreateOrderRequest): Order to place. Split across makers with `partial_fills`, see `place_partial_order`
+
+    Returns:
+        dict: Account of the maker that accepted the order and the order
+
+    Raises:
+        HTTPException: 404 if no maker accepted the order
+    """
+    logging.info("Received order request.", extra={"quantity": order_request.quantity, "currency": order_request.currency})
+    if order_request.partial_fills:
+        return await place_partial_order(order_request)
+
+    # Makers are looked up lazily wave by wave as they might have changed their state since the order was received.
+    users = (user for user in order_book.candidates(order_request.currency, order_request.quantity) if user.id not in offering)
+    offered = 0
+
+    # Offering the order to `ORDER_BROADCAST_SIZE` makers at the same time. The first one to accept wins it.
+    waves = chunked(users, ORDER_BROADCAST_SIZE)
+    while True:
+        with metrics.order_phase_seconds.time(phase='eligibility'):
+            makers = next(waves, None)
+        if makers is None:
+            break
+        logging.debug("Found users eligible for accepting the order.", extra={"makers": len(makers), "quantity": order_request.quantity, "currency": order_request.currency})
+        offered += len(makers)
+        try:
+            offering.update(user.id for user in makers)
+            if result := await offer_wave(order_request, makers):
+                metrics.order_offers_per_fill.observe(offered)
+                return result
+        finally:
+            offering.difference_update(user.id for user in makers)
+
+    message = f"Order can't be completed. {("None of the users accepted it.") if offered > 0 else ('No users eligible for accepting the order were found.')}"
+    logging.info(message)
+    metrics.orders_unfilled_total.inc()
+    raise HTTPException(status_code=404, detail=message)
 
+async def place_partial_order(order_request: CreateOrderRequest) -> dict:
+    """
+    Splits the order across makers wave by wave until it's filled. Every maker of a wave is offered a part it can cover at the same time,
+    the rest left by the makers that didn't accept their part is split across the next wave.
+
+    Returns:
+        dict: Parent order with the quantity filled and the account and child order of every part accepted
+
+    Raises:
+        HTTPException: 404 if no maker accepted any part
+    """
+    async with AsyncSessionFactory() as session:
+        parent = ParentOrder(quantity=order_request.quantity, currency=order_request.currency)
+        session.add(parent)
+        await session.commit()
+
+    users = (user for user in order_book.candidates(order_request.currency, MIN_QUANTITY) if user.id not in offering)
+    remaining = order_request.quantity
+    fills = []
+    offered = 0
+    while remaining > 0 and len(fills) < ORDER_MAX_FILLS:
+        with metrics.order_phase_seconds.time(phase='eligibility'):
+            parts = split(users, remaining, ORDER_MAX_FILLS - len(fills))
+        if not parts:
+            break
+        logging.debug("Split order across makers.", extra={"order_id": parent.id, "makers": len(parts), "quantity": remaining})
+        offered += len(parts)
+        try:
+            offering.update(user.id for user, _ in parts)
+            results = await gather(*(offer_wave(order_request.model_copy(update={"quantity": quantity}), [user], parent.id) for user, quantity in parts))
+        finally:
+            offering.difference_update(user.id for user, _ in parts)
+        for result in results:
+            if result:
+                fills.append(result)
+                remaining -= result["order"]["quantity"]
+
+    if not fills:
+        message = f"Order can't be completed. {("None of the users accepted any part of it.") if offered > 0 else ('No users eligible for accepting the order were found.')}"
+        logging.info(message, extra={"order_id": parent.id})
+        # Its offered parts are gone by now, and the parent isn't reported anywhere else.
+        try:
+            async with AsyncSessionFactory() as session:
+                await session.execute(delete(ParentOrder).where(ParentOrder.id == parent.id))
+                await session.commit()
+        except Exception as e:
+            logging.error(f"Error deleting parent order that wasn't filled: {e}", exc_info=True, extra={"order_id": parent.id})
+        metrics.orders_unfilled_total.inc()
+        raise HTTPException(status_code=404, detail=message)
+
+    filled = order_request.quantity - remaining
+    async with AsyncSessionFactory() as session:
+        session.add(parent)
+        parent.filled = filled
+        await session.commit()
+    metrics.order_offers_per_fill.observe(offered)
+    metrics.order_fills.observe(len(fills))
+    return {
+        "order": {"id": parent.id, "quantity": order_request.quantity, "filled": filled},
+        "fills": fills,
+    }
+
+def split(users: Iterator[User], quantity: Decimal, limit: int) -> List[tuple[User, Decimal]]:
+    """
+    Splits `quantity` into parts of at least `ORDER_MIN_FILL` across at most `limit` makers taken from `users`, each part no larger than the maker's balance.
+
+    Returns:
+        List[tuple[User, Decimal]]: Makers with their parts. The parts sum up to less than `quantity` if makers ran out
+    """
+    parts = []
+    left = quantity
+    for user in users:
+        part = min(left, user.balance).quantize(MIN_QUANTITY, rounding=ROUND_DOWN)
+        # Makers that can't cover a part are skipped, unless it's the last one.
+        if part < min(ORDER_MIN_FILL, left):
+            continue
+        parts.append((user, part))
+        left -= part
+        if left <= 0 or len(parts) == limit:
+            break
+    return parts
+
+async def offer_wave(order_request: CreateOrderRequest, makers: List[User], parent_id: Optional[str] = None) -> Optional[dict]:
+    """
+    Offers the order to `makers` at the same time and resolves the offer once it's won or every maker has withdrawn.
+
+    Returns:
+        Optional[dict]: Account of the maker that won the offer and the order, None if nobody did
+    """
+    offer = await store.create_offer()
+    # Every maker joins before any is sent the offer, so that an early decline doesn't settle it while the rest are still being sent it.
+    await offer.join(*(user.id for user in makers))
+    offered = await gather(*(offer_order(user, order_request, offer, parent_id) for user in makers))
+    contexts = [oc for oc in offered if oc]
+    if not contexts:
+        await offer.close()
+        return None
+    # Makers that weren't offered the order can't withdraw on their own.
+    for user, oc in zip(makers, offered):
+        if not oc:
+            await offer.withdraw(user.id)
+
+    # Accept/Decline. Makers that don't respond in time are withdrawn from the offer by `scheduler`.
+    targets = [(oc._order_id, oc._user_id) for oc in contexts]
+    # Backstop for deadlines that keep failing, so that the order is answered anyway.
+    timeout = ACCEPT_ORDER_TIMEOUT + ORDER_EXPIRY_GRACE
+    try:
+        await scheduler.schedule(DeadlineKind.ORDER_EXPIRY, ACCEPT_ORDER_TIMEOUT, *targets)
+    except Exception as e:
+        logging.error(f"Error scheduling order expiry deadlines: {e}", exc_info=True)
+        # Expiring the offer in process.
+        timeout = ACCEPT_ORDER_TIMEOUT
+    try:
+        with metrics.order_phase_seconds.time(phase='wait'):
+            await wait_for(offer.settled.wait(), timeout=timeout)
+    except TimeoutError:
+        pass
+    except Exception as e:
+        logging.error(f"Error during order handling: {e}", exc_info=True)
 
-        async with oc:
-            match oc.order.status:
-                case OrderStatus.ACCEPTED:
-                    oc.order.user.balance -= oc.order.quantity
-                    oc.order.user.frozen_balance += oc.order.quantity
-                    oc.session.commit()
-
-                    await oc.start_client_completion_waiter()
-
-                    return {
-                        "account": {
-                            "id": oc.order.user.id,
-                            "card": oc.order.user.card
-                        },
-                        "order": {
-                            "id": oc.order.id,
-                            "price": oc.order.price,
-                            "quantity": oc.order.quantity
-                        }
-                    }
-                
-                case OrderStatus.DECLINED:
-                    oc.session.delete(oc.order)
-                    oc.session.commit()
+    with metrics.order_phase_seconds.time(phase='commit'):
+        results = [result for result in await gather(*(resolve_offer(oc) for oc in contexts)) if result]
+    try:
+        await scheduler.cancel(DeadlineKind.ORDER_EXPIRY, *[order_id for order_id, _ in targets])
+        await offer.close()
+    except Exception as e:
+        logging.error(f"Error cleaning up order offer: {e}", exc_info=True)
+    return results[0] if results else None
 
-                case OrderStatus.PENDING:
-                    oc.order.user.balance -= ORDER_FEE
-                    oc.session.delete(oc.order)
-                    oc.session.commit()
+async def expire_orders(deadlines: List[Deadline]):
+    metrics.order_timeouts_total.inc(len(deadlines), kind=DeadlineKind.ORDER_EXPIRY.value)
+    # Raised once all are done, so that `scheduler` fires the deadlines again.
+    for result in await gather(*(expire_order(deadline) for deadline in deadlines), return_exceptions=True):
+        if isinstance(result, Exception):
+            raise result
 
-                    await oc.notification.edit_text(f"Время ответа на ордер `{md(oc.order.id, version=2)}` истекло\nСервисная плата в размере *{md(FormattingHelper.quantize(ORDER_FEE, 8), version=2)}* USDT была изъята", reply_markup=None, parse_mode="MarkdownV2")
+async def expire_order(deadline: Deadline):
+    try:
+        oc = (await OrderContextManager.get(deadline.user_id)).context
+        if oc and oc._order_id == deadline.key and oc.offer:
+            await oc.offer.withdraw(deadline.user_id)
+            return
 
-                case _:
-                    logging.error(f"Order ({oc.order.id}) didn't match any valid {OrderStatus.__name__}.")
-        
+        # The offer didn't survive a restart, so the order is expired on its own.
+        async with AsyncSessionFactory() as session:
+            if (order := await session.get(Order, deadline.key)) and order.status == OrderStatus.PENDING:
+                await ledger.post(session, ledger.entry(LedgerEntryKind.FEE, order.user_id, ORDER_FEE, order.id))
+                metrics.order_outcomes_total.inc(outcome='expired')
+                metrics.order_fees_total.inc()
+                await session.delete(order)
+                await session.commit()
+                order_book.update(order.user, busy=False)
+                leaderboard.update(order.user)
+                logging.info("Order expired without its offer.", extra={"order_id": order.id, "user_id": deadline.user_id})
+
+                # An offer still waiting on the maker would never settle otherwise. A maker with a context of another order is pending in that one's offer.
+                if oc is None or oc._order_id == deadline.key:
+                    for offer in await store.pending_offers(deadline.user_id):
+                        await offer.withdraw(deadline.user_id)
+    except Exception as e:
+        logging.error(f"Error expiring order: {e}", exc_info=True, extra={"order_id": deadline.key, "user_id": deadline.user_id})
+        raise
 
-        # Acquiring exclusive lock under which all `user_data` IO must be done.
-        async with await OrderContextManager.get(user_id, application.user_data) as ocm:
-            ocm.remove_context()
+async def expire_client_completions(deadlines: List[Deadline]):
+    metrics.order_timeouts_total.inc(len(deadlines), kind=DeadlineKind.CLIENT_COMPLETION.value)
+    await gather(*(expire_client_completion(deadline) for deadline in deadlines))
 
+async def expire_client_completion(deadline: Deadline):
+    try:
+        oc = (await OrderContextManager.get(deadline.user_id)).context
+        if oc and oc._order_id == deadline.key:
+            await oc.client_completion_timeout()
+            return
 
-    message = f"Order can't be completed. {("None of the users accepted it.") if len(users) > 0 else ('No users eligible for accepting the order were found.')}"
-    logging.info(message)
-    raise HTTPException(status_code=404, detail=message)
+        # The context didn't survive a restart, so the order is cancelled on its own.
+        async with AsyncSessionFactory() as session:
+            if (order := await session.get(Order, deadline.key)) and order.status == OrderStatus.ACCEPTED and order.paid_at is None:
+                await ledger.post(session, ledger.entry(LedgerEntryKind.UNFREEZE, order.user_id, order.quantity, order.id))
+                await session.delete(order)
+                await session.commit()
+                order_book.update(order.user, busy=False)
+                leaderboard.update(order.user)
+                logging.info(f"Order {order.id} of user {deadline.user_id} cancelled without its context as client didn't pay in time.")
+                metrics.order_outcomes_total.inc(outcome='cancelled')
+                await placements.transition(PlacementStatus.CANCELLED, by_order=order.id, detail="Client didn't pay in time.")
+    except Exception as e:
+        logging.error(f"Error cancelling order {deadline.key} for user {deadline.user_id}: {e}", exc_info=True)
 
 async def accept_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.callback_query.answer()
+    support_message = None
     try:
-        async with (await OrderContextManager.get(update.effective_user.id, application.user_data)).context as oc:
+        async with (await OrderContextManager.get(update.effective_user.id)).context as oc:
             if oc.order.status == OrderStatus.PENDING:
-                oc.order.status = OrderStatus.ACCEPTED
-                oc.session.commit()
+                if not await oc.offer.claim(update.effective_user.id):
+                    logging.info(f"Order can't be accepted. It's been accepted by user {oc.offer.winner}.", extra={"order_id": oc.order.id, "user_id": update.effective_user.id})
+                    return
 
-                # Make ACID.
-                await oc.notification.edit_reply_markup(None)
-                oc.support_message = await context.bot.send_message(SUPPORT_ID, f"Ордер ID: `{md(oc.order.id, version=2)}`\nСтоимость: *{md(FormattingHelper.quantize(oc.order.total_price, 2), version=2)}* {oc.order.user.currency}\nКонтрагент: @{update.effective_user.username}\nРеквизиты: `{oc.order.user.card}`", reply_markup=InlineKeyboardMarkup([
+                oc.order.status = OrderStatus.ACCEPTED
+                # Frozen along with the status, so that the frozen balance always matches the ACCEPTED orders once committed.
+                await ledger.post(oc.session, ledger.entry(LedgerEntryKind.FREEZE, oc.order.user_id, oc.order.quantity, oc.order.id))
+                await oc.session.commit()
+                metrics.order_accept_seconds.observe((datetime.now(timezone.utc) - oc.order.created_at).total_seconds())
+
+                # Make ACID. Left to `offer_order` if the offer is still being sent.
+                if oc.notification:
+                    dispatcher.edit_reply_markup(oc.notification, None, Priority.ORDER)
+                support_message = dispatcher.send_message(SUPPORT_ID, templates.ORDER_ACCEPTED.render(order_id=oc.order.id, total=FormattingHelper.quantize(oc.order.total_price, 2), currency=oc.order.user.currency, username=update.effective_user.username, card=oc.order.user.card), Priority.ORDER, reply_markup=InlineKeyboardMarkup([
                     [InlineKeyboardButton("Да ID", callback_data=f"{HandlerNames.YES_SUPPORT}|{oc.order.user_id}"), InlineKeyboardButton("Нет ID", callback_data=f"{HandlerNames.NO_SUPPORT}|{oc.order.user_id}")]
                     ]),
                     parse_mode="MarkdownV2")
-                
-                oc.handle_event.set()
 
             else:
-                logging.warning(f"Order ({oc.order.id}) can't be accepted. It's not {OrderStatus.PENDING} ({oc.order.status}).")
+                logging.warning(f"Order can't be accepted. It's not {OrderStatus.PENDING} ({oc.order.status}).", extra={"order_id": oc.order.id, "user_id": update.effective_user.id})
+
+        # Awaited without holding the lock and then kept along with the order, unless it's been resolved meanwhile.
+        if support_message and (oc := (await OrderContextManager.get(update.effective_user.id)).context):
+            message = await support_message
+            async with oc:
+                oc.support_message = message
     except Exception as e:
-        logging.error(f"Error accepting order for user {update.effective_user.id}: {e}", exc_info=True)
+        logging.error(f"Error accepting order: {e}", exc_info=True, extra={"user_id": update.effective_user.id})
 
 async def decline_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.callback_query.answer()
     try:
-        async with (await OrderContextManager.get(update.effective_user.id, application.user_data)).context as oc:
+        async with (await OrderContextManager.get(update.effective_user.id)).context as oc:
             if oc.order.status == OrderStatus.PENDING:
                 oc.order.status = OrderStatus.DECLINED
-                oc.session.commit()
+                await oc.session.commit()
 
-                # Make ACID.
-                await oc.notification.delete()
+                # Make ACID. Left to `offer_order` if the offer is still being sent.
+                if oc.notification:
+                    dispatcher.delete(oc.notification, Priority.ORDER)
 
-                oc.handle_event.set()
+                await oc.offer.withdraw(update.effective_user.id)
 
             else:
-                logging.warning(f"Order ({oc.order.id}) can't be declined. It's not {OrderStatus.PENDING} ({oc.order.status}).")
+                logging.warning(f"Order can't be declined. It's not {OrderStatus.PENDING} ({oc.order.status}).", extra={"order_id": oc.order.id, "user_id": update.effective_user.id})
     except Exception as e:
-        logging.error(f"Error declining order ({oc.order.id}) for user {update.effective_user.id}: {e}", exc_info=True)
+        logging.error(f"Error declining order: {e}", exc_info=True, extra={"user_id": update.effective_user.id})
 
 
 class CompleteOrderRequest(BaseModel):
@@ -236,20 +702,23 @@ class CompleteOrderRequest(BaseModel):
     account_id: int
 
 @app.patch("/orders", dependencies=[Depends(validate_api_key)])
-async def order(request: CompleteOrderRequest):
+async def order(request: CompleteOrderRequest, idempotency_key: Optional[str] = Header(None)):
+    return await idempotency.run("PATCH /orders", idempotency_key, fingerprint(request.model_dump_json()), lambda: complete_client_order(request))
+
+async def complete_client_order(request: CompleteOrderRequest):
     logging.info(f"{CompleteOrderRequest.__name__} for order {request.order_id} for account {request.account_id} from client was received.")
 
     try:
-        async with (await OrderContextManager.get(request.account_id, application.user_data)).context as oc:
+        async with (await OrderContextManager.get(request.account_id)).context as oc:
             # Client sent wrong data. Active order doesn't match the user.
             if oc.order.id == request.order_id:
                 if oc.order.status == OrderStatus.ACCEPTED:
-                    await oc.cancel_client_completion_waiter()
+                    await oc.cancel_client_completion_timeout()
 
                     oc.order.paid_at = datetime.now(timezone.utc)
-                    oc.session.commit()
+                    await oc.session.commit()
 
-                    await application.bot.send_message(oc.order.user.id, f"Клиент оплатил *{md(FormattingHelper.quantize(oc.order.total_price, 2), version=2)}* {oc.order.user.currency}", reply_markup=InlineKeyboardMarkup([
+                    dispatcher.send_message(oc.order.user.id, templates.CLIENT_PAID.render(total=FormattingHelper.quantize(oc.order.total_price, 2), currency=oc.order.user.currency), Priority.ORDER, reply_markup=InlineKeyboardMarkup([
                         [InlineKeyboardButton("Подтвердить", callback_data=HandlerNames.CONFIRM_CLIENT_PAYMENT), InlineKeyboardButton("Обратиться в тех. поддержку", callback_data=HandlerNames.CALL_SUPPORT)]
                         ]),
                         parse_mode="MarkdownV2")
@@ -271,7 +740,7 @@ async def order(request: CompleteOrderRequest):
 async def confirm_client_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.callback_query.answer()
     
-    await update.effective_message.edit_text(f"{update.effective_message.text_markdown_v2}\n\nВы уверены?", reply_markup=InlineKeyboardMarkup([
+    await update.effective_message.edit_text(templates.CONFIRM_PAYMENT.render(text=update.effective_message.text_markdown_v2), reply_markup=InlineKeyboardMarkup([
         [InlineKeyboardButton("Да", callback_data=HandlerNames.COMPLETE_ORDER), InlineKeyboardButton("Нет", callback_data=HandlerNames.HANDLE_CLIENT_PAYMENT)]
         ]),
         parse_mode="MarkdownV2")
@@ -279,8 +748,8 @@ async def confirm_client_payment(update: Update, context: ContextTypes.DEFAULT_T
 async def handle_client_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.callback_query.answer()
 
-    async with (await OrderContextManager.get(update.effective_user.id, application.user_data)).context as oc:
-        await update.effective_message.edit_text(f"Клиент оплатил *{md(FormattingHelper.quantize(oc.order.total_price, 2), version=2)}* {oc.order.user.currency}", reply_markup=InlineKeyboardMarkup([
+    async with (await OrderContextManager.get(update.effective_user.id)).context as oc:
+        dispatcher.edit_text(update.effective_message, templates.CLIENT_PAID.render(total=FormattingHelper.quantize(oc.order.total_price, 2), currency=oc.order.user.currency), Priority.ORDER, reply_markup=InlineKeyboardMarkup([
             [InlineKeyboardButton("Подтвердить", callback_data=HandlerNames.CONFIRM_CLIENT_PAYMENT), InlineKeyboardButton("Обратиться в тех. поддержку", callback_data=HandlerNames.CALL_SUPPORT)]
             ]),
             parse_mode="MarkdownV2")
@@ -290,18 +759,20 @@ async def complete_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     user_id = update.effective_user.id
     try:
-        async with (await OrderContextManager.get(user_id, application.user_data)).context as oc:
+        async with (await OrderContextManager.get(user_id)).context as oc:
             if oc.order.status == OrderStatus.ACCEPTED:
-                oc.order.user.frozen_balance -= oc.order.quantity
+                await ledger.post(oc.session, ledger.entry(LedgerEntryKind.SETTLE, oc.order.user_id, oc.order.quantity, oc.order.id))
                 oc.order.status = OrderStatus.COMPLETED
-                oc.session.commit()
+                await oc.session.commit()
+                order_book.update(oc.order.user, busy=False)
 
-                await update.effective_message.delete()
-                async with await OrderContextManager.get(user_id, application.user_data) as ocm:
-                    ocm.remove_context()
+                dispatcher.delete(update.effective_message, Priority.ORDER)
+                async with await OrderContextManager.get(user_id) as ocm:
+                    await ocm.remove_context()
 
                 logging.info(f"Order {oc.order.id} completed for user {user_id}")
-                # Send confirmation back to the client.
+                metrics.order_outcomes_total.inc(outcome='completed')
+                await placements.transition(PlacementStatus.COMPLETED, by_order=oc.order.id)
             else:
                 # Must be impossible due to preceding validations.
                 message = f"{OrderStatus.PENDING} order {oc.order.id} got through to {complete_order.__name__}."
@@ -312,8 +783,8 @@ async def complete_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def call_support(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.callback_query.answer()
     try:
-        async with (await OrderContextManager.get(update.effective_user.id, application.user_data)).context as oc:
-            await update.effective_message.reply_markdown_v2(f"@techsupport\n\n*Ордер ID*: `{oc.order.id}`\n*Время оплаты*: `{oc.order.paid_at.astimezone(ZoneInfo("Europe/Moscow")).strftime("%Y-%m-%d %H:%M:%S")}`")
+        async with (await OrderContextManager.get(update.effective_user.id)).context as oc:
+            dispatcher.send_message(update.effective_message.chat_id, templates.SUPPORT_REQUEST.render(order_id=oc.order.id, paid_at=oc.order.paid_at.astimezone(ZoneInfo("Europe/Moscow")).strftime("%Y-%m-%d %H:%M:%S")), Priority.ORDER, parse_mode="MarkdownV2")
     except Exception as e:
         logging.error(f"Error calling support for user {update.effective_user.id}: {e}", exc_info=True)
 
@@ -323,28 +794,30 @@ async def yes_support(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.callback_query.answer()
 
     user_id = int(update.callback_query.data.split('|')[-1])
-    if oc := (await OrderContextManager.get(user_id, application.user_data)).context:
+    if oc := (await OrderContextManager.get(user_id)).context:
         try:
             async with oc:
                 if oc.order.status == OrderStatus.ACCEPTED:
-                    oc.order.user.frozen_balance -= oc.order.quantity
+                    await ledger.post(oc.session, ledger.entry(LedgerEntryKind.SETTLE, oc.order.user_id, oc.order.quantity, oc.order.id))
                     oc.order.status = OrderStatus.COMPLETED
-                    oc.session.commit()
+                    await oc.session.commit()
+                    order_book.update(oc.order.user, busy=False)
 
-                    await update.effective_message.delete()
+                    dispatcher.delete(update.effective_message, Priority.ORDER)
 
-                    await oc.cancel_client_completion_waiter()
+                    await oc.cancel_client_completion_timeout()
 
-                    async with await OrderContextManager.get(user_id, application.user_data) as ocm:
-                        ocm.remove_context()
-                    # Send confirmation back to the client.
+                    async with await OrderContextManager.get(user_id) as ocm:
+                        await ocm.remove_context()
                     logging.info(f"Order {oc.order.id} completed by support for user {user_id}")
+                    metrics.order_outcomes_total.inc(outcome='completed')
+                    await placements.transition(PlacementStatus.COMPLETED, by_order=oc.order.id)
 
         except Exception as e:
             logging.error(f"Error resolving order by support for user {user_id}: {e}", exc_info=True)
     else:
-        with SessionFactory() as session:
-            orders = session.query(Order).filter_by(user_id=user_id, status=OrderStatus.ACCEPTED).all()
+        async with AsyncSessionFactory() as session:
+            orders = (await session.scalars(select(Order).filter_by(user_id=user_id, status=OrderStatus.ACCEPTED))).all()
 
             if len(orders) == 0:
                 logging.warning(f"No active orders for user {user_id}.")
@@ -355,9 +828,12 @@ async def yes_support(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 return
             
             order = orders[0]
-            order.user.frozen_balance -= order.quantity
+            await ledger.post(session, ledger.entry(LedgerEntryKind.SETTLE, order.user_id, order.quantity, order.id))
             order.status = OrderStatus.COMPLETED
-            session.commit()
+            await session.commit()
+            order_book.update(order.user, busy=False)
+        metrics.order_outcomes_total.inc(outcome='completed')
+        await placements.transition(PlacementStatus.COMPLETED, by_order=order.id)
 
 async def no_support(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logging.info(f"No support called with {update.callback_query.data}")
@@ -365,29 +841,31 @@ async def no_support(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.callback_query.answer()
 
     user_id = int(update.callback_query.data.split('|')[-1])
-    if oc := (await OrderContextManager.get(user_id, application.user_data)).context:
+    if oc := (await OrderContextManager.get(user_id)).context:
         try:
             async with oc:
                 if oc.order.status == OrderStatus.ACCEPTED:
-                    oc.order.user.frozen_balance -= oc.order.quantity
-                    oc.order.user.balance += oc.order.quantity
-                    oc.session.delete(oc.order)
-                    oc.session.commit()
+                    await ledger.post(oc.session, ledger.entry(LedgerEntryKind.UNFREEZE, oc.order.user_id, oc.order.quantity, oc.order.id))
+                    await oc.session.delete(oc.order)
+                    await oc.session.commit()
+                    order_book.update(oc.order.user, busy=False)
+                    leaderboard.update(oc.order.user)
 
-                    await update.effective_message.delete()
+                    dispatcher.delete(update.effective_message, Priority.ORDER)
 
-                    await oc.cancel_client_completion_waiter()
+                    await oc.cancel_client_completion_timeout()
 
-                    async with await OrderContextManager.get(user_id, application.user_data) as ocm:
-                        ocm.remove_context()
-                    # Send rejection back to the client.
+                    async with await OrderContextManager.get(user_id) as ocm:
+                        await ocm.remove_context()
                     logging.info(f"Order {oc.order.id} rejected by support for user {user_id}")
+                    metrics.order_outcomes_total.inc(outcome='cancelled')
+                    await placements.transition(PlacementStatus.CANCELLED, by_order=oc.order.id, detail="Payment wasn't confirmed by support.")
 
         except Exception as e:
             logging.error(f"Error resolving order by support for user {user_id}: {e}", exc_info=True)
     else:
-        with SessionFactory() as session:
-            orders = session.query(Order).filter_by(user_id=user_id, status=OrderStatus.ACCEPTED).all()
+        async with AsyncSessionFactory() as session:
+            orders = (await session.scalars(select(Order).filter_by(user_id=user_id, status=OrderStatus.ACCEPTED))).all()
 
             if len(orders) == 0:
                 logging.warning(f"No active orders for user {user_id}.")
@@ -398,10 +876,13 @@ async def no_support(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 return
             
             order = orders[0]
-            order.user.frozen_balance -= oc.order.quantity
-            order.user.balance += oc.order.quantity
-            session.delete(oc.order)
-            session.commit()
+            await ledger.post(session, ledger.entry(LedgerEntryKind.UNFREEZE, order.user_id, order.quantity, order.id))
+            await session.delete(order)
+            await session.commit()
+            order_book.update(order.user, busy=False)
+            leaderboard.update(order.user)
+        metrics.order_outcomes_total.inc(outcome='cancelled')
+        await placements.transition(PlacementStatus.CANCELLED, by_order=order.id, detail="Payment wasn't confirmed by support.")
     
 async def order(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logging.info(f"User {update.effective_user.id} requested to start order")
@@ -427,13 +908,15 @@ async def receive_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Add buttons and handlers for cancelling lookup.
 
     # Move to actual handler that will validate deposit transaction.
-    with SessionFactory() as session:
-        if user := session.query(User).filter_by(id=update.effective_user.id).one_or_none():
-            user.balance += amount
-            session.commit()
+    async with AsyncSessionFactory() as session:
+        if user := await session.get(User, update.effective_user.id):
+            await ledger.post(session, ledger.entry(LedgerEntryKind.DEPOSIT, user.id, amount))
+            await session.commit()
+            order_book.update(user)
+            leaderboard.update(user)
             logging.info(f"User {user.id} balance updated with {amount}")
             await update.message.reply_text(f"Баланс пополнен: {user.formatted_balance} USDT.")
-            await display_account(update, user, session)
+            await display_account(update, user)
         else:
             await update.message.reply_text("Аккаунт не найден.")
             # Must be impossible. Redirect to registration.
@@ -453,13 +936,14 @@ async def receive_card_details(update: Update, context: ContextTypes.DEFAULT_TYP
     if card_number.isdigit():
         card = CreditCard(card_number)
         if card.is_valid and not card.is_expired:
-            with SessionFactory() as session:
-                if user := session.query(User).filter_by(id=update.effective_user.id).one_or_none():
+            async with AsyncSessionFactory() as session:
+                if user := await session.get(User, update.effective_user.id):
                     user.card = card.number
-                    session.commit()
+                    await session.commit()
+                    order_book.update(user)
                     logging.info(f"User card details changed to {card.number}")
                     await update.message.reply_text(f"Реквизиты изменены: {card.number}.")
-                    await display_account(update, user, session)
+                    await display_account(update, user)
                     return ConversationHandler.END
                 elif user := context.user_data.get('new_user', None):
                     user.card = card.number
@@ -491,10 +975,12 @@ async def receive_exchange_rate(update: Update, context: ContextTypes.DEFAULT_TY
         await update.message.reply_text("Некорректный курс.")
         return
     
-    with SessionFactory() as session:
-        if user := session.query(User).filter_by(id=update.effective_user.id).one_or_none():
+    async with AsyncSessionFactory() as session:
+        if user := await session.get(User, update.effective_user.id):
             user.exchange_rate = new_exchange_rate
-            session.commit()
+            await session.commit()
+            order_book.update(user)
+            leaderboard.update(user)
         elif user := context.user_data.get('new_user', None):
             user.exchange_rate = new_exchange_rate
         else:
@@ -519,8 +1005,8 @@ async def receive_currency(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.callback_query.answer(f"Некорректная валюта. Доступные валюты: {', '.join(Currency.__members__.keys())}.")
         return
 
-    with SessionFactory() as session:
-        if user := session.query(User).filter_by(id=update.effective_user.id).one_or_none():
+    async with AsyncSessionFactory() as session:
+        if user := await session.get(User, update.effective_user.id):
             user.currency = currency
         elif user := context.user_data.get('new_user', None):
             user.currency = currency
@@ -529,19 +1015,21 @@ async def receive_currency(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.callback_query.answer("Аккаунт не найден.")
             return ConversationHandler.END
 
-        session.commit()
+        await session.commit()
+        order_book.update(user)
+        leaderboard.update(user)
 
         logging.info(f"User {user.id} currency changed to {currency}")
         await update.callback_query.answer(f"Валюта обновлена: {currency}")
         await update.effective_message.delete()
 
-        await display_account(update, user, session)
+        await display_account(update, user)
         return ConversationHandler.END
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with SessionFactory() as session:
-        if user := session.query(User).filter_by(id=update.effective_user.id).one_or_none():
-            await display_account(update, user, session)
+    async with AsyncSessionFactory() as session:
+        if user := await session.get(User, update.effective_user.id):
+            await display_account(update, user)
             return ConversationHandler.END
         else:
             if update.effective_user.username:
@@ -554,28 +1042,32 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
 async def start_work(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logging.info(f"User {update.effective_user.id} started work")
-    with SessionFactory() as session:
-        user = session.query(User).filter_by(id=update.effective_user.id).one()
+    async with AsyncSessionFactory() as session:
+        user = await session.get_one(User, update.effective_user.id)
         user.is_working = True
-        session.commit()
+        await session.commit()
+        order_book.update(user)
         
         await update.effective_message.delete()
-        await display_account(update, user, session)
+        await display_account(update, user)
 
 async def stop_work(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logging.info(f"User {update.effective_user.id} stopped work")
-    with SessionFactory() as session:
-        user = session.query(User).filter_by(id=update.effective_user.id).one()
+    async with AsyncSessionFactory() as session:
+        user = await session.get_one(User, update.effective_user.id)
         user.is_working = False
-        session.commit()
+        await session.commit()
+        order_book.update(user)
         
         await update.effective_message.delete()
-        await display_account(update, user, session)
-
-async def display_account(update: Update, user: User, session):
-    users: List[User] = session.query(User).order_by(User.exchange_rate).all()
-    await update.effective_message.reply_markdown_v2(
-        f"{user.name} \\| *{md(user.formatted_balance, version=2)}* USDT \\| 1 USDT \\= *{md(user.formatted_exchange_rate, version=2)}* {user.currency}\nРеквизиты: `{user.card}`\n\n*TOP*:\n{'\n'.join([f"{user[0]}\\. {md(user[1].formatted_name, version=2)} \\| *{md(user[1].formatted_balance, version=2)}* USDT \\| 1 USDT \\= *{md(user[1].formatted_exchange_rate, version=2)}* {user[1].currency}" for user in enumerate(users[:TOP_LENGTH], 1)])}",
+        await display_account(update, user)
+
+async def display_account(update: Update, user: User):
+    await dispatcher.send_message(
+        update.effective_message.chat_id,
+        templates.ACCOUNT.render(name=user.name, balance=user.formatted_balance, exchange_rate=user.formatted_exchange_rate, currency=user.currency, card=user.card, top=leaderboard.text),
+        Priority.MENU,
+        parse_mode="MarkdownV2",
         reply_markup=InlineKeyboardMarkup([
             [InlineKeyboardButton("Купить USDT", callback_data=order.__name__)],
             [
@@ -645,13 +1137,115 @@ async def main():
     application.add_handlers([CallbackQueryHandler(start_work, pattern=HandlerNames.START_WORK), CallbackQueryHandler(stop_work, pattern=HandlerNames.STOP_WORK)])
     application.add_handlers([CallbackQueryHandler(handle_client_payment, pattern=HandlerNames.HANDLE_CLIENT_PAYMENT), CallbackQueryHandler(confirm_client_payment, pattern=HandlerNames.CONFIRM_CLIENT_PAYMENT), CallbackQueryHandler(complete_order, pattern=HandlerNames.COMPLETE_ORDER), CallbackQueryHandler(call_support, pattern=HandlerNames.CALL_SUPPORT)])
     application.add_handlers([CallbackQueryHandler(yes_support, pattern=f"{HandlerNames.YES_SUPPORT}|(d+)"), CallbackQueryHandler(no_support, pattern=f"{HandlerNames.NO_SUPPORT}|(d+)")])
+    if tracer.enabled:
+        tracer.instrument_handlers(application)
 
     # Both servers .start() and not .run() so to not block the event loop on which they both must run.
+    if pending := migrations.pending(engine):
+        raise RuntimeError(f"Database schema is out of date. Pending migrations: {pending}. Run `python manage.py migrate`.")
+    if API_WORKERS > 1 and not isinstance(store, PostgresContextStore):
+        raise RuntimeError("Running multiple API workers requires `CONTEXT_STORE=postgres`.")
+    if BOT_MODE == 'webhook':
+        if not (WEBHOOK_URL and WEBHOOK_SECRET):
+            raise RuntimeError("Webhook mode requires `WEBHOOK_URL` and `WEBHOOK_SECRET`.")
+        # Conversations are kept by the application of the process that receives the update.
+        if API_WORKERS > 1:
+            raise RuntimeError("Webhook mode requires `API_WORKERS=1`.")
+
+    await start_services(primary=True)
+
     await application.initialize()
     await application.start()
-    await application.updater.start_polling()
+    if BOT_MODE == 'webhook':
+        await application.bot.set_webhook(f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}", allowed_updates=Update.ALL_TYPES, secret_token=WEBHOOK_SECRET)
+    else:
+        # Removes the webhook set before, if any.
+        await application.updater.start_polling()
+
+    sockets = None
+    if API_WORKERS > 1:
+        # Workers accept connections on the socket shared with this process.
+        sockets = [Config(app, host=API_HOST, port=API_PORT).bind_socket()]
+        for _ in range(API_WORKERS - 1):
+            get_context('spawn').Process(target=serve_api_worker, args=(sockets[0],), daemon=True).start()
+
+    await Server(Config(app, host=API_HOST, port=API_PORT)).serve(sockets)
+
+    await async_engine.dispose()
+
+async def start_services(primary: bool):
+    """
+    Starts the services the handlers rely on in this process.
+
+    Args:
+        primary (bool): Whether this is the process running the bot. Only it fires the deadlines persisted before startup and recovers active orders
+    """
+    if isinstance(store, PostgresContextStore):
+        store.bot = application.bot
+        # Book and TOP of every process follow the changes made by the others.
+        order_book.on_change = lambda user_id: create_task(store.publish('users', f"{os.getpid()} {user_id}"))
+        store.subscribe('users', refresh_user)
+        # Watchers of a placement might be served by another process.
+        placements.on_change = lambda id: create_task(store.publish('order_placements', id))
+        store.subscribe('order_placements', on_placement_changed)
+        await store.start()
+
+    if tracer.enabled:
+        tracer.instrument_engine(async_engine)
+        tracer.start()
+
+    scheduler.register(DeadlineKind.ORDER_EXPIRY, expire_orders)
+    scheduler.register(DeadlineKind.CLIENT_COMPLETION, expire_client_completions)
+    if primary:
+        await scheduler.load()
+        # Orders left active by the previous run are settled before the book is built from them.
+        await recover(RECOVERY_BATCH_SIZE)
+
+    create_task(dispatcher.run(application.bot))
+    await order_book.sync()
+    await leaderboard.load()
+    create_task(order_book.run_sync(ORDER_BOOK_SYNC_INTERVAL))
+    if primary:
+        create_task(idempotency.run_purge(IDEMPOTENCY_TTL))
+        create_task(archiver.run(ORDER_ARCHIVE_INTERVAL))
+        if RECONCILE_INTERVAL > 0:
+            reconciler.on_fixed = on_balance_fixed
+            create_task(reconciler.run(RECONCILE_INTERVAL))
+
+    create_task(scheduler.run())
+
+async def refresh_user(payload: str):
+    pid, user_id = map(int, payload.split())
+    if pid == os.getpid():
+        return
+    try:
+        if user := await order_book.refresh(user_id):
+            leaderboard.update(user)
+    except Exception as e:
+        logging.error(f"Error refreshing user {user_id} changed by process {pid}: {e}", exc_info=True)
+
+def on_balance_fixed(user: User):
+    order_book.update(user)
+    leaderboard.update(user)
+
+async def on_placement_changed(id: str):
+    placements.notify(id)
+
+def serve_api_worker(sock: socket.socket):
+    """
+    Entry point of an extra API worker process. It serves the HTTP API only as the bot runs in the main process.
+    """
+    run(api_worker(sock))
+
+async def api_worker(sock: socket.socket):
+    await start_services(primary=False)
+    # Not started, only used for calling the Bot API.
+    await application.initialize()
+
+    await Server(Config(app)).serve([sock])
 
-    await Server(Config(app)).serve()
+    await application.shutdown()
+    await async_engine.dispose()
     
 if __name__ == '__main__':
     run(main())
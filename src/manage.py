@@ -0,0 +1,143 @@
+"""
+Management commands.
+
+Usage:
+    python manage.py migrate [--to VERSION]
+    python manage.py downgrade --to VERSION
+    python manage.py current
+    python manage.py explain [--currency CURRENCY] [--quantity QUANTITY] [--analyze]
+    python manage.py ledger [--rebuild]
+    python manage.py reconcile [--full] [--fix]
+    python manage.py export [--makers] [--format csv|ndjson] [--user USER_ID] [--status STATUS] [--currency CURRENCY] [--since TIME] [--until TIME] [--output FILE]
+"""
+from argparse import ArgumentParser, Namespace
+import asyncio
+from datetime import datetime
+from decimal import Decimal
+import logging
+import sys
+
+from sqlalchemy import text
+from database import Currency, OrderStatus, busy_makers, eligible_makers, engine
+import ledger
+import migrations
+import reports
+from reconciliation import reconciler
+
+
+def migrate(args: Namespace):
+    migrations.upgrade(engine, args.to)
+    print(f"Schema version: {migrations.current(engine)}")
+
+def downgrade(args: Namespace):
+    migrations.downgrade(engine, args.to)
+    print(f"Schema version: {migrations.current(engine)}")
+
+def current(args: Namespace):
+    print(f"Schema version: {migrations.current(engine)}")
+    for migration in migrations.pending(engine):
+        print(f"Pending: {migration}")
+
+def explain(args: Namespace):
+    """
+    Reports query plans of the lookup of makers eligible for accepting an order.
+    """
+    statements = {
+        "Eligible makers": eligible_makers(args.currency, Decimal(args.quantity)),
+        "Order book sync of busy makers": busy_makers(),
+    }
+    with engine.connect() as connection:
+        for title, statement in statements.items():
+            sql = str(statement.compile(engine, compile_kwargs={"literal_binds": True}))
+            plan = connection.execute(text(f"EXPLAIN {'(ANALYZE, BUFFERS) ' if args.analyze else ''}{sql}")).scalars().all()
+            print(f"{title}:\n{'\n'.join(plan)}\n")
+            if any('Seq Scan on orders' in line for line in plan):
+                print(f"Warning: {title.lower()} scans the whole orders table. Check that migrations are applied and statistics are up to date (ANALYZE orders).\n")
+
+def audit_ledger(args: Namespace):
+    """
+    Reports users whose balances don't match their ledger, or resets their balances to the ledger's with `--rebuild`.
+    """
+    with engine.begin() as connection:
+        if args.rebuild:
+            print(f"Rebuilt balances of {ledger.rebuild(connection)} users.")
+            return
+
+        rows = ledger.discrepancies(connection)
+        for user_id, balance, frozen_balance, ledger_balance, ledger_frozen_balance in rows:
+            print(f"User {user_id}: balance {balance} (ledger {ledger_balance}), frozen balance {frozen_balance} (ledger {ledger_frozen_balance})")
+        print(f"{len(rows)} users don't match their ledger.")
+
+def reconcile(args: Namespace):
+    """
+    Reports users whose frozen balance doesn't match their ACCEPTED orders, or fixes them with `--fix`.
+    The book of a running service picks fixed balances up on its next sync.
+    """
+    checked, discrepancies = asyncio.run(reconciler.reconcile(args.full, args.fix))
+    for user_id, frozen_balance, accepted in discrepancies:
+        print(f"User {user_id}: frozen balance {frozen_balance}, ACCEPTED orders {accepted}")
+    print(f"{len(discrepancies)} of {checked} users checked {'were fixed' if args.fix else "don't match their orders"}.")
+
+def export(args: Namespace):
+    """
+    Streams orders, or per-maker aggregates with `--makers`, to `--output` or stdout.
+    """
+    if args.makers:
+        statement = reports.makers(args.user, args.currency, args.since, args.until)
+    else:
+        statement = reports.orders(args.user, args.status, args.currency, args.since, args.until)
+    output = open(args.output, 'w', newline='') if args.output else sys.stdout
+    try:
+        with engine.connect() as connection:
+            written = reports.write(connection, statement, reports.ExportFormat(args.format), output)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    logging.info(f"Exported {written} rows.")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    parser = ArgumentParser(description="Management commands.")
+    commands = parser.add_subparsers(required=True)
+
+    command = commands.add_parser('migrate', help="Apply pending migrations.")
+    command.add_argument('--to', type=int, help="Version to migrate up to. Latest by default.")
+    command.set_defaults(func=migrate)
+
+    command = commands.add_parser('downgrade', help="Revert migrations.")
+    command.add_argument('--to', type=int, required=True, help="Version to revert down to. 0 reverts all.")
+    command.set_defaults(func=downgrade)
+
+    command = commands.add_parser('current', help="Show the current schema version and pending migrations.")
+    command.set_defaults(func=current)
+
+    command = commands.add_parser('explain', help="Report query plans of the eligible makers lookup.")
+    command.add_argument('--currency', choices=Currency.__members__.keys(), default=Currency.RUB.value)
+    command.add_argument('--quantity', default='100')
+    command.add_argument('--analyze', action='store_true', help="Run the queries to report actual timings.")
+    command.set_defaults(func=explain)
+
+    command = commands.add_parser('ledger', help="Audit balances against the ledger.")
+    command.add_argument('--rebuild', action='store_true', help="Reset mismatching balances to the ledger's.")
+    command.set_defaults(func=audit_ledger)
+
+    command = commands.add_parser('reconcile', help="Reconcile frozen balances with ACCEPTED orders of the users touched since the last run.")
+    command.add_argument('--full', action='store_true', help="Check every user.")
+    command.add_argument('--fix', action='store_true', help="Fix mismatching frozen balances with RECONCILE ledger entries.")
+    command.set_defaults(func=reconcile)
+
+    command = commands.add_parser('export', help="Export orders or per-maker aggregates as CSV or NDJSON.")
+    command.add_argument('--makers', action='store_true', help="Export per-maker aggregates instead of orders.")
+    command.add_argument('--format', choices=[format.value for format in reports.ExportFormat], default=reports.ExportFormat.CSV.value)
+    command.add_argument('--user', type=int, help="ID of the maker.")
+    command.add_argument('--status', choices=[status.value for status in OrderStatus], help="Status of the orders. Ignored with --makers.")
+    command.add_argument('--currency', choices=Currency.__members__.keys())
+    command.add_argument('--since', type=datetime.fromisoformat, help="ISO time the range starts at, inclusive.")
+    command.add_argument('--until', type=datetime.fromisoformat, help="ISO time the range ends at, exclusive.")
+    command.add_argument('--output', help="File to write to. Standard output by default.")
+    command.set_defaults(func=export)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,142 @@
+"""
+Service metrics exposed at `/metrics` in the Prometheus text format.
+
+Metrics are kept per process, so with several API workers every scrape reports the process that served it.
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+from math import inf
+from time import perf_counter
+from typing import Callable, Iterator, Union
+
+# Seconds.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class Metric:
+    type = ''
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        registry.append(self)
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: tuple[str, ...], extra: str = '') -> str:
+        pairs = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, key)]
+        if extra:
+            pairs.append(extra)
+        return f"{{{','.join(pairs)}}}" if pairs else ''
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return '\n'.join([f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}", *self.samples()])
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> Iterator[str]:
+        for key, value in self._values.items():
+            yield f"{self.name}{self._labels(key)} {_format(value)}"
+
+
+class Gauge(Metric):
+    """
+    Gauge read from `collect` at scrape time, so that the measured state isn't duplicated.
+    With `labelnames`, `collect` returns the values by label values.
+    """
+    type = 'gauge'
+
+    def __init__(self, name: str, help: str, collect: Callable[[], Union[float, dict[tuple[str, ...], float]]], labelnames: tuple[str, ...] = ()):
+        super().__init__(name, help, labelnames)
+        self._collect = collect
+
+    def samples(self) -> Iterator[str]:
+        if not self.labelnames:
+            yield f"{self.name} {_format(self._collect())}"
+            return
+        for key, value in self._collect().items():
+            yield f"{self.name}{self._labels(key)} {_format(value)}"
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self._buckets = (*buckets, inf)
+        # Non-cumulative bucket counts and sum per label values.
+        self._values: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        if (series := self._values.get(key)) is None:
+            series = self._values[key] = ([0] * len(self._buckets), [0.0])
+        series[0][bisect_left(self._buckets, value)] += 1
+        series[1][0] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def samples(self) -> Iterator[str]:
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self._buckets, counts):
+                cumulative += count
+                le = f'le="{_format(bound)}"'
+                yield f"{self.name}_bucket{self._labels(key, le)} {cumulative}"
+            yield f"{self.name}_sum{self._labels(key)} {_format(total[0])}"
+            yield f"{self.name}_count{self._labels(key)} {cumulative}"
+
+
+def render() -> str:
+    return '\n'.join(metric.render() for metric in registry) + '\n'
+
+def _format(value: float) -> str:
+    if value == inf:
+        return '+Inf'
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+registry: list[Metric] = []
+
+order_phase_seconds = Histogram('order_phase_seconds', "Duration of the phases of placing an order: eligibility, notify, wait (for accept) and commit.", ('phase',))
+order_request_seconds = Histogram('order_request_seconds', "Duration of placing an order, i.e. how long POST /orders holds the connection when placed synchronously.")
+order_offers_per_fill = Histogram('order_offers_per_fill', "Makers an order was offered to until it was accepted.", buckets=(1, 2, 3, 5, 10, 20, 50, 100, 200))
+order_fills = Histogram('order_fills', "Makers an order placed with partial fills was split across.", buckets=(1, 2, 3, 5, 10, 20, 50))
+order_accept_seconds = Histogram('order_accept_seconds', "Time from offering an order to a maker until the maker accepted it.")
+order_outcomes_total = Counter('order_outcomes_total', "Orders offered to makers by outcome: accepted, declined, superseded (accepted by another maker), expired, completed or cancelled.", ('outcome',))
+orders_unfilled_total = Counter('orders_unfilled_total', "Orders none of the makers accepted.")
+order_timeouts_total = Counter('order_timeouts_total', "Fired order deadlines by kind.", ('kind',))
+order_fees_total = Counter('order_fees_total', "Service fees charged for offers that weren't responded to in time.")
+lock_wait_seconds = Histogram('lock_wait_seconds', "Time spent waiting for the per-user lock of `OrderContext` (context) or `OrderContextManager` (manager).", ('scope',))
+telegram_request_seconds = Histogram('telegram_request_seconds', "Latency of Bot API requests made by the dispatcher.", ('method',))
+telegram_requests_total = Counter('telegram_requests_total', "Bot API requests made by the dispatcher by result: ok, retry or error.", ('method', 'result'))
+order_queue_seconds = Histogram('order_queue_seconds', "Time orders waited in the admission queue for a slot of their currency.", ('currency',))
+order_rejections_total = Counter('order_rejections_total', "Orders rejected with 429 by reason: rate (limit of the API key), queue_full, deadline (expected to wait longer than the queue timeout) or timeout (waited for it).", ('reason',))
+orders_archived_total = Counter('orders_archived_total', "Finished orders moved to `orders_archive`.")
+reconcile_users_checked_total = Counter('reconcile_users_checked_total', "Users whose frozen balance was reconciled with their ACCEPTED orders.")
+reconcile_discrepancies_total = Counter('reconcile_discrepancies_total', "Frozen balances that didn't match the ACCEPTED orders by action: reported or fixed.", ('action',))
+log_records_dropped_total = Counter('log_records_dropped_total', "Log records dropped as the log queue was full.")
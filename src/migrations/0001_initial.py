@@ -0,0 +1,34 @@
+"""
+Initial schema. Idempotent, so that databases created before migrations were introduced can be brought under them.
+"""
+from sqlalchemy import Connection, text
+
+
+def upgrade(connection: Connection):
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS users (
+            id BIGINT PRIMARY KEY,
+            name VARCHAR,
+            card VARCHAR NOT NULL,
+            balance NUMERIC(20, 8) NOT NULL,
+            frozen_balance NUMERIC(20, 8) NOT NULL,
+            exchange_rate NUMERIC(20, 8) NOT NULL,
+            currency VARCHAR NOT NULL,
+            is_working BOOLEAN NOT NULL
+        )
+    """))
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS orders (
+            id VARCHAR PRIMARY KEY,
+            created_at TIMESTAMP WITH TIME ZONE NOT NULL,
+            status VARCHAR NOT NULL,
+            price NUMERIC(20, 8) NOT NULL,
+            quantity NUMERIC(20, 8) NOT NULL,
+            paid_at TIMESTAMP WITH TIME ZONE,
+            user_id BIGINT REFERENCES users (id)
+        )
+    """))
+
+def downgrade(connection: Connection):
+    connection.execute(text("DROP TABLE orders"))
+    connection.execute(text("DROP TABLE users"))
@@ -0,0 +1,23 @@
+"""
+Indexes for looking up makers eligible for accepting an order.
+
+Created concurrently, so that tables aren't locked for writes while indexes are being built.
+"""
+from sqlalchemy import Connection, text
+
+transactional = False
+
+
+def upgrade(connection: Connection):
+    # Working makers by currency ordered by exchange rate.
+    connection.execute(text("CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_working_currency_exchange_rate ON users (currency, exchange_rate) WHERE is_working"))
+    # TOP ordering of all users.
+    connection.execute(text("CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_exchange_rate ON users (exchange_rate)"))
+    connection.execute(text("CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_orders_user_id ON orders (user_id)"))
+    # Orders in flight by maker. Stays small as completed orders make up the bulk of the table.
+    connection.execute(text("CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_orders_user_id_active ON orders (user_id) WHERE status <> 'completed'"))
+    connection.execute(text("CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_orders_status ON orders (status)"))
+
+def downgrade(connection: Connection):
+    for index in ("ix_orders_status", "ix_orders_user_id_active", "ix_orders_user_id", "ix_users_exchange_rate", "ix_users_working_currency_exchange_rate"):
+        connection.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {index}"))
@@ -0,0 +1,20 @@
+"""
+Persisted deadlines fired by `scheduler`.
+"""
+from sqlalchemy import Connection, text
+
+
+def upgrade(connection: Connection):
+    connection.execute(text("""
+        CREATE TABLE deadlines (
+            kind VARCHAR NOT NULL,
+            key VARCHAR NOT NULL,
+            user_id BIGINT NOT NULL,
+            due_at TIMESTAMP WITH TIME ZONE NOT NULL,
+            PRIMARY KEY (kind, key)
+        )
+    """))
+    connection.execute(text("CREATE INDEX ix_deadlines_due_at ON deadlines (due_at)"))
+
+def downgrade(connection: Connection):
+    connection.execute(text("DROP TABLE deadlines"))
@@ -0,0 +1,29 @@
+"""
+Tables of the Postgres context store (`CONTEXT_STORE=postgres`) shared by all processes of the service.
+"""
+from sqlalchemy import Connection, text
+
+
+def upgrade(connection: Connection):
+    connection.execute(text("""
+        CREATE TABLE order_offers (
+            id VARCHAR PRIMARY KEY,
+            winner BIGINT,
+            pending BIGINT[] NOT NULL DEFAULT '{}',
+            created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+        )
+    """))
+    connection.execute(text("""
+        CREATE TABLE order_contexts (
+            user_id BIGINT PRIMARY KEY,
+            order_id VARCHAR,
+            offer_id VARCHAR,
+            notification JSONB,
+            support_message JSONB,
+            updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+        )
+    """))
+
+def downgrade(connection: Connection):
+    connection.execute(text("DROP TABLE order_contexts"))
+    connection.execute(text("DROP TABLE order_offers"))
@@ -0,0 +1,26 @@
+"""
+Append-only ledger of balance changes, opened with the balances users have at the time.
+"""
+from sqlalchemy import Connection, text
+
+
+def upgrade(connection: Connection):
+    connection.execute(text("""
+        CREATE TABLE ledger_entries (
+            id BIGSERIAL PRIMARY KEY,
+            created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+            user_id BIGINT NOT NULL REFERENCES users (id),
+            kind VARCHAR NOT NULL,
+            order_id VARCHAR,
+            balance_delta NUMERIC(20, 8) NOT NULL,
+            frozen_delta NUMERIC(20, 8) NOT NULL
+        )
+    """))
+    connection.execute(text("CREATE INDEX ix_ledger_entries_user_id ON ledger_entries (user_id, id)"))
+    connection.execute(text("""
+        INSERT INTO ledger_entries (user_id, kind, balance_delta, frozen_delta)
+        SELECT id, 'opening', balance, frozen_balance FROM users WHERE balance <> 0 OR frozen_balance <> 0
+    """))
+
+def downgrade(connection: Connection):
+    connection.execute(text("DROP TABLE ledger_entries"))
@@ -0,0 +1,27 @@
+"""
+Orders placed asynchronously, whose status is pushed to the client.
+"""
+from sqlalchemy import Connection, text
+
+
+def upgrade(connection: Connection):
+    connection.execute(text("""
+        CREATE TABLE order_placements (
+            id VARCHAR PRIMARY KEY,
+            created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+            updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+            status VARCHAR NOT NULL,
+            quantity NUMERIC(20, 8) NOT NULL,
+            currency VARCHAR NOT NULL,
+            callback_url VARCHAR,
+            order_id VARCHAR,
+            price NUMERIC(20, 8),
+            account_id BIGINT,
+            card VARCHAR,
+            detail VARCHAR
+        )
+    """))
+    connection.execute(text("CREATE INDEX ix_order_placements_order_id ON order_placements (order_id)"))
+
+def downgrade(connection: Connection):
+    connection.execute(text("DROP TABLE order_placements"))
@@ -0,0 +1,24 @@
+"""
+Responses replayed to retries of requests made with an `Idempotency-Key` header.
+"""
+from sqlalchemy import Connection, text
+
+
+def upgrade(connection: Connection):
+    connection.execute(text("""
+        CREATE TABLE idempotency_keys (
+            scope VARCHAR NOT NULL,
+            key VARCHAR NOT NULL,
+            fingerprint VARCHAR NOT NULL,
+            created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+            expires_at TIMESTAMP WITH TIME ZONE NOT NULL,
+            status_code INTEGER,
+            headers JSONB,
+            body TEXT,
+            PRIMARY KEY (scope, key)
+        )
+    """))
+    connection.execute(text("CREATE INDEX ix_idempotency_keys_expires_at ON idempotency_keys (expires_at)"))
+
+def downgrade(connection: Connection):
+    connection.execute(text("DROP TABLE idempotency_keys"))
@@ -0,0 +1,22 @@
+"""
+Orders split across makers. Every part is a child order of the client's parent order.
+"""
+from sqlalchemy import Connection, text
+
+
+def upgrade(connection: Connection):
+    connection.execute(text("""
+        CREATE TABLE parent_orders (
+            id VARCHAR PRIMARY KEY,
+            created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+            quantity NUMERIC(20, 8) NOT NULL,
+            currency VARCHAR NOT NULL,
+            filled NUMERIC(20, 8) NOT NULL DEFAULT 0
+        )
+    """))
+    connection.execute(text("ALTER TABLE orders ADD COLUMN parent_id VARCHAR REFERENCES parent_orders (id)"))
+    connection.execute(text("CREATE INDEX ix_orders_parent_id ON orders (parent_id) WHERE parent_id IS NOT NULL"))
+
+def downgrade(connection: Connection):
+    connection.execute(text("ALTER TABLE orders DROP COLUMN parent_id"))
+    connection.execute(text("DROP TABLE parent_orders"))
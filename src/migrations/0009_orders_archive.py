@@ -0,0 +1,30 @@
+"""
+Archive of finished orders moved out of `orders`, so that it only holds the orders in flight.
+"""
+from sqlalchemy import Connection, text
+
+
+def upgrade(connection: Connection):
+    connection.execute(text("""
+        CREATE TABLE orders_archive (
+            id VARCHAR PRIMARY KEY,
+            created_at TIMESTAMP WITH TIME ZONE NOT NULL,
+            status VARCHAR NOT NULL,
+            price NUMERIC(20, 8) NOT NULL,
+            quantity NUMERIC(20, 8) NOT NULL,
+            paid_at TIMESTAMP WITH TIME ZONE,
+            user_id BIGINT,
+            parent_id VARCHAR,
+            archived_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+        )
+    """))
+    connection.execute(text("CREATE INDEX ix_orders_archive_user_id ON orders_archive (user_id, created_at)"))
+    connection.execute(text("CREATE INDEX ix_orders_archive_created_at ON orders_archive (created_at)"))
+
+def downgrade(connection: Connection):
+    # Archived orders are moved back rather than lost.
+    connection.execute(text("""
+        INSERT INTO orders (id, created_at, status, price, quantity, paid_at, user_id, parent_id)
+        SELECT id, created_at, status, price, quantity, paid_at, user_id, parent_id FROM orders_archive
+    """))
+    connection.execute(text("DROP TABLE orders_archive"))
@@ -0,0 +1,17 @@
+"""
+Watermarks of incremental background jobs, e.g. the last ledger entry reconciled.
+"""
+from sqlalchemy import Connection, text
+
+
+def upgrade(connection: Connection):
+    connection.execute(text("""
+        CREATE TABLE watermarks (
+            name VARCHAR PRIMARY KEY,
+            value BIGINT NOT NULL,
+            updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+        )
+    """))
+
+def downgrade(connection: Connection):
+    connection.execute(text("DROP TABLE watermarks"))
@@ -0,0 +1,82 @@
+"""
+Versioned schema migrations.
+
+Migrations are modules of this package named `<version>_<name>.py` that define `upgrade(connection)` and `downgrade(connection)`.
+Every migration runs in its own transaction along with recording its version in `schema_migrations`,
+unless it defines `transactional = False`, e.g. to create indexes concurrently.
+"""
+import importlib
+import logging
+import pkgutil
+import re
+from types import ModuleType
+from typing import List, Optional
+
+from sqlalchemy import Engine, text
+
+
+class Migration:
+    def __init__(self, version: int, name: str, module: ModuleType):
+        self.version = version
+        self.name = name
+        self.module = module
+
+    @property
+    def transactional(self) -> bool:
+        return getattr(self.module, 'transactional', True)
+
+    def __repr__(self) -> str:
+        return f"{self.version:04d}_{self.name}"
+
+
+def migrations() -> List[Migration]:
+    found = []
+    for module_info in pkgutil.iter_modules(__path__):
+        if match := re.fullmatch(r'(\d+)_(\w+)', module_info.name):
+            found.append(Migration(int(match[1]), match[2], importlib.import_module(f"{__name__}.{module_info.name}")))
+    return sorted(found, key=lambda migration: migration.version)
+
+def applied(engine: Engine) -> List[int]:
+    with engine.begin() as connection:
+        connection.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "version INTEGER PRIMARY KEY, "
+            "name VARCHAR NOT NULL, "
+            "applied_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now())"
+        ))
+        return connection.execute(text("SELECT version FROM schema_migrations ORDER BY version")).scalars().all()
+
+def current(engine: Engine) -> Optional[int]:
+    versions = applied(engine)
+    return versions[-1] if versions else None
+
+def pending(engine: Engine) -> List[Migration]:
+    versions = set(applied(engine))
+    return [migration for migration in migrations() if migration.version not in versions]
+
+def upgrade(engine: Engine, target: Optional[int] = None):
+    for migration in pending(engine):
+        if target is not None and migration.version > target:
+            break
+        logging.info(f"Applying migration {migration}")
+        _run(engine, migration, migration.module.upgrade, "INSERT INTO schema_migrations (version, name) VALUES (:version, :name)")
+
+def downgrade(engine: Engine, target: int):
+    versions = set(applied(engine))
+    for migration in reversed(migrations()):
+        if migration.version <= target:
+            break
+        if migration.version in versions:
+            logging.info(f"Reverting migration {migration}")
+            _run(engine, migration, migration.module.downgrade, "DELETE FROM schema_migrations WHERE version = :version")
+
+def _run(engine: Engine, migration: Migration, step, record: str):
+    parameters = {"version": migration.version, "name": migration.name}
+    if migration.transactional:
+        with engine.begin() as connection:
+            step(connection)
+            connection.execute(text(record), parameters)
+    else:
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+            step(connection)
+            connection.execute(text(record), parameters)
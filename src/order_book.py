@@ -0,0 +1,180 @@
+from asyncio import sleep
+from bisect import bisect_left, insort
+from decimal import Decimal
+import logging
+from typing import Callable, Iterator, Optional
+
+from sqlalchemy import select
+from database import AsyncSessionFactory, Currency, Order, User, busy_makers
+
+
+class OrderBook:
+    """
+    In-memory book of makers eligible for accepting orders.
+
+    Makers are kept per `Currency` sorted by exchange rate, so looking up candidates for an order doesn't need a database round trip.
+    The book is updated incrementally by the handlers changing a maker's state and periodically synced with the database.
+    """
+    def __init__(self):
+        # Detached snapshots of all known users.
+        self._makers: dict[int, User] = {}
+        # Users that have an order which isn't completed yet.
+        self._busy: set[int] = set()
+        # (exchange_rate, user_id) of working makers without an active order sorted in ascending order.
+        self._books: dict[Currency, list[tuple[Decimal, int]]] = {currency: [] for currency in Currency}
+        # Version of the last incremental update per user. Lets sync skip users updated while it was loading.
+        self._versions: dict[int, int] = {}
+        self._version = 0
+        # Called with the ID of every incrementally updated user. Lets other processes follow the changes.
+        self.on_change: Optional[Callable[[int], None]] = None
+
+    def update(self, user: User, busy: Optional[bool] = None):
+        """
+        Updates maker's snapshot from `user`.
+
+        Args:
+            user (User): User whose state has changed
+            busy (Optional[bool]): Whether the user has an order which isn't completed yet. Unchanged if None
+        """
+        self._unlist(user.id)
+        self._makers[user.id] = self._snapshot(user)
+        if busy is not None:
+            self._set_busy(user.id, busy)
+        self._list(user.id)
+        self._touch(user.id)
+        if self.on_change:
+            self.on_change(user.id)
+
+    def set_busy(self, user_id: int, busy: bool):
+        self._unlist(user_id)
+        self._set_busy(user_id, busy)
+        self._list(user_id)
+        self._touch(user_id)
+        if self.on_change:
+            self.on_change(user_id)
+
+    async def refresh(self, user_id: int) -> Optional[User]:
+        """
+        Reloads a single maker changed elsewhere, e.g. by another process.
+
+        Returns:
+            Optional[User]: Reloaded user, if it exists
+        """
+        async with AsyncSessionFactory() as session:
+            user = await session.get(User, user_id)
+            busy = await session.scalar(busy_makers().filter(Order.user_id == user_id)) is not None
+
+        if user:
+            self._unlist(user_id)
+            self._makers[user_id] = self._snapshot(user)
+            self._set_busy(user_id, busy)
+            self._list(user_id)
+            self._touch(user_id)
+        return user
+
+    def eligible(self, user_id: int, quantity: Decimal) -> Optional[User]:
+        """
+        Returns the maker's snapshot if the maker is eligible for accepting an order for `quantity` USDT.
+        """
+        maker = self._makers.get(user_id)
+        if maker and self._is_listed(maker) and maker.balance >= quantity:
+            return maker
+        return None
+
+    def candidates(self, currency: Currency, quantity: Decimal) -> Iterator[User]:
+        """
+        Yields makers eligible for accepting an order for `quantity` USDT for `currency` starting from the lowest exchange rate.
+
+        Eligibility is rechecked on every step as the book may change while the caller awaits between them.
+        """
+        for _, user_id in list(self._books[Currency(currency)]):
+            if maker := self.eligible(user_id, quantity):
+                yield maker
+
+    async def sync(self):
+        """
+        Reconciles the book with the database.
+        """
+        version = self._version
+        async with AsyncSessionFactory() as session:
+            users = (await session.scalars(select(User))).all()
+            busy = set((await session.scalars(busy_makers())).all())
+
+        initial = not self._makers
+        discrepancies = 0
+        for user in users:
+            # Updated incrementally after the state was loaded, thus fresher than the loaded one.
+            if self._versions.get(user.id, 0) > version:
+                continue
+            if not self._matches(user, user.id in busy):
+                discrepancies += 1
+                self._unlist(user.id)
+                self._makers[user.id] = self._snapshot(user)
+                self._set_busy(user.id, user.id in busy)
+                self._list(user.id)
+
+        if initial:
+            logging.info(f"{OrderBook.__name__} loaded {len(users)} users.")
+        elif discrepancies:
+            logging.warning(f"{OrderBook.__name__} was out of sync with the database for {discrepancies} users.")
+
+    async def run_sync(self, interval: float):
+        while True:
+            await sleep(interval)
+            try:
+                await self.sync()
+            except Exception as e:
+                logging.error(f"Error syncing {OrderBook.__name__}: {e}", exc_info=True)
+
+    def _touch(self, user_id: int):
+        self._version += 1
+        self._versions[user_id] = self._version
+
+    def _set_busy(self, user_id: int, busy: bool):
+        if busy:
+            self._busy.add(user_id)
+        else:
+            self._busy.discard(user_id)
+
+    def _is_listed(self, maker: User) -> bool:
+        return maker.is_working and maker.id not in self._busy and maker.currency in Currency.__members__ and maker.exchange_rate is not None
+
+    def _list(self, user_id: int):
+        maker = self._makers.get(user_id)
+        if maker and self._is_listed(maker):
+            insort(self._books[Currency(maker.currency)], (maker.exchange_rate, maker.id))
+
+    def _unlist(self, user_id: int):
+        maker = self._makers.get(user_id)
+        if maker and self._is_listed(maker):
+            book = self._books[Currency(maker.currency)]
+            key = (maker.exchange_rate, maker.id)
+            index = bisect_left(book, key)
+            if index < len(book) and book[index] == key:
+                del book[index]
+
+    def _matches(self, user: User, busy: bool) -> bool:
+        maker = self._makers.get(user.id)
+        return (maker is not None
+                and (maker.id in self._busy) == busy
+                and maker.is_working == user.is_working
+                and maker.currency == user.currency
+                and maker.exchange_rate == user.exchange_rate
+                and maker.balance == user.balance
+                and maker.frozen_balance == user.frozen_balance)
+
+    @staticmethod
+    def _snapshot(user: User) -> User:
+        return User(
+            id=user.id,
+            name=user.name,
+            card=user.card,
+            balance=user.balance,
+            frozen_balance=user.frozen_balance,
+            exchange_rate=user.exchange_rate,
+            currency=user.currency,
+            is_working=user.is_working
+        )
+
+
+order_book = OrderBook()
@@ -1,111 +1,173 @@
-from asyncio import CancelledError, Event, Lock, create_task, sleep
-from typing import Mapping, Optional, Self
+from typing import Optional, Self
 
 from telegram import Message
 from config import FROZEN_BALANCE_COOLDOWN
-from database import Order, OrderStatus, SessionFactory
+from context_store import ContextState, LockScope, OrderOffer, store
+from sqlalchemy import select
+from database import AsyncSessionFactory, DeadlineKind, LedgerEntryKind, Order, OrderStatus, PlacementStatus
+import ledger
+import metrics
+import templates
+from dispatcher import Priority, dispatcher
+from leaderboard import leaderboard
+from order_book import order_book
+from placements import placements
+from scheduler import scheduler
 import logging
 
 class OrderContext:
-    def __init__(self, user_id: int, ocm: 'OrderContextManager'):
-        self._order_id = None
+    def __init__(self, user_id: int, ocm: 'OrderContextManager', state: ContextState):
         self.order = None
         self._user_id = user_id
-        self._lock = Lock()
-        self.handle_event = Event()
+        self._lock = None
+        # Connection holding the lock while entered, if the store locks in the database.
+        self._connection = None
         self.session = None
-        self.notification: Message = None
-        self.support_message: Message = None
-        self._client_completion_waiter = None
         self._ocm = ocm
+        self._restore(state)
+
+    @property
+    def state(self) -> ContextState:
+        return ContextState(self._order_id, self.offer, self.notification, self.support_message)
+
+    def _restore(self, state: ContextState):
+        self._state = state
+        self._order_id: Optional[str] = state.order_id
+        self.offer: Optional[OrderOffer] = state.offer
+        self.notification: Optional[Message] = state.notification
+        self.support_message: Optional[Message] = state.support_message
 
     async def __aenter__(self) -> Self:
-        await self._lock.acquire()
+        self._lock = store.lock(LockScope.CONTEXT, self._user_id)
+        with metrics.lock_wait_seconds.time(scope='context'):
+            self._connection = await self._lock.__aenter__()
         try:
-            self.session = SessionFactory()
+            # The state might have been changed by the previous holder of the lock, possibly in another process.
+            if state := await store.load(self._user_id, self._connection):
+                self._restore(state)
+            self.session = AsyncSessionFactory(bind=self._connection) if self._connection else AsyncSessionFactory()
             if self._order_id:
-                self.order = self.session.query(Order).filter_by(id=self._order_id).one()
+                self.order = (await self.session.scalars(select(Order).filter_by(id=self._order_id))).one()
         except Exception as e:
             logging.error(f"Error during OrderContext __aenter__ for user {self._user_id}: {e}", exc_info=True)
+            await self.__aexit__(type(e), e, e.__traceback__)
             raise
         return self
     
     async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
         try:
-            if exc_type is not None:
-                if self.session:
-                    logging.debug(f"Rolling back session for user {self._user_id} due to exception: {exc_type}")
-                    self.session.rollback()
-                self.session.rollback()
+            if self.session:
+                if exc_type is not None:
+                    logging.debug("Rolling back session due to exception %s.", exc_type, extra={"user_id": self._user_id})
+                    await self.session.rollback()
+                # Ends the session's transaction on the lock's connection, which the state is saved on.
+                await self.session.close()
+                self.session = None
+            # Only the changed state is saved, so that a context removed under the lock isn't written back.
+            if exc_type is None and self.state != self._state:
+                await store.save(self._user_id, self.state, self._connection)
+                self._state = self.state
         finally:
             if self.session:
-                self.session.close()
+                await self.session.close()
                 self.session = None
-            self._lock.release()
+            self._connection = None
+            await self._lock.__aexit__(exc_type, exc_val, exc_tb)
 
-    async def start_client_completion_waiter(self):
-        self._client_completion_waiter = create_task(self.client_completion_waiter())
+    async def dangling(self) -> bool:
+        """
+        Whether the context outlived its order, i.e. the order is gone or COMPLETED. Checked without the context's lock.
+        """
+        async with AsyncSessionFactory() as session:
+            order = self._order_id and await session.get(Order, self._order_id)
+        return order is None or order.status == OrderStatus.COMPLETED
 
-    async def cancel_client_completion_waiter(self):
-        try:
-            self._client_completion_waiter.cancel()
-        except:
-            pass
+    async def schedule_client_completion_timeout(self):
+        await scheduler.schedule(DeadlineKind.CLIENT_COMPLETION, FROZEN_BALANCE_COOLDOWN, (self._order_id, self._user_id))
 
-    async def client_completion_waiter(self):
-        try:
-            await sleep(FROZEN_BALANCE_COOLDOWN)
-            async with self:
-                order = self.order
-                if order.status == OrderStatus.ACCEPTED:
-                    order.user.balance += order.quantity
-                    order.user.frozen_balance -= order.quantity
-                    self.session.delete(order)
-                    self.session.commit()
-                    
-                    self._ocm.remove_context()
-                    await self.notification.edit_text(f"{self.notification.text_markdown_v2}\n\nКлиент не совершил перевод по ордеру вовремя\nОрдер отменён\nБаланс разморожен", parse_mode="MarkdownV2")
-                elif order.status == OrderStatus.COMPLETED:
-                    logging.error(f"Client completion waiter triggered for completed order ({order.id}) for user {self.order.user.id}")
-        except CancelledError:
-            pass
+    async def cancel_client_completion_timeout(self):
+        await scheduler.cancel(DeadlineKind.CLIENT_COMPLETION, self._order_id)
 
+    async def client_completion_timeout(self):
+        async with self:
+            order = self.order
+            # Client might have paid while the deadline was firing.
+            if order.status == OrderStatus.ACCEPTED and order.paid_at is None:
+                await ledger.post(self.session, ledger.entry(LedgerEntryKind.UNFREEZE, order.user_id, order.quantity, order.id))
+                await self.session.delete(order)
+                await self.session.commit()
+                order_book.update(order.user, busy=False)
+                leaderboard.update(order.user)
+                
+                await self._ocm.remove_context()
+                metrics.order_outcomes_total.inc(outcome='cancelled')
+                if self.notification:
+                    dispatcher.edit_text(self.notification, templates.CLIENT_TIMEOUT_NOTICE.render(text=self.notification.text_markdown_v2), Priority.ORDER, parse_mode="MarkdownV2")
+                else:
+                    # Context was recovered without its notification.
+                    dispatcher.send_message(self._user_id, templates.CLIENT_TIMEOUT.render(order_id=order.id), Priority.ORDER, parse_mode="MarkdownV2")
+                await placements.transition(PlacementStatus.CANCELLED, by_order=order.id, detail="Client didn't pay in time.")
+            elif order.status == OrderStatus.COMPLETED:
+                logging.error(f"Client completion timeout triggered for completed order ({order.id}) for user {self.order.user.id}")
 
-class OrderContextManager:
-    global_lock = Lock()
 
+class OrderContextManager:
     @classmethod
-    async def get(cls, user_id: int, user_data: Mapping[int, dict[str, dict]]) -> 'OrderContextManager':
+    async def get(cls, user_id: int) -> 'OrderContextManager':
+        # Not locked, as managers aren't shared. Exclusion per user is up to `async with`.
         try:
-            async with cls.global_lock:
-                return user_data[user_id].setdefault(OrderContextManager.__name__, OrderContextManager(user_id, user_data))
+            ocm = OrderContextManager(user_id)
+            await ocm._load()
+            return ocm
         except Exception as e:
             logging.error(f"Error getting {OrderContextManager.__name__} for user {user_id}: {e}", exc_info=True)
             raise
         
-    def __init__(self, id: int, user_data: Mapping[int, dict[str, dict]]):
-        self._lock = Lock()
+    def __init__(self, id: int):
+        self._lock = None
+        # Connection holding the lock while entered, if the store locks in the database.
+        self._connection = None
         self.id = id
-        self.user_data = user_data
+        self._context: Optional[OrderContext] = None
 
     # Locks seting/getting `OrderContext` this `OrderContextManager` manages.
     async def __aenter__(self) -> Self:
-        await self._lock.acquire()
+        self._lock = store.lock(LockScope.MANAGER, self.id)
+        with metrics.lock_wait_seconds.time(scope='manager'):
+            self._connection = await self._lock.__aenter__()
+        try:
+            # Might have been changed since `get`.
+            await self._load()
+        except BaseException as e:
+            self._connection = None
+            await self._lock.__aexit__(type(e), e, e.__traceback__)
+            raise
         return self
     
     async def __aexit__(self, exc_type, exc_value, traceback):
-        self._lock.release()
+        self._connection = None
+        await self._lock.__aexit__(exc_type, exc_value, traceback)
     
     @property
     def context(self) -> Optional[OrderContext]:
-        return self.user_data[self.id].get(OrderContext.__name__)
+        return self._context
     
-    def create_context(self) -> OrderContext:
-        return self.user_data[self.id].setdefault(OrderContext.__name__, OrderContext(self.id, self))
+    async def create_context(self) -> Optional[OrderContext]:
+        """
+        Creates the context, None if the user already has one, possibly created by another process.
+        """
+        if (state := await store.create(self.id, self._connection)) is None:
+            return None
+        self._context = OrderContext(self.id, self, state)
+        return self._context
     
-    def remove_context(self):
-        logging.debug(f"Removing {OrderContext.__name__} for user {self.id}")
-        if self.user_data[self.id].pop(OrderContext.__name__, None) is None:
+    async def remove_context(self):
+        logging.debug("Removing OrderContext.", extra={"user_id": self.id})
+        if not await store.delete(self.id, self._connection):
             logging.error(f"Error removing {OrderContext.__name__} for user {self.id}: context not found", exc_info=True)
-        logging.debug(f"Removed {OrderContext.__name__} for user {self.id}")
-            
+        self._context = None
+        logging.debug("Removed OrderContext.", extra={"user_id": self.id})
+
+    async def _load(self):
+        state = await store.load(self.id, self._connection)
+        self._context = OrderContext(self.id, self, state) if state else None
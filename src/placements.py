@@ -0,0 +1,200 @@
+from asyncio import Event, Task, create_task, sleep, wait_for
+from contextlib import contextmanager
+from decimal import Decimal
+import logging
+from time import monotonic
+from typing import AsyncIterator, Callable, Iterator, Optional
+
+from fastapi.encoders import jsonable_encoder
+import httpx
+from sqlalchemy import func, select, update
+from config import ORDER_CALLBACK_RETRIES, ORDER_CALLBACK_TIMEOUT
+from database import AsyncSessionFactory, OrderPlacement, PlacementStatus
+from locks import LockRegistry
+
+# Statuses a placement may move to from each status.
+TRANSITIONS = {
+    PlacementStatus.ACCEPTED: (PlacementStatus.PENDING,),
+    PlacementStatus.FAILED: (PlacementStatus.PENDING,),
+    PlacementStatus.COMPLETED: (PlacementStatus.ACCEPTED,),
+    PlacementStatus.CANCELLED: (PlacementStatus.ACCEPTED,),
+}
+FINAL = (PlacementStatus.COMPLETED, PlacementStatus.FAILED, PlacementStatus.CANCELLED)
+
+
+class Placements:
+    """
+    Orders placed asynchronously, whose status changes are pushed to clients.
+
+    Clients follow a placement by long polling, SSE or a callback URL. Changes wake up the watchers of this process
+    and are announced through `on_change` to the other processes, which pass them on to `notify`.
+    Callbacks are only sent by the process making the change, one at a time per placement so that they arrive in order.
+    """
+    def __init__(self, callback_timeout: float, callback_retries: int):
+        self._callback_timeout = callback_timeout
+        self._callback_retries = callback_retries
+        self._client: Optional[httpx.AsyncClient] = None
+        # Events of the requests watching a placement in this process.
+        self._watchers: dict[str, set[Event]] = {}
+        self._callbacks = LockRegistry()
+        self._tasks: set[Task] = set()
+        # Called with the ID of every changed placement.
+        self.on_change: Optional[Callable[[str], None]] = None
+
+    async def create(self, quantity: Decimal, currency: str, callback_url: Optional[str] = None) -> dict:
+        async with AsyncSessionFactory() as session:
+            placement = OrderPlacement(quantity=quantity, currency=currency, callback_url=callback_url)
+            session.add(placement)
+            await session.commit()
+            return self._snapshot(placement)
+
+    async def get(self, id: str) -> Optional[dict]:
+        async with AsyncSessionFactory() as session:
+            placement = await session.get(OrderPlacement, id)
+            return placement and self._snapshot(placement)
+
+    async def transition(self, status: PlacementStatus, id: Optional[str] = None, by_order: Optional[str] = None, **values) -> Optional[dict]:
+        """
+        Moves the placement found by `id` or by the order it was accepted with to `status`, unless it's moved on already.
+
+        Failures are logged, as the order itself has changed already.
+
+        Args:
+            status (PlacementStatus): Status to move to
+            id (Optional[str]): ID of the placement
+            by_order (Optional[str]): ID of the order the placement was accepted with. Orders placed synchronously have no placement
+            values: Other columns to set
+
+        Returns:
+            Optional[dict]: Changed placement, None if there wasn't any
+        """
+        try:
+            async with AsyncSessionFactory() as session:
+                placement = (await session.scalars(
+                    update(OrderPlacement)
+                    .where(OrderPlacement.id == id if id else OrderPlacement.order_id == by_order, OrderPlacement.status.in_(TRANSITIONS[status]))
+                    .values(status=status, updated_at=func.now(), **values)
+                    .returning(OrderPlacement)
+                    .execution_options(synchronize_session=False)
+                )).one_or_none()
+                await session.commit()
+        except Exception as e:
+            logging.error(f"Error moving placement {id or by_order} to {status}: {e}", exc_info=True)
+            return None
+
+        if placement is None:
+            return None
+        snapshot = self._snapshot(placement)
+        logging.info(f"Placement is {status}.", extra={"placement_id": placement.id, "order_id": placement.order_id})
+        self.notify(placement.id)
+        if self.on_change:
+            self.on_change(placement.id)
+        if placement.callback_url:
+            task = create_task(self._call_back(placement.callback_url, snapshot))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return snapshot
+
+    async def abandon(self) -> int:
+        """
+        Fails the pending placements, whose matching died with the service. Only safe at startup.
+
+        Returns:
+            int: Number of placements failed
+        """
+        async with AsyncSessionFactory() as session:
+            ids = (await session.scalars(select(OrderPlacement.id).filter_by(status=PlacementStatus.PENDING))).all()
+        for id in ids:
+            await self.transition(PlacementStatus.FAILED, id, detail="Order placement was interrupted by a restart.")
+        return len(ids)
+
+    def notify(self, id: str):
+        for event in self._watchers.get(id, ()):
+            event.set()
+
+    async def wait(self, id: str, status: Optional[PlacementStatus], timeout: float) -> Optional[dict]:
+        """
+        Long polls the placement.
+
+        Returns:
+            Optional[dict]: Placement once its status differs from `status` or `timeout` seconds passed, None if it doesn't exist
+        """
+        deadline = monotonic() + timeout
+        with self._watching(id) as event:
+            while True:
+                # Cleared before reading, so that no change is missed.
+                event.clear()
+                placement = await self.get(id)
+                if placement is None or placement["status"] != status or (left := deadline - monotonic()) <= 0:
+                    return placement
+                try:
+                    await wait_for(event.wait(), left)
+                except TimeoutError:
+                    pass
+
+    async def watch(self, id: str, keepalive: float) -> AsyncIterator[Optional[dict]]:
+        """
+        Yields the placement now and on every change until it's final. Yields it again every `keepalive` seconds without changes.
+        """
+        with self._watching(id) as event:
+            while True:
+                event.clear()
+                placement = await self.get(id)
+                yield placement
+                if placement is None or placement["status"] in FINAL:
+                    return
+                try:
+                    await wait_for(event.wait(), keepalive)
+                except TimeoutError:
+                    pass
+
+    @contextmanager
+    def _watching(self, id: str) -> Iterator[Event]:
+        event = Event()
+        self._watchers.setdefault(id, set()).add(event)
+        try:
+            yield event
+        finally:
+            self._watchers[id].discard(event)
+            if not self._watchers[id]:
+                del self._watchers[id]
+
+    async def _call_back(self, url: str, placement: dict):
+        async with self._callbacks.hold(placement["id"]):
+            if self._client is None:
+                self._client = httpx.AsyncClient(timeout=self._callback_timeout)
+            for attempt in range(self._callback_retries + 1):
+                if attempt:
+                    await sleep(2 ** attempt)
+                try:
+                    response = await self._client.post(url, json=jsonable_encoder(placement))
+                    # Client errors won't get any better.
+                    if response.status_code < 500:
+                        if response.is_error:
+                            logging.warning(f"Callback of placement {placement['id']} to {url} was rejected with {response.status_code}.")
+                        return
+                    logging.warning(f"Callback of placement {placement['id']} to {url} failed with {response.status_code} (attempt {attempt + 1}).")
+                except httpx.HTTPError as e:
+                    logging.warning(f"Callback of placement {placement['id']} to {url} failed: {e} (attempt {attempt + 1}).")
+            logging.error(f"Gave up calling back placement {placement['id']} to {url}.")
+
+    @staticmethod
+    def _snapshot(placement: OrderPlacement) -> dict:
+        snapshot = {
+            "id": placement.id,
+            "status": placement.status,
+            "quantity": placement.quantity,
+            "currency": placement.currency,
+            "created_at": placement.created_at,
+            "updated_at": placement.updated_at,
+        }
+        if placement.order_id:
+            # Same as the response of a synchronous order.
+            snapshot["account"] = {"id": placement.account_id, "card": placement.card}
+            snapshot["order"] = {"id": placement.order_id, "price": placement.price, "quantity": placement.quantity}
+        if placement.detail:
+            snapshot["detail"] = placement.detail
+        return snapshot
+
+
+placements = Placements(ORDER_CALLBACK_TIMEOUT, ORDER_CALLBACK_RETRIES)
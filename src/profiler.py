@@ -0,0 +1,71 @@
+"""
+Sampling profiler switchable at runtime, e.g. to find what blocks the event loop in production.
+"""
+from collections import Counter
+import sys
+import threading
+from time import sleep
+from typing import Optional
+
+# Shortest interval between samples, below which sampling would keep a core busy.
+MIN_INTERVAL = 0.001
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of a thread from a background thread every `interval` seconds.
+
+    Samples are aggregated as folded stacks (`frame;frame;frame count`), the input of flame graph tools.
+    """
+    def __init__(self):
+        self._samples: Counter[str] = Counter()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        # Held while starting and stopping, which overlapping requests may do from different threads.
+        self._lock = threading.Lock()
+        self.interval: Optional[float] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self, interval: float, thread_id: Optional[int] = None):
+        """
+        Starts sampling the thread `thread_id`, the calling one by default. Samples of the previous run are discarded.
+        """
+        if interval < MIN_INTERVAL:
+            raise ValueError(f"Interval must be at least {MIN_INTERVAL}s.")
+        with self._lock:
+            self._halt()
+            self._samples = Counter()
+            self._stop.clear()
+            self.interval = interval
+            self._thread = threading.Thread(target=self._run, args=(thread_id or threading.get_ident(), interval), name=SamplingProfiler.__name__, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            self._halt()
+
+    def _halt(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def folded(self) -> str:
+        return ''.join(f"{stack} {count}\n" for stack, count in self._samples.most_common())
+
+    def _run(self, thread_id: int, interval: float):
+        while not self._stop.is_set():
+            if frame := sys._current_frames().get(thread_id):
+                stack = []
+                while frame:
+                    stack.append(f"{frame.f_code.co_name} ({frame.f_code.co_filename}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self._samples[';'.join(reversed(stack))] += 1
+            sleep(interval)
+
+
+profiler = SamplingProfiler()
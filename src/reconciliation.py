@@ -0,0 +1,139 @@
+"""
+Reconciliation of frozen balances with the orders they're reserved for.
+
+A maker's `frozen_balance` must equal the quantity of the maker's ACCEPTED orders. Every path freezing, unfreezing or settling
+an order, accepting it included, changes both in one transaction, so a mismatch means a path paired them wrongly, e.g. deleted an order without
+unfreezing it. `manage.py ledger` can't catch it, as the ledger matches the balances in that case.
+
+Users are checked in keyed batches of `RECONCILE_BATCH_SIZE`, each by a single query over `ix_orders_user_id_active`.
+Runs are incremental: only users with ledger entries posted since the last run are checked, tracked by the `reconciliation`
+watermark on `ledger_entries.id`. Entries are left to settle for `RECONCILE_LAG` first, as IDs are taken before commit and
+a later ID might become visible before an earlier one. The first run, and runs with `full`, check every user.
+
+Mismatches are reported or, with `fix`, corrected by a RECONCILE ledger entry moving the difference between the balance
+and the frozen balance, made under the users' row locks after checking them again.
+"""
+from asyncio import sleep
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+import logging
+from typing import Callable, Optional
+
+from sqlalchemy import Select, func, select
+from sqlalchemy.dialects.postgresql import insert
+from config import RECONCILE_BATCH_SIZE, RECONCILE_LAG, RECONCILE_POLICY
+from database import AsyncSessionFactory, LedgerEntry, LedgerEntryKind, Order, OrderStatus, User, Watermark
+import ledger
+import metrics
+
+WATERMARK = 'reconciliation'
+
+
+class Reconciler:
+    def __init__(self, batch_size: int, lag: float, fix: bool):
+        self._batch_size = batch_size
+        self._lag = lag
+        self._fix = fix
+        # Called with every user whose frozen balance was fixed. Lets the book and TOP follow the new balance.
+        self.on_fixed: Optional[Callable[[User], None]] = None
+
+    async def reconcile(self, full: bool = False, fix: Optional[bool] = None) -> tuple[int, list[tuple[int, Decimal, Decimal]]]:
+        """
+        Checks the users touched since the last run, or every user with `full`.
+
+        Args:
+            full (bool): Whether to check every user rather than the ones touched since the last run
+            fix (Optional[bool]): Whether to fix mismatching frozen balances. `RECONCILE_POLICY` if None
+
+        Returns:
+            tuple[int, list[tuple[int, Decimal, Decimal]]]: Users checked and (user_id, frozen balance, ACCEPTED quantity) of the mismatching ones
+        """
+        fix = self._fix if fix is None else fix
+        async with AsyncSessionFactory() as session:
+            low = await session.scalar(select(Watermark.value).where(Watermark.name == WATERMARK))
+            # Scans only the entries past the watermark.
+            high = await session.scalar(
+                select(func.max(LedgerEntry.id))
+                .where(LedgerEntry.id > (low or 0), LedgerEntry.created_at < datetime.now(timezone.utc) - timedelta(seconds=self._lag))
+            )
+        if low is None or full:
+            users = select(User.id.label('id'))
+        elif high is None:
+            return 0, []
+        else:
+            users = select(LedgerEntry.user_id.label('id')).where(LedgerEntry.id > low, LedgerEntry.id <= high).distinct()
+        users = users.subquery()
+
+        checked = 0
+        discrepancies = []
+        after = None
+        while True:
+            async with AsyncSessionFactory() as session:
+                batch = select(users.c.id).order_by(users.c.id).limit(self._batch_size)
+                ids = (await session.scalars(batch if after is None else batch.where(users.c.id > after))).all()
+                if not ids:
+                    break
+                rows = (await session.execute(mismatches(ids))).all()
+            checked += len(ids)
+            after = ids[-1]
+            if rows and fix:
+                rows = await self._correct([row.id for row in rows])
+            for user_id, frozen_balance, accepted in rows:
+                logging.warning(f"Frozen balance {frozen_balance} doesn't match ACCEPTED orders for {accepted}{' and was fixed' if fix else ''}.", extra={"user_id": user_id})
+            metrics.reconcile_discrepancies_total.inc(len(rows), action='fixed' if fix else 'reported')
+            discrepancies.extend(tuple(row) for row in rows)
+        metrics.reconcile_users_checked_total.inc(checked)
+
+        if high is not None:
+            async with AsyncSessionFactory() as session:
+                upsert = insert(Watermark).values(name=WATERMARK, value=high, updated_at=func.now())
+                await session.execute(upsert.on_conflict_do_update(index_elements=[Watermark.name], set_={"value": upsert.excluded.value, "updated_at": upsert.excluded.updated_at}))
+                await session.commit()
+        return checked, discrepancies
+
+    async def run(self, interval: float):
+        while True:
+            await sleep(interval)
+            try:
+                checked, discrepancies = await self.reconcile()
+                logging.info(f"Reconciled frozen balances of {checked} users, {len(discrepancies)} didn't match.")
+            except Exception as e:
+                logging.error(f"Error reconciling frozen balances: {e}", exc_info=True)
+
+    async def _correct(self, ids: list[int]) -> list[tuple[int, Decimal, Decimal]]:
+        """
+        Fixes the frozen balances of the users that still don't match once locked.
+
+        Returns:
+            list[tuple[int, Decimal, Decimal]]: (user_id, frozen balance, ACCEPTED quantity) of the fixed users before the fix
+        """
+        async with AsyncSessionFactory() as session:
+            # Holds off freezing, unfreezing and settling their orders, which update the same rows, until the fix is committed.
+            users = {user.id: user for user in (await session.scalars(select(User).where(User.id.in_(ids)).order_by(User.id).with_for_update())).all()}
+            rows = (await session.execute(mismatches(ids))).all()
+            await ledger.post(session, *(ledger.entry(LedgerEntryKind.RECONCILE, row.id, row.accepted - row.frozen_balance) for row in rows))
+            await session.commit()
+
+        if self.on_fixed:
+            for row in rows:
+                self.on_fixed(users[row.id])
+        return [tuple(row) for row in rows]
+
+
+def mismatches(ids: list[int]) -> Select:
+    """
+    (id, frozen_balance, accepted) of the users whose frozen balance doesn't match the quantity of their ACCEPTED orders.
+    """
+    accepted = func.coalesce(func.sum(Order.quantity), 0)
+    return (
+        select(User.id, User.frozen_balance, accepted.label('accepted'))
+        .select_from(User)
+        .outerjoin(Order, (Order.user_id == User.id) & (Order.status == OrderStatus.ACCEPTED))
+        .where(User.id.in_(ids))
+        .group_by(User.id)
+        .having(User.frozen_balance != accepted)
+        .order_by(User.id)
+    )
+
+
+reconciler = Reconciler(RECONCILE_BATCH_SIZE, RECONCILE_LAG, RECONCILE_POLICY == 'fix')
@@ -0,0 +1,100 @@
+"""
+Startup recovery of the orders left active by the previous run of the service.
+
+Offers die with the process waiting on them, so PENDING orders are expired as if their makers didn't respond in time.
+ACCEPTED orders get their `OrderContext` and client completion deadline back, so that the handlers resume them as usual.
+Orders are streamed in batches from `ix_orders_status`, thus recovery costs the same regardless of the number of completed orders.
+"""
+from asyncio import gather
+import logging
+from typing import List
+
+from sqlalchemy import delete, select
+from config import FROZEN_BALANCE_COOLDOWN, ORDER_FEE
+from context_store import store
+from database import AsyncSessionFactory, DeadlineKind, LedgerEntryKind, Order, OrderStatus
+from dispatcher import Priority, dispatcher
+from formatting_helper import FormattingHelper
+import ledger
+import metrics
+import templates
+from order_manager import OrderContextManager
+from placements import placements
+from scheduler import scheduler
+
+
+async def recover(batch_size: int):
+    """
+    Recovers active orders. Must run in the primary process after `scheduler.load` and before the book is synced and any order is placed.
+
+    Args:
+        batch_size (int): Orders fetched and processed at a time
+    """
+    expired = restored = 0
+    async with AsyncSessionFactory() as session:
+        result = await session.stream_scalars(
+            select(Order)
+            .filter(Order.status.in_([OrderStatus.PENDING, OrderStatus.ACCEPTED]))
+            .execution_options(yield_per=batch_size)
+        )
+        async for orders in result.partitions():
+            pending = [order for order in orders if order.status == OrderStatus.PENDING]
+            accepted = [order for order in orders if order.status == OrderStatus.ACCEPTED]
+            await expire(pending)
+            await restore(accepted)
+            expired += len(pending)
+            restored += len(accepted)
+
+    await store.discard_offers()
+    abandoned = await placements.abandon()
+    logging.info(f"Recovered orders: {expired} pending expired, {restored} accepted restored, {abandoned} placements failed.")
+
+async def expire(orders: List[Order]):
+    if not orders:
+        return
+
+    async with AsyncSessionFactory() as session:
+        await ledger.post(session, *(ledger.entry(LedgerEntryKind.FEE, order.user_id, ORDER_FEE, order.id) for order in orders))
+        await session.execute(delete(Order).filter(Order.id.in_([order.id for order in orders])))
+        await session.commit()
+    await scheduler.cancel(DeadlineKind.ORDER_EXPIRY, *[order.id for order in orders])
+    metrics.order_outcomes_total.inc(len(orders), outcome='expired')
+    metrics.order_fees_total.inc(len(orders))
+    await gather(*(discard_context(order) for order in orders))
+
+async def discard_context(order: Order):
+    try:
+        async with await OrderContextManager.get(order.user_id) as ocm:
+            if not (oc := ocm.context) or oc._order_id != order.id:
+                return
+            if oc.notification:
+                dispatcher.edit_text(oc.notification, templates.OFFER_EXPIRED.render(order_id=order.id, fee=FormattingHelper.quantize(ORDER_FEE, 8)), Priority.ORDER, reply_markup=None, parse_mode="MarkdownV2")
+            await ocm.remove_context()
+    except Exception as e:
+        logging.error(f"Error discarding context of expired order {order.id} of user {order.user_id}: {e}", exc_info=True)
+
+async def restore(orders: List[Order]):
+    if not orders:
+        return
+
+    await gather(*(restore_context(order) for order in orders))
+    # Deadlines of orders accepted before they were persisted.
+    if targets := [(order.id, order.user_id) for order in orders if order.paid_at is None and not scheduler.is_scheduled(DeadlineKind.CLIENT_COMPLETION, order.id)]:
+        await scheduler.schedule(DeadlineKind.CLIENT_COMPLETION, FROZEN_BALANCE_COOLDOWN, *targets)
+
+async def restore_context(order: Order):
+    try:
+        async with await OrderContextManager.get(order.user_id) as ocm:
+            if (oc := ocm.context) and oc._order_id == order.id:
+                return
+            if oc:
+                logging.error(f"User {order.user_id} has context of order {oc._order_id} instead of accepted order {order.id}. Replacing it.")
+                await ocm.remove_context()
+
+            if (oc := await ocm.create_context()) is None:
+                logging.error(f"User {order.user_id} got a context meanwhile. Accepted order {order.id} isn't restored.")
+                return
+            async with oc:
+                oc._order_id = order.id
+    except Exception as e:
+        logging.error(f"Error restoring context of accepted order {order.id} of user {order.user_id}: {e}", exc_info=True)
@@ -0,0 +1,150 @@
+"""
+Order history and per-maker aggregates exported for reporting.
+
+Rows are streamed from a server-side cursor and encoded `EXPORT_BATCH_SIZE` at a time, so exporting months of orders
+takes as much memory as a few rows. Orders are read from both `orders` and `orders_archive`.
+
+Aggregates are computed in SQL from the ledger, as only orders that were completed or are in flight are kept:
+- accepted, completed, cancelled and expired are the maker's FREEZE, SETTLE, UNFREEZE and FEE entries
+- volume is the USDT settled by the completed orders
+- fill rate is the share of the offers the maker accepted or let expire that were completed. Declined offers leave no trace
+- accept latency is the time from the creation of the order to its FREEZE, for the orders still kept
+"""
+import csv
+from datetime import datetime
+from decimal import Decimal
+from enum import Enum
+import io
+import json
+from typing import Any, AsyncIterator, Optional, Sequence, TextIO
+
+from sqlalchemy import Connection, Numeric, Row, Select, cast, func, select, union_all
+from config import EXPORT_BATCH_SIZE
+from database import ArchivedOrder, AsyncSessionFactory, Currency, LedgerEntry, LedgerEntryKind, Order, OrderStatus, User
+
+
+class ExportFormat(str, Enum):
+    CSV = "csv"
+    NDJSON = "ndjson"
+
+    @property
+    def media_type(self) -> str:
+        return "text/csv" if self is ExportFormat.CSV else "application/x-ndjson"
+
+
+def history() -> Select:
+    """
+    Orders in flight and archived alike.
+    """
+    columns = ('id', 'created_at', 'status', 'price', 'quantity', 'paid_at', 'user_id', 'parent_id')
+    return union_all(
+        select(*[getattr(Order, name) for name in columns]),
+        select(*[getattr(ArchivedOrder, name) for name in columns]),
+    ).subquery('history')
+
+def orders(user_id: Optional[int] = None, status: Optional[OrderStatus] = None, currency: Optional[Currency] = None, since: Optional[datetime] = None, until: Optional[datetime] = None) -> Select:
+    """
+    Orders created in [`since`, `until`) by creation time. The currency is the maker's.
+    """
+    orders = history()
+    statement = (
+        select(orders.c.id, orders.c.created_at, orders.c.status, orders.c.user_id, User.currency, orders.c.price, orders.c.quantity, orders.c.paid_at, orders.c.parent_id)
+        .join(User, User.id == orders.c.user_id)
+        .order_by(orders.c.created_at, orders.c.id)
+    )
+    if user_id is not None:
+        statement = statement.where(orders.c.user_id == user_id)
+    if status is not None:
+        statement = statement.where(orders.c.status == status)
+    if currency is not None:
+        statement = statement.where(User.currency == currency)
+    if since is not None:
+        statement = statement.where(orders.c.created_at >= since)
+    if until is not None:
+        statement = statement.where(orders.c.created_at < until)
+    return statement
+
+def makers(user_id: Optional[int] = None, currency: Optional[Currency] = None, since: Optional[datetime] = None, until: Optional[datetime] = None) -> Select:
+    """
+    Aggregates per maker of the ledger entries posted in [`since`, `until`).
+    """
+    orders = history()
+    def count(kind: LedgerEntryKind):
+        return func.count().filter(LedgerEntry.kind == kind)
+
+    accepted = count(LedgerEntryKind.FREEZE)
+    completed = count(LedgerEntryKind.SETTLE)
+    expired = count(LedgerEntryKind.FEE)
+    statement = (
+        select(
+            User.id.label('user_id'),
+            User.name,
+            User.currency,
+            accepted.label('accepted'),
+            completed.label('completed'),
+            count(LedgerEntryKind.UNFREEZE).label('cancelled'),
+            expired.label('expired'),
+            func.coalesce(-func.sum(LedgerEntry.frozen_delta).filter(LedgerEntry.kind == LedgerEntryKind.SETTLE), 0).label('volume'),
+            func.round(cast(completed, Numeric) / func.nullif(accepted + expired, 0), 4).label('fill_rate'),
+            func.round(func.avg(func.extract('epoch', LedgerEntry.created_at - orders.c.created_at)).filter(LedgerEntry.kind == LedgerEntryKind.FREEZE), 3).label('avg_accept_seconds'),
+        )
+        .select_from(LedgerEntry)
+        .join(User, User.id == LedgerEntry.user_id)
+        .outerjoin(orders, orders.c.id == LedgerEntry.order_id)
+        .where(LedgerEntry.kind.in_([LedgerEntryKind.FREEZE, LedgerEntryKind.SETTLE, LedgerEntryKind.UNFREEZE, LedgerEntryKind.FEE]))
+        .group_by(User.id)
+        .order_by(User.id)
+    )
+    if user_id is not None:
+        statement = statement.where(LedgerEntry.user_id == user_id)
+    if currency is not None:
+        statement = statement.where(User.currency == currency)
+    if since is not None:
+        statement = statement.where(LedgerEntry.created_at >= since)
+    if until is not None:
+        statement = statement.where(LedgerEntry.created_at < until)
+    return statement
+
+async def stream(statement: Select, format: ExportFormat) -> AsyncIterator[str]:
+    """
+    Rows of `statement` encoded batch by batch, preceded by the header for CSV.
+    """
+    async with AsyncSessionFactory() as session:
+        result = await session.stream(statement.execution_options(yield_per=EXPORT_BATCH_SIZE))
+        fields = tuple(result.keys())
+        if format is ExportFormat.CSV:
+            yield encode([fields], format)
+        async for rows in result.partitions():
+            yield encode(rows, format, fields)
+
+def write(connection: Connection, statement: Select, format: ExportFormat, output: TextIO) -> int:
+    """
+    Writes rows of `statement` to `output` batch by batch, preceded by the header for CSV.
+
+    Returns:
+        int: Rows written
+    """
+    result = connection.execution_options(yield_per=EXPORT_BATCH_SIZE).execute(statement)
+    fields = tuple(result.keys())
+    if format is ExportFormat.CSV:
+        output.write(encode([fields], format))
+    written = 0
+    for rows in result.partitions():
+        output.write(encode(rows, format, fields))
+        written += len(rows)
+    return written
+
+def encode(rows: Sequence[Row | tuple], format: ExportFormat, fields: Sequence[str] = ()) -> str:
+    if format is ExportFormat.CSV:
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator='\n').writerows([[_value(value) for value in row] for row in rows])
+        return buffer.getvalue()
+    return ''.join([json.dumps({field: _value(value) for field, value in zip(fields, row)}) + '\n' for row in rows])
+
+def _value(value: Any) -> Any:
+    # Amounts are exported exactly rather than as floats.
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
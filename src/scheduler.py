@@ -0,0 +1,140 @@
+from asyncio import Event, Task, create_task, wait_for
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from heapq import heappop, heappush
+from itertools import count
+import logging
+from typing import Awaitable, Callable, List
+
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.postgresql import insert
+from database import AsyncSessionFactory, Deadline, DeadlineKind
+
+Action = Callable[[List[Deadline]], Awaitable[None]]
+
+# Seconds after which deadlines whose action failed are fired again.
+RETRY_DELAY = 5
+
+
+class Scheduler:
+    """
+    Durable timers for order deadlines.
+
+    Deadlines are persisted in the `deadlines` table and mirrored in a heap, so that a single task fires them all
+    and the ones due while the service was down are fired at startup.
+    Due deadlines are fired in batches per `DeadlineKind` and deleted once their action completes, thus actions must be idempotent.
+    Batches whose action failed are fired again after `RETRY_DELAY`.
+    Cancelled and rescheduled deadlines are removed from the heap lazily.
+    """
+    def __init__(self):
+        self._heap: list[tuple[datetime, int, Deadline]] = []
+        # Live deadline per (kind, key). Heap entries not referenced here are stale.
+        self._scheduled: dict[tuple[str, str], Deadline] = {}
+        self._actions: dict[str, Action] = {}
+        self._sequence = count()
+        self._wakeup = Event()
+        # Batches being fired, referenced so that they aren't garbage collected meanwhile.
+        self._firing: set[Task] = set()
+
+    def register(self, kind: DeadlineKind, action: Action):
+        self._actions[kind] = action
+
+    async def schedule(self, kind: DeadlineKind, delay: float, *targets: tuple[str, int]):
+        """
+        Schedules deadlines of `kind` due in `delay` seconds. Already scheduled deadlines with the same keys are rescheduled.
+
+        Args:
+            kind (DeadlineKind): Kind of the deadlines determining the action fired
+            delay (float): Seconds from now the deadlines are due in
+            targets (tuple[str, int]): (key, user_id) of every deadline
+        """
+        if not targets:
+            return
+
+        due_at = datetime.now(timezone.utc) + timedelta(seconds=delay)
+        deadlines = [Deadline(kind=kind, key=key, user_id=user_id, due_at=due_at) for key, user_id in targets]
+        async with AsyncSessionFactory() as session:
+            statement = insert(Deadline).values([{"kind": d.kind, "key": d.key, "user_id": d.user_id, "due_at": d.due_at} for d in deadlines])
+            await session.execute(statement.on_conflict_do_update(index_elements=[Deadline.kind, Deadline.key], set_={"due_at": statement.excluded.due_at}))
+            await session.commit()
+
+        for deadline in deadlines:
+            self._push(deadline)
+
+    async def cancel(self, kind: DeadlineKind, *keys: str):
+        if not keys:
+            return
+
+        for key in keys:
+            self._scheduled.pop((kind, key), None)
+        async with AsyncSessionFactory() as session:
+            await session.execute(delete(Deadline).filter(Deadline.kind == kind, Deadline.key.in_(keys)))
+            await session.commit()
+
+    def is_scheduled(self, kind: DeadlineKind, key: str) -> bool:
+        return (kind, key) in self._scheduled
+
+    async def load(self):
+        async with AsyncSessionFactory() as session:
+            deadlines = (await session.scalars(select(Deadline))).all()
+
+        for deadline in deadlines:
+            self._push(deadline)
+        logging.info(f"{Scheduler.__name__} loaded {len(deadlines)} deadlines.")
+
+    async def run(self):
+        while True:
+            self._wakeup.clear()
+            timeout = max((self._heap[0][0] - datetime.now(timezone.utc)).total_seconds(), 0) if self._heap else None
+            try:
+                await wait_for(self._wakeup.wait(), timeout)
+            except TimeoutError:
+                pass
+
+            batches: dict[str, list[Deadline]] = defaultdict(list)
+            now = datetime.now(timezone.utc)
+            while self._heap and self._heap[0][0] <= now:
+                _, _, deadline = heappop(self._heap)
+                if self._scheduled.get((deadline.kind, deadline.key)) is deadline:
+                    del self._scheduled[(deadline.kind, deadline.key)]
+                    batches[deadline.kind].append(deadline)
+
+            for kind, deadlines in batches.items():
+                task = create_task(self._fire(kind, deadlines))
+                self._firing.add(task)
+                task.add_done_callback(self._firing.discard)
+
+    def _push(self, deadline: Deadline):
+        self._scheduled[(deadline.kind, deadline.key)] = deadline
+        heappush(self._heap, (deadline.due_at, next(self._sequence), deadline))
+        # Only a deadline due earlier than the awaited one changes when the loop must wake up.
+        if self._heap[0][2] is deadline:
+            self._wakeup.set()
+
+    async def _fire(self, kind: str, deadlines: List[Deadline]):
+        logging.debug(f"Firing {len(deadlines)} {kind} deadlines.")
+        try:
+            await self._actions[kind](deadlines)
+        except Exception as e:
+            # Kept persisted, so that they're fired after restart too.
+            logging.error(f"Error firing {len(deadlines)} {kind} deadlines, retrying in {RETRY_DELAY}s: {e}", exc_info=True)
+            due_at = datetime.now(timezone.utc) + timedelta(seconds=RETRY_DELAY)
+            for deadline in deadlines:
+                # Unless rescheduled meanwhile.
+                if (kind, deadline.key) not in self._scheduled:
+                    self._push(Deadline(kind=deadline.kind, key=deadline.key, user_id=deadline.user_id, due_at=due_at))
+            return
+
+        try:
+            async with AsyncSessionFactory() as session:
+                # Deadlines rescheduled while firing are kept.
+                await session.execute(delete(Deadline).filter(
+                    Deadline.kind == kind,
+                    Deadline.key.in_([deadline.key for deadline in deadlines if (kind, deadline.key) not in self._scheduled])
+                ))
+                await session.commit()
+        except Exception as e:
+            logging.error(f"Error deleting {len(deadlines)} fired {kind} deadlines: {e}", exc_info=True)
+
+
+scheduler = Scheduler()
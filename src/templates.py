@@ -0,0 +1,52 @@
+"""
+MarkdownV2 texts of the bot messages, parsed once at import rather than built by every call.
+"""
+from functools import lru_cache
+from string import Formatter
+from typing import Any, Callable, Optional
+
+from telegram.helpers import escape_markdown as md
+
+
+# Values rendered into messages repeat a lot: currencies, amounts, names of the makers in TOP.
+@lru_cache(maxsize=4096)
+def escape(text: str) -> str:
+    return md(text, version=2)
+
+@lru_cache(maxsize=4096)
+def escape_code(text: str) -> str:
+    return md(text, version=2, entity_type='code')
+
+def raw(text: str) -> str:
+    return text
+
+
+ESCAPES: dict[str, Callable[[str], str]] = {'': escape, 'code': escape_code, 'raw': raw}
+
+
+class Template:
+    """
+    MarkdownV2 text with `{field}`s escaped as they're rendered. `{field:code}` is escaped for code entities
+    and `{field:raw}` isn't escaped, for values that are MarkdownV2 already.
+    """
+    def __init__(self, text: str):
+        self._parts: list[tuple[str, Optional[str], Callable[[str], str]]] = [
+            (literal, field, ESCAPES[spec or ''])
+            for literal, field, spec, _ in Formatter().parse(text)
+        ]
+
+    def render(self, **values: Any) -> str:
+        return ''.join([literal if field is None else literal + escape_value(str(values[field])) for literal, field, escape_value in self._parts])
+
+
+OFFER = Template("Запрос на покупку *{quantity}* USDT\nБаланс: *{balance}* USDT\nПрибыль: *{profit}* {currency}")
+OFFER_EXPIRED = Template("Время ответа на ордер `{order_id:code}` истекло\nСервисная плата в размере *{fee}* USDT была изъята")
+ORDER_ACCEPTED = Template("Ордер ID: `{order_id:code}`\nСтоимость: *{total}* {currency}\nКонтрагент: @{username}\nРеквизиты: `{card:code}`")
+CLIENT_PAID = Template("Клиент оплатил *{total}* {currency}")
+CONFIRM_PAYMENT = Template("{text:raw}\n\nВы уверены?")
+SUPPORT_REQUEST = Template("@techsupport\n\n*Ордер ID*: `{order_id:code}`\n*Время оплаты*: `{paid_at:code}`")
+CLIENT_TIMEOUT = Template("Клиент не совершил перевод по ордеру `{order_id:code}` вовремя\nОрдер отменён\nБаланс разморожен")
+# Appended to the notification of the order.
+CLIENT_TIMEOUT_NOTICE = Template("{text:raw}\n\nКлиент не совершил перевод по ордеру вовремя\nОрдер отменён\nБаланс разморожен")
+ACCOUNT = Template("{name} \\| *{balance}* USDT \\| 1 USDT \\= *{exchange_rate}* {currency}\nРеквизиты: `{card:code}`\n\n*TOP*:\n{top:raw}")
+LEADERBOARD_ENTRY = Template("{name} \\| *{balance}* USDT \\| 1 USDT \\= *{exchange_rate}* {currency}")
@@ -0,0 +1,216 @@
+"""
+Opt-in tracing of Telegram handlers and API routes (`TRACING=file|otlp`).
+
+Every handled update and request gets a span timing it along with the number and duration of the database queries
+and Bot API requests made on its behalf. Finished spans are exported in batches in the background
+as JSON lines to a file or as OTLP/HTTP JSON to a collector.
+"""
+from asyncio import create_task, sleep, to_thread
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+import json
+import logging
+import os
+import random
+from time import perf_counter, time_ns
+from typing import Any, Callable, Iterator, Optional
+
+import httpx
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from telegram.ext import Application, BaseHandler, ConversationHandler
+from config import TRACING, TRACING_FILE, TRACING_OTLP_ENDPOINT, TRACING_SAMPLE_RATE
+
+SERVICE_NAME = 'p2p-bot'
+# Seconds between exports of finished spans.
+EXPORT_INTERVAL = 1
+# Finished spans kept until exported. Spans finished beyond it are dropped.
+BUFFER_SIZE = 10000
+
+
+class Span:
+    def __init__(self, name: str, kind: str, parent: Optional['Span'] = None):
+        self.name = name
+        # `server` for handled updates and requests, `internal` for nested spans.
+        self.kind = kind
+        self.trace_id = parent.trace_id if parent else random.getrandbits(128)
+        self.span_id = random.getrandbits(64)
+        self.parent_id = parent.span_id if parent else None
+        self.start = time_ns()
+        self.end: Optional[int] = None
+        self.error: Optional[str] = None
+        self.attributes: dict[str, Any] = {
+            "db.queries": 0,
+            "db.duration": 0.0,
+            "telegram.requests": 0,
+            "telegram.duration": 0.0,
+        }
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "kind": self.kind,
+            "trace_id": f"{self.trace_id:032x}",
+            "span_id": f"{self.span_id:016x}",
+            "parent_id": self.parent_id and f"{self.parent_id:016x}",
+            "start": self.start,
+            "duration": (self.end - self.start) / 1e9,
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+    def to_otlp(self) -> dict:
+        span = {
+            "traceId": f"{self.trace_id:032x}",
+            "spanId": f"{self.span_id:016x}",
+            "name": self.name,
+            # SPAN_KIND_SERVER and SPAN_KIND_INTERNAL.
+            "kind": 2 if self.kind == 'server' else 1,
+            "startTimeUnixNano": str(self.start),
+            "endTimeUnixNano": str(self.end),
+            "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in self.attributes.items()],
+            # STATUS_CODE_ERROR and STATUS_CODE_UNSET.
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 0},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = f"{self.parent_id:016x}"
+        return span
+
+
+class Tracer:
+    def __init__(self, exporter: str, sample_rate: float):
+        self.enabled = exporter in ('file', 'otlp')
+        self._exporter = exporter
+        self._sample_rate = sample_rate
+        self._current: ContextVar[Optional[Span]] = ContextVar('span', default=None)
+        self._finished: list[Span] = []
+        self._dropped = 0
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def current(self) -> Optional[Span]:
+        return self._current.get()
+
+    @contextmanager
+    def span(self, name: str, **attributes: Any) -> Iterator[Optional[Span]]:
+        """
+        Times the block as a span nested in the current one. Yields None if tracing is off or the trace isn't sampled.
+        """
+        parent = self._current.get()
+        if not self.enabled or (parent is None and random.random() >= self._sample_rate):
+            yield None
+            return
+
+        span = Span(name, 'internal' if parent else 'server', parent)
+        span.attributes.update(attributes)
+        token = self._current.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            self._current.reset(token)
+            span.end = time_ns()
+            if len(self._finished) < BUFFER_SIZE:
+                self._finished.append(span)
+            else:
+                self._dropped += 1
+
+    def record_telegram(self, span: Optional[Span], duration: float):
+        """
+        Adds a Bot API request that took `duration` seconds to `span`, which is captured when the request is queued.
+        """
+        if span is not None:
+            span.attributes["telegram.requests"] += 1
+            span.attributes["telegram.duration"] += duration
+
+    def traced(self, name: str, callback: Callable) -> Callable:
+        @wraps(callback)
+        async def wrapper(*args, **kwargs):
+            with self.span(name):
+                return await callback(*args, **kwargs)
+        wrapper.__traced__ = True
+        return wrapper
+
+    def instrument_engine(self, engine: AsyncEngine):
+        @event.listens_for(engine.sync_engine, 'before_cursor_execute')
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            context._tracing_start = perf_counter()
+
+        @event.listens_for(engine.sync_engine, 'after_cursor_execute')
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            # Queries run in the greenlet of the awaiting task, thus see its span.
+            if span := self._current.get():
+                span.attributes["db.queries"] += 1
+                span.attributes["db.duration"] += perf_counter() - context._tracing_start
+
+    def instrument_handlers(self, application: Application):
+        """
+        Wraps the callbacks of all handlers of `application`, including the ones nested in conversations, in spans named after them.
+        """
+        def instrument(handler: BaseHandler):
+            if isinstance(handler, ConversationHandler):
+                for nested in [*handler.entry_points, *handler.fallbacks, *(h for handlers in handler.states.values() for h in handlers)]:
+                    instrument(nested)
+            # Handlers might be shared by conversations.
+            elif not getattr(handler.callback, '__traced__', False):
+                handler.callback = self.traced(f"telegram {handler.callback.__name__}", handler.callback)
+
+        for handlers in application.handlers.values():
+            for handler in handlers:
+                instrument(handler)
+
+    async def run_export(self):
+        while True:
+            await sleep(EXPORT_INTERVAL)
+            if self._dropped:
+                logging.warning(f"Dropped {self._dropped} spans as the export buffer is full.")
+                self._dropped = 0
+            if not (spans := self._finished):
+                continue
+            self._finished = []
+            try:
+                if self._exporter == 'file':
+                    await to_thread(self._write, spans)
+                else:
+                    await self._post(spans)
+            except Exception as e:
+                logging.error(f"Error exporting {len(spans)} spans: {e}", exc_info=True)
+
+    def start(self):
+        if self.enabled:
+            create_task(self.run_export())
+
+    @staticmethod
+    def _write(spans: list[Span]):
+        with open(TRACING_FILE, 'a') as file:
+            file.writelines(json.dumps(span.to_dict()) + '\n' for span in spans)
+
+    async def _post(self, spans: list[Span]):
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=10)
+        response = await self._client.post(TRACING_OTLP_ENDPOINT, json={
+            "resourceSpans": [{
+                "resource": {"attributes": [
+                    {"key": "service.name", "value": {"stringValue": SERVICE_NAME}},
+                    {"key": "process.pid", "value": {"intValue": str(os.getpid())}},
+                ]},
+                "scopeSpans": [{"scope": {"name": __name__}, "spans": [span.to_otlp() for span in spans]}]
+            }]
+        })
+        response.raise_for_status()
+
+
+def _otlp_value(value: Any) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+tracer = Tracer(TRACING, TRACING_SAMPLE_RATE)